@@ -7,45 +7,157 @@ Author: Oxben <oxben@free.fr>
 -*- coding: utf-8 -*-
 '''
 
+import time
+# Reference of the startup profile (see --startup-profile), taken before the imports
+# it measures
+StartTime = time.perf_counter()
+
+# pylint: disable=wrong-import-position
+import base64
+import functools
 import getopt
+import gzip
+import hashlib
+import importlib.util
 import json
 import logging
+import math
 import os
+import re
 import signal
+import struct
 import sys
+import tempfile
+import threading
+import weakref
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
 
-from PyQt5.QtWidgets import QApplication, QWidget, QStyle
+from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QStyle
 from PyQt5.QtWidgets import QBoxLayout, QVBoxLayout, QSpacerItem
-from PyQt5.QtWidgets import QToolBar, QLabel, QComboBox
+from PyQt5.QtWidgets import QToolBar, QToolButton, QLabel, QComboBox, QProgressBar
 from PyQt5.QtWidgets import QGraphicsItem, QGraphicsPixmapItem, QGraphicsView, QGraphicsScene
-from PyQt5.QtWidgets import QFileDialog, QMessageBox, QOpenGLWidget, QColorDialog
+from PyQt5.QtWidgets import QFileDialog, QMessageBox
 
 from PyQt5.QtGui import QPainter, QPen, QBrush, QPixmap, QImage, QIcon, QDrag, QColor, QPalette
+from PyQt5.QtGui import QImageReader, QImageWriter, QImageIOHandler, QPainterPath, QPixmapCache
+from PyQt5.QtGui import QPixelFormat
+
+from PyQt5.QtCore import Qt, QRect, QRectF, QPoint, QPointF, QMimeData, QSize, QUrl
+from PyQt5.QtCore import QBuffer, QByteArray, QIODevice
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QCoreApplication, QTimer, pyqtSignal
 
-from PyQt5.QtCore import Qt, QRect, QRectF, QPoint, QPointF, QMimeData
+from PyQt5 import sip
+
+from treeview import PhotoBrowser, ImageExtensions
+# pylint: enable=wrong-import-position
 
 RotOffset   = 5.0
 ScaleOffset = 0.05
 SmallScaleOffset = 0.01
 MaxZoom     = 2.0
+# Delay (ms) after the last input before a transformed photo is rendered in high quality
+InteractionIdleDelay = 150
+# Interval (ms) at which accumulated wheel steps are applied
+WheelUpdateInterval = 16
+# Interval (ms) at which performance statistics are updated
+StatsUpdateInterval = 500
+# Undo history: maximum number of entries, and delay (s) within which successive
+# transformations of a photo are merged into one entry
+UndoLimit = 1000
+UndoMergeDelay = 0.5
 FrameRadius = 15
 MaxFrameRadius = 60
 FrameWidth  = 10.0
+CollageAspect = '3:2'
 CollageAspectRatio = (3.0 / 2.0)
 CollageSize = QRectF(0, 0, 2048, 2048 * (1 / CollageAspectRatio))
+CollageLayout = 'Columns 3/2B/3'
 LimitDrag   = True
 OutFileName = ''
+TraceFileName = ''
+ProjectFileName = ''
+ProjectThumbnailSize = 256
+ProjectFileFilter = 'PyView projects (*.pyview);;All Files (*)'
+ExportWidth = None
+ExportDpi = None
+ExportStripHeight = 256
+# (format, quality) of the files exported together, from a single render
+ExportFormats = []
 FrameColor = Qt.white
 FrameBgColor = QColor(216, 216, 216)
 LastDirectory = None
 DefaultPhoto = 'icon-photo-128x128.png'
+DefaultPhotoPath = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'icons', DefaultPhoto)
 DarkTheme = False
+PixmapCacheSize = 512 * 1024 * 1024
+PixmapMemoryBudget = 1024 * 1024 * 1024
+ItemCacheSize = 64 * 1024 * 1024
+# Persistent thumbnails
+ThumbnailSizes = [128, 256, 512]
+CacheDir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                        'pyview')
+ThumbnailCacheDir = os.path.join(CacheDir, 'thumbnails')
+ThumbnailCacheSize = 256 * 1024 * 1024
+LowResSize = 256
+# Photos of more pixels are displayed from tiles decoded for the visible part of the photo
+# only, at the level of detail of the view, instead of a full resolution pixmap
+TiledMinPixels = 50 * 1000 * 1000
+TileSize = 512
+ProxyMode = True
+# Fit photos so that their salient region (subjects, faces...) stays inside the frame,
+# from saliency maps computed on copies of the photos downscaled to SaliencySize squares
+SmartFit = False
+SaliencySize = 64
+# Near-duplicate photos (burst shots...) when filling collages: None to keep them all,
+# 'skip' to keep the first photo of each group, 'spread' to place the others after all
+# the distinct photos. Photos are near-duplicates when their perceptual hashes differ by
+# DuplicateDistance bits at most, out of 64.
+DuplicateMode = None
+DuplicateDistance = 4
+# Perceptual hashes of the photos, computed by batches of PhotoHashBatchSize photos
+PhotoHashFile = os.path.join(CacheDir, 'hashes.jsonl')
+PhotoHashBatchSize = 64
 
 OpenGLRender = False
+Headless = False
+# Log time to first paint and to photos loaded
+StartupProfile = False
+# Delay (ms) after which photos are loaded if the window hasn't been painted yet
+FirstPaintTimeout = 1000
+# Batch mode
+BatchSource = ''
+BatchPhotoCount = None
+BatchJobs = None
+BatchOutputName = 'collage-%04d.jpg'
+# Collages already rendered, for resuming an interrupted batch
+BatchJournalName = '.pyview-batch.jsonl'
+
+OneMB = (1024.0 * 1024.0)
 
 filenames = []
 app = None
 
+Layouts = [
+    ('Grid 2x2',       ('createGridCollage', (2, 2))),
+    ('Grid 3x3',       ('createGridCollage', (3, 3))),
+    ('Grid 3x4',       ('createGridCollage', (3, 4))),
+    ('Grid 4x3',       ('createGridCollage', (4, 3))),
+    ('Grid 4x4',       ('createGridCollage', (4, 4))),
+    ('Grid 5x5',       ('createGridCollage', (5, 5))),
+    ('Grid 7x1',       ('createGridCollage', (7, 1))),
+    ('Columns 1B/3',   ('createColumnCollage', ('1B/3',))),
+    ('Columns 2/2B/2', ('createColumnCollage', ('2/2B/2',))),
+    ('Columns 3/1B/3', ('createColumnCollage', ('3/1B/3',))),
+    ('Columns 3/2B/3', ('createColumnCollage', ('3/2B/3',))),
+    ('Rows 1B/2/3/2B', ('createRowCollage', ('1B/2/3/2B',))),
+    ('Auto',           ('createAutoCollage', ())),
+]
+
+# Aspect ratios of the toolbar combobox (None: separator)
+AspectRatios = ['1:1', None, '3:2', '4:3', '16:9', '16:10', None, '2:3', '3:4']
+
 HelpCommands = [
     ('Left Button',   'Drag image'),
     ('Right Button',  'Drag to swap two images'),
@@ -55,18 +167,1206 @@ HelpCommands = [
     ('+/-',           'Increase/Decrease photo frame'),
     ('Shift + S',     'Save as collage'),
     ('S',             'Save collage'),
+    ('Ctrl + S',      'Save project'),
+    ('Ctrl + O',      'Open project'),
     ('R',             'Rotate photo by 90° clockwise'),
     ('Shift + R',     'Rotate photo by 90° counter-clockwise'),
     ('F',             'Fit photo into frame (fill frame)'),
     ('Shitf + F',     'Fit photo into frame (fit both dimensions)'),
     ('Numpad /',      'Reset photo position, scale and rotation'),
     ('D',             'Toggle dark theme'),
+    ('Ctrl + Z',      'Undo'),
+    ('Ctrl + Y',      'Redo'),
+    ('P',             'Show performance statistics'),
 ]
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+#-------------------------------------------------------------------------------
+class Tracer:
+    '''
+    Record named spans (load, decode, layout, paint, save...) and write them in Chrome
+    trace-event format, viewable in chrome://tracing or Perfetto. When disabled,
+    span() returns a shared no-op context manager.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.filename = None
+        self.events = []
+        # Thread names: thread id -> name
+        self.threads = {}
+        self._nullSpan = nullcontext()
+
+    #-------------------------------------------------------
+    def enable(self, filename):
+        '''Start recording spans, to be written to filename'''
+        self.enabled = True
+        self.filename = filename
+
+    #-------------------------------------------------------
+    def span(self, name, lazyArgs=None, **args):
+        '''
+        Return context manager recording a span named name, with args. lazyArgs is a
+        function returning more args, only called when recording, so that frequent spans
+        cost nothing when tracing is disabled.
+        '''
+        if not self.enabled:
+            return self._nullSpan
+        return self._span(name, lazyArgs, args)
+
+    #-------------------------------------------------------
+    @contextmanager
+    def _span(self, name, lazyArgs, args):
+        if lazyArgs is not None:
+            args.update(lazyArgs())
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            if threading.current_thread() is threading.main_thread():
+                self.threads[tid] = 'GUI'
+            else:
+                self.threads[tid] = 'Worker %d' % len(self.threads)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            # list.append() is atomic: spans can be recorded from the decode threads
+            self.events.append({'name': name, 'cat': 'pyview', 'ph': 'X', 'pid': os.getpid(),
+                                'tid': tid, 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                                'args': args})
+
+    #-------------------------------------------------------
+    def write(self):
+        '''Write recorded spans to trace file'''
+        if not self.enabled:
+            return
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                   'args': {'name': name}} for tid, name in self.threads.items()]
+        events += self.events
+        try:
+            with open(self.filename, 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        except OSError as err:
+            logger.error('Failed to write trace file %s: %s', self.filename, err)
+            return
+        logger.info('Trace written to file: %s (%d spans)', self.filename, len(self.events))
+
+
+tracer = Tracer()
+
+
+#-------------------------------------------------------------------------------
+def traced(name):
+    '''Decorator recording calls of the function as spans named name'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+#-------------------------------------------------------------------------------
+class PixmapCache:
+    '''
+    Process-wide cache of decoded pixmaps, keyed by file path, mtime and size.
+    Least recently used pixmaps are evicted when the byte budget is exceeded.
+    '''
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.currentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._pixmaps = OrderedDict()
+
+    #-------------------------------------------------------
+    @staticmethod
+    def key(filename):
+        '''Return cache key of file, or None if the file can't be accessed'''
+        try:
+            st = os.stat(filename)
+        except (OSError, ValueError):
+            return None
+        return (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+
+    #-------------------------------------------------------
+    @staticmethod
+    def tileKey(key, level, column, row):
+        '''Return cache key of a tile of the file of cache key key (see TileDecodeTask)'''
+        return key + ('tile', level, column, row)
+
+    #-------------------------------------------------------
+    @staticmethod
+    def pixmapBytes(pixmap):
+        '''Return memory used by pixmap'''
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    #-------------------------------------------------------
+    def setMaxBytes(self, maxBytes):
+        '''Set cache byte budget'''
+        self.maxBytes = maxBytes
+        self._evict()
+
+    #-------------------------------------------------------
+    def find(self, key):
+        '''Return cached pixmap for key, or None'''
+        pixmap = self._pixmaps.get(key)
+        if pixmap is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._pixmaps.move_to_end(key)
+        return pixmap
+
+    #-------------------------------------------------------
+    def insert(self, key, pixmap):
+        '''Insert pixmap in cache'''
+        size = self.pixmapBytes(pixmap)
+        if key is None or pixmap.isNull() or size > self.maxBytes:
+            return
+        old = self._pixmaps.pop(key, None)
+        if old is not None:
+            self.currentBytes -= self.pixmapBytes(old)
+        self._pixmaps[key] = pixmap
+        self.currentBytes += size
+        self._evict()
+
+    #-------------------------------------------------------
+    def get(self, filename):
+        '''Return pixmap of file, decoding it on cache miss'''
+        key = self.key(filename)
+        if key is None:
+            return QPixmap()
+        pixmap = self.find(key)
+        if pixmap is None:
+            with tracer.span('load', lambda: {'file': os.path.basename(filename)}, sync=True):
+                reader = QImageReader(filename)
+                # EXIF orientation is applied as the photo rotation
+                reader.setAutoTransform(False)
+                pixmap = QPixmap.fromImage(reader.read())
+            self.insert(key, pixmap)
+        return pixmap
+
+    #-------------------------------------------------------
+    def remove(self, key):
+        '''Remove pixmap of key from cache'''
+        pixmap = self._pixmaps.pop(key, None)
+        if pixmap is not None:
+            self.currentBytes -= self.pixmapBytes(pixmap)
+
+    #-------------------------------------------------------
+    def entries(self):
+        '''Return list of (key, pixmap) in cache, least recently used first'''
+        return list(self._pixmaps.items())
+
+    #-------------------------------------------------------
+    def values(self):
+        '''Return list of pixmaps in cache, least recently used first'''
+        return list(self._pixmaps.values())
+
+    #-------------------------------------------------------
+    def clear(self):
+        '''Remove all pixmaps from cache'''
+        self._pixmaps.clear()
+        self.currentBytes = 0
+
+    #-------------------------------------------------------
+    def _evict(self):
+        '''Drop least recently used pixmaps until cache fits in its budget'''
+        while self.currentBytes > self.maxBytes and self._pixmaps:
+            key, pixmap = self._pixmaps.popitem(last=False)
+            self.currentBytes -= self.pixmapBytes(pixmap)
+            logger.debug('PixmapCache: evict %s', key[0])
+
+    #-------------------------------------------------------
+    def __str__(self):
+        return 'PixmapCache: %d pixmaps, %.1f/%.1f MB, %d hits, %d misses' % \
+            (len(self._pixmaps), self.currentBytes / OneMB, self.maxBytes / OneMB,
+             self.hits, self.misses)
+
+
+pixmapCache = PixmapCache(PixmapCacheSize)
+
+# Original size of images: cache key -> QSize
+imageSizes = {}
+
+
+#-------------------------------------------------------------------------------
+def imageSize(filename):
+    '''Return original size of image, read from the file header without decoding it'''
+    key = PixmapCache.key(filename)
+    size = imageSizes.get(key)
+    if size is None:
+        size = QImageReader(filename).size()
+        if key is not None and size.isValid():
+            imageSizes[key] = size
+    return QSize(size)
+
+
+# NumPy module, imported on first use by loadNumpy(): its import is slow
+np = None
+
+
+#-------------------------------------------------------------------------------
+def numpyAvailable():
+    '''Return True if NumPy is installed, without importing it'''
+    return np is not None or importlib.util.find_spec('numpy') is not None
+
+
+#-------------------------------------------------------------------------------
+def loadNumpy():
+    '''Import NumPy, needed by smart fit and near-duplicates. Return False if not installed.'''
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+        np = numpy
+    return True
+
+
+# Saliency maps of images (see computeSaliency()): cache key -> float array
+saliencyMaps = {}
+
+# EXIF orientation of images: cache key -> orientation
+imageOrientations = {}
+
+# Rotation of the photo for each EXIF orientation. Mirrored orientations are
+# approximated by their rotation.
+ExifRotations = {1: 0, 2: 0, 3: 180, 4: 180, 5: 90, 6: 90, 7: 270, 8: 270}
+
+
+#-------------------------------------------------------------------------------
+def readExif(filename):
+    '''
+    Return (orientation, thumbnail) read from the EXIF block of a JPEG file, without
+    decoding the image. thumbnail is the embedded JPEG thumbnail data, or None.
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return (1, None)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xff or marker[1] in (0xd9, 0xda):
+                    # Not a marker, end of image or start of scan: no EXIF block
+                    break
+                length = struct.unpack('>H', f.read(2))[0]
+                if marker[1] == 0xe1:
+                    data = f.read(length - 2)
+                    if data[:6] == b'Exif\x00\x00':
+                        return parseExif(data[6:])
+                else:
+                    f.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        pass
+    return (1, None)
+
+
+#-------------------------------------------------------------------------------
+def parseExif(tiff):
+    '''Return (orientation, thumbnail) from the TIFF structure of an EXIF block'''
+    orientation = 1
+    thumbnail = None
+    try:
+        order = {b'II': '<', b'MM': '>'}[tiff[:2]]
+        # IFD0 holds the orientation, IFD1 the thumbnail
+        offset = struct.unpack(order + 'I', tiff[4:8])[0]
+        for ifd in range(2):
+            if not offset or offset + 2 > len(tiff):
+                break
+            count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+            thumbOffset = thumbLength = None
+            for i in range(count):
+                entry = tiff[offset + 2 + i * 12:offset + 14 + i * 12]
+                tag = struct.unpack(order + 'H', entry[:2])[0]
+                if ifd == 0 and tag == 0x0112:
+                    orientation = struct.unpack(order + 'H', entry[8:10])[0]
+                elif ifd == 1 and tag == 0x0201:
+                    thumbOffset = struct.unpack(order + 'I', entry[8:12])[0]
+                elif ifd == 1 and tag == 0x0202:
+                    thumbLength = struct.unpack(order + 'I', entry[8:12])[0]
+            if thumbOffset and thumbLength:
+                data = tiff[thumbOffset:thumbOffset + thumbLength]
+                if data[:2] == b'\xff\xd8':
+                    thumbnail = data
+            end = offset + 2 + count * 12
+            offset = struct.unpack(order + 'I', tiff[end:end + 4])[0]
+    except (KeyError, struct.error):
+        pass
+    if orientation not in ExifRotations:
+        orientation = 1
+    return (orientation, thumbnail)
+
+
+#-------------------------------------------------------------------------------
+def imageRotation(filename):
+    '''Return rotation (in degrees) to display image upright, from its EXIF orientation'''
+    key = PixmapCache.key(filename)
+    orientation = imageOrientations.get(key)
+    if orientation is None:
+        orientation = readExif(filename)[0]
+        if key is not None:
+            imageOrientations[key] = orientation
+    return ExifRotations[orientation]
+
+
+#-------------------------------------------------------------------------------
+def readPngText(filename):
+    '''
+    Return dict of the tEXt chunks preceding the image data of a PNG file, without
+    decoding it. (Qt splits keys containing ':' when reading them.)
+    '''
+    text = {}
+    try:
+        with open(filename, 'rb') as f:
+            if f.read(8) != b'\x89PNG\r\n\x1a\n':
+                return text
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                length, chunkType = struct.unpack('>I4s', header)
+                if chunkType in (b'IDAT', b'IEND'):
+                    break
+                if chunkType == b'tEXt':
+                    key, _, value = f.read(length).partition(b'\x00')
+                    text[key.decode('latin-1')] = value.decode('latin-1')
+                    f.seek(4, os.SEEK_CUR)
+                else:
+                    f.seek(length + 4, os.SEEK_CUR)
+    except (OSError, struct.error):
+        pass
+    return text
+
+
+#-------------------------------------------------------------------------------
+class ThumbnailStore:
+    '''
+    Persistent thumbnails shared by PyView sessions and processes, in the spirit of the
+    freedesktop.org thumbnail spec: one directory per size, PNG files named after the MD5
+    of the file URI, URI, mtime and size of the original file stored in PNG text chunks
+    to detect outdated thumbnails. Unlike the spec, thumbnails keep the orientation of
+    the file (EXIF orientation is applied as the photo rotation), hence a directory of
+    their own. Files are written atomically, and the least recently used ones are pruned
+    when the store exceeds its size. Methods can be called from the decode threads.
+    The store also keeps JPEG copies of the large images whose format can't be decoded
+    by regions (see regionSource()).
+    '''
+
+    # Directory of the JPEG copies of large images
+    CopiesDir = 'large'
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.enabled = True
+        # Unknown until the store is scanned on first write
+        self.currentBytes = None
+        self._lock = threading.Lock()
+        self._copyLock = threading.Lock()
+
+    #-------------------------------------------------------
+    def path(self, filename, size):
+        '''Return path of thumbnail of file at size'''
+        uri = QUrl.fromLocalFile(os.path.abspath(filename)).toEncoded().data()
+        return os.path.join(self.directory, str(size), hashlib.md5(uri).hexdigest() + '.png')
+
+    #-------------------------------------------------------
+    def find(self, filename, key, coverSize=None, fallback=False):
+        '''
+        Return (image, sourceSize) of the smallest thumbnail of file covering coverSize,
+        sourceSize being the size of the original image. If none covers it and fallback
+        is set, return the biggest thumbnail. Return None if not found.
+        key is the pixmap cache key of the file.
+        '''
+        if not self.enabled or key is None:
+            return None
+        needed = max(coverSize.width(), coverSize.height()) if coverSize else 0
+        best = None
+        for size in ThumbnailSizes:
+            if size < needed:
+                continue
+            thumbnail = self._read(self.path(filename, size), key)
+            if thumbnail is None:
+                continue
+            image, sourceSize = thumbnail
+            if coverSize is None or image.size() == sourceSize or \
+               (image.width() >= coverSize.width() and image.height() >= coverSize.height()):
+                return thumbnail
+            best = thumbnail
+        if fallback and best is None:
+            for size in reversed(ThumbnailSizes):
+                if size < needed:
+                    best = self._read(self.path(filename, size), key)
+                    if best:
+                        break
+        return best if fallback else None
+
+    #-------------------------------------------------------
+    def _read(self, path, key):
+        '''Return (image, sourceSize) read from thumbnail file if it is up to date, or None'''
+        text = readPngText(path)
+        if text.get('Thumb::Size') != str(key[2]) or text.get('X-PyView::MTimeNs') != str(key[1]):
+            return None
+        try:
+            sourceSize = QSize(int(text['Thumb::Image::Width']), int(text['Thumb::Image::Height']))
+        except (KeyError, ValueError):
+            return None
+        image = QImage(path, 'PNG')
+        if image.isNull():
+            return None
+        try:
+            # Last access time, for pruning
+            os.utime(path)
+        except OSError:
+            pass
+        return (image, sourceSize)
+
+    #-------------------------------------------------------
+    def store(self, filename, key, image, sourceSize):
+        '''Store thumbnails of file, at the sizes image is big enough for'''
+        if not self.enabled or key is None or image.isNull():
+            return
+        uri = QUrl.fromLocalFile(os.path.abspath(filename)).toString(QUrl.FullyEncoded)
+        for size in ThumbnailSizes:
+            if size > max(image.width(), image.height()):
+                break
+            path = self.path(filename, size)
+            if readPngText(path).get('X-PyView::MTimeNs') == str(key[1]):
+                # Already stored
+                continue
+            thumbnail = image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            thumbnail.setText('Thumb::URI', uri)
+            thumbnail.setText('Thumb::MTime', str(key[1] // 1000000000))
+            thumbnail.setText('Thumb::Size', str(key[2]))
+            thumbnail.setText('Thumb::Image::Width', str(sourceSize.width()))
+            thumbnail.setText('Thumb::Image::Height', str(sourceSize.height()))
+            thumbnail.setText('X-PyView::MTimeNs', str(key[1]))
+            self._write(thumbnail, path)
+
+    #-------------------------------------------------------
+    def regionSource(self, filename, key):
+        '''
+        Return path of a file with the pixels of filename that can be decoded by regions:
+        filename itself if its format supports it (JPEG), or else a JPEG copy, written on
+        first use by decoding the whole image once. Images with an alpha channel have no
+        copy. key is the pixmap cache key of the file.
+        '''
+        reader = QImageReader(filename)
+        if not self.enabled or key is None or reader.supportsOption(QImageIOHandler.ClipRect) or \
+           QImage.toPixelFormat(reader.imageFormat()).alphaUsage() == QPixelFormat.UsesAlpha:
+            return filename
+        name = '%s-%d-%d' % (QUrl.fromLocalFile(key[0]).toString(QUrl.FullyEncoded), key[1], key[2])
+        path = os.path.join(self.directory, self.CopiesDir,
+                            hashlib.md5(name.encode('utf-8')).hexdigest() + '.jpg')
+        # Copies take seconds to write: don't write the same one twice
+        with self._copyLock:
+            try:
+                # Last access time, for pruning
+                os.utime(path)
+                return path
+            except OSError:
+                pass
+            with tracer.span('copy', lambda: {'file': os.path.basename(filename)}):
+                reader.setAutoTransform(False)
+                image = reader.read()
+                if image.isNull() or not self._write(image, path, 92):
+                    return filename
+        logger.debug('ThumbnailStore: copied %s to %s', filename, path)
+        return path
+
+    #-------------------------------------------------------
+    def _write(self, image, path, quality=-1):
+        '''
+        Write image atomically, in the format of the extension of path: other processes
+        never see a partial file. Return True on success.
+        '''
+        tmpPath = None
+        try:
+            directory = os.path.dirname(path)
+            os.makedirs(directory, 0o700, exist_ok=True)
+            ext = os.path.splitext(path)[1]
+            fd, tmpPath = tempfile.mkstemp(prefix='.', suffix=ext, dir=directory)
+            os.close(fd)
+            if not image.save(tmpPath, ext[1:].upper(), quality):
+                raise OSError('failed to encode image')
+            size = os.path.getsize(tmpPath)
+            os.replace(tmpPath, path)
+        except OSError as err:
+            logger.debug('Failed to write thumbnail %s: %s', path, err)
+            if tmpPath and os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            return False
+        with self._lock:
+            if self.currentBytes is None:
+                self.currentBytes = sum(size for mtime, size, path in self._files())
+            else:
+                self.currentBytes += size
+            if self.currentBytes > self.maxBytes:
+                self._prune()
+        return True
+
+    #-------------------------------------------------------
+    def _files(self):
+        '''Return list of (mtime, size, path) of the thumbnail files'''
+        files = []
+        for subdir in [str(size) for size in ThumbnailSizes] + [self.CopiesDir]:
+            try:
+                with os.scandir(os.path.join(self.directory, subdir)) as it:
+                    for entry in it:
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        files.append((st.st_mtime, st.st_size, entry.path))
+            except OSError:
+                continue
+        return files
+
+    #-------------------------------------------------------
+    def _prune(self):
+        '''Remove least recently used thumbnails until the store is 10% under its size'''
+        files = sorted(self._files())
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in files:
+            if total <= self.maxBytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Removed by another process
+                pass
+            except OSError:
+                continue
+            total -= size
+        self.currentBytes = total
+        logger.debug('ThumbnailStore: pruned to %.1f MB', total / OneMB)
+
+
+thumbnailStore = ThumbnailStore(ThumbnailCacheDir, ThumbnailCacheSize)
+
+
+#-------------------------------------------------------------------------------
+class DecodeTask(QRunnable):
+    '''Decode an image file in a worker thread (QImage only, no QPixmap)'''
+
+    def __init__(self, loader, requestId, key, filename, maxSize=None):
+        super(DecodeTask, self).__init__()
+        self.loader = loader
+        self.requestId = requestId
+        self.key = key
+        self.filename = filename
+        self.maxSize = maxSize
+
+    #-------------------------------------------------------
+    def run(self):
+        '''Decode image and send it back to the GUI thread'''
+        with tracer.span('decode', lambda: {'file': os.path.basename(self.filename),
+                                            'proxy': bool(self.maxSize)}):
+            self._run()
+
+    #-------------------------------------------------------
+    def _run(self):
+        start = time.perf_counter()
+        # Proxies small enough are read from the thumbnail store
+        thumbnail = thumbnailStore.find(self.filename, self.key[:3], self.maxSize) \
+            if self.maxSize else None
+        if thumbnail:
+            image, sourceSize = thumbnail
+            imageSizes[self.key[:3]] = sourceSize
+        else:
+            image = self._decode()
+        if image.hasAlphaChannel():
+            image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        elif not image.isNull():
+            image = image.convertToFormat(QImage.Format_RGB32)
+        self.loader.decoded.emit(self.requestId, self.key, image, time.perf_counter() - start)
+
+    #-------------------------------------------------------
+    def _decode(self):
+        '''Decode image file, return QImage'''
+        reader = QImageReader(self.filename)
+        # EXIF orientation is applied as the photo rotation
+        reader.setAutoTransform(False)
+        sourceSize = reader.size()
+        if sourceSize.isValid():
+            imageSizes[self.key[:3]] = sourceSize
+            if self.maxSize:
+                # Proxy: decode image straight to the size needed to cover maxSize, and
+                # at least the smallest thumbnail size. The JPEG plugin uses reduced DCT
+                # scaling in this case.
+                ratio = max(self.maxSize.width() / sourceSize.width(),
+                            self.maxSize.height() / sourceSize.height())
+                if thumbnailStore.enabled:
+                    ratio = max(ratio, ThumbnailSizes[0] / max(sourceSize.width(),
+                                                               sourceSize.height()))
+                if ratio < 1:
+                    reader.setScaledSize(QSize(max(1, round(sourceSize.width() * ratio)),
+                                               max(1, round(sourceSize.height() * ratio))))
+        image = reader.read()
+        if image.isNull():
+            logger.warning('Failed to decode %s: %s', self.filename, reader.errorString())
+        elif self.maxSize and sourceSize.isValid():
+            thumbnailStore.store(self.filename, self.key[:3], image, sourceSize)
+        return image
+
+
+#-------------------------------------------------------------------------------
+class TileDecodeTask(QRunnable):
+    '''
+    Decode a block of tiles of a large image in a worker thread. Tiles are TileSize pixels
+    squares of a level of detail of the image, level n being the image downscaled by 2^n.
+    The block is decoded at once from the region of the image it covers, directly at the
+    level size, then cut into tiles.
+    '''
+
+    def __init__(self, loader, requestId, key, filename, level, tiles):
+        super(TileDecodeTask, self).__init__()
+        self.loader = loader
+        self.requestId = requestId
+        self.key = key
+        self.filename = filename
+        self.level = level
+        # Columns and rows of the tiles
+        self.tiles = tiles
+
+    #-------------------------------------------------------
+    def run(self):
+        '''Decode tiles and send them back to the GUI thread'''
+        with tracer.span('decode', lambda: {'file': os.path.basename(self.filename),
+                                            'level': self.level,
+                                            'tiles': self.tiles.width() * self.tiles.height()}):
+            start = time.perf_counter()
+            tiles = self._decode()
+            self.loader.tilesDecoded.emit(self.requestId, self.key, tiles,
+                                          time.perf_counter() - start)
+
+    #-------------------------------------------------------
+    def _decode(self):
+        '''Return list of (cache key, QImage) of the tiles'''
+        fileKey = self.key[:3]
+        reader = QImageReader(thumbnailStore.regionSource(self.filename, fileKey))
+        reader.setAutoTransform(False)
+        scale = 1 << self.level
+        # Size of a tile in the source image
+        size = TileSize * scale
+        region = QRect(self.tiles.x() * size, self.tiles.y() * size,
+                       self.tiles.width() * size, self.tiles.height() * size)
+        region &= QRect(QPoint(0, 0), reader.size())
+        if region.isEmpty():
+            return []
+        reader.setClipRect(region)
+        reader.setScaledSize(QSize(-(-region.width() // scale), -(-region.height() // scale)))
+        image = reader.read()
+        if image.isNull():
+            logger.warning('Failed to decode %s: %s', self.filename, reader.errorString())
+            return []
+        image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied if image.hasAlphaChannel()
+                                      else QImage.Format_RGB32)
+        tiles = []
+        for row in range(self.tiles.height()):
+            for column in range(self.tiles.width()):
+                rect = QRect(column * TileSize, row * TileSize, TileSize, TileSize) & image.rect()
+                if not rect.isEmpty():
+                    tiles.append((PixmapCache.tileKey(fileKey, self.level, self.tiles.x() + column,
+                                                      self.tiles.y() + row), image.copy(rect)))
+        return tiles
+
+
+#-------------------------------------------------------------------------------
+def decodeSmall(filename, fileKey, minSize):
+    '''
+    Return image of file downscaled to about minSize pixels on its smaller side or more,
+    read from the thumbnail store when possible. fileKey is the pixmap cache key of the
+    file. Return a null image if the file can't be decoded.
+    '''
+    thumbnail = thumbnailStore.find(filename, fileKey)
+    if thumbnail:
+        return thumbnail[0]
+    reader = QImageReader(filename)
+    reader.setAutoTransform(False)
+    size = reader.size()
+    if size.isValid():
+        # The JPEG plugin uses DCT scaling
+        ratio = min(1.0, minSize / max(1, min(size.width(), size.height())))
+        reader.setScaledSize(QSize(max(1, round(size.width() * ratio)),
+                                   max(1, round(size.height() * ratio))))
+    image = reader.read()
+    if image.isNull():
+        logger.warning('Failed to decode %s: %s', filename, reader.errorString())
+    return image
+
+
+#-------------------------------------------------------------------------------
+def imageArray(image):
+    '''
+    Return (height, width, 4) uint8 array viewing the pixels of a 32 bits per pixel image,
+    without copy. The image must outlive the array.
+    '''
+    pixels = image.constBits()
+    pixels.setsize(image.byteCount())
+    array = np.frombuffer(pixels, np.uint8).reshape(image.height(), image.bytesPerLine() // 4, 4)
+    return array[:, :image.width()]
+
+
+#-------------------------------------------------------------------------------
+def boxBlur(array, radius):
+    '''Return array blurred by a box filter of radius along axes 1 and 2'''
+    for axis in (1, 2):
+        padding = [(0, 0)] * array.ndim
+        padding[axis] = (radius, radius)
+        padded = np.pad(array, padding, mode='edge')
+        size = array.shape[axis]
+        array = sum(padded.take(range(i, i + size), axis=axis)
+                    for i in range(2 * radius + 1)) / (2 * radius + 1)
+    return array
+
+
+#-------------------------------------------------------------------------------
+def computeSaliency(pixels):
+    '''
+    Return saliency maps of a batch of images, given as a (count, height, width, 3) RGB
+    array, as a (count, height, width) float32 array. Each map sums to 1. Saliency
+    combines the contrast of colors with the mean color of the image (frequency-tuned
+    saliency) and the density of edges, weighted by a mild center prior.
+    '''
+    rgb = pixels.astype(np.float32)
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    luminance = (red + green + blue) / 3
+    # Opponent color space, closer to perception than RGB
+    colors = np.stack([luminance, red - green, (red + green) / 2 - blue], axis=-1)
+    blurred = boxBlur(colors, 1)
+    contrast = np.sqrt(((blurred - colors.mean(axis=(1, 2), keepdims=True)) ** 2).sum(axis=-1))
+    gradientY, gradientX = np.gradient(luminance, axis=(1, 2))
+    edges = boxBlur(np.hypot(gradientX, gradientY), 2)
+    saliency = sum(channel / np.maximum(channel.max(axis=(1, 2), keepdims=True), 1e-6)
+                   for channel in (contrast, edges))
+    height, width = saliency.shape[1:]
+    y, x = np.ogrid[-1:1:height * 1j, -1:1:width * 1j]
+    saliency *= 1 - 0.3 * (x ** 2 + y ** 2) / 2
+    # Keep the regions standing out only
+    saliency = np.maximum(saliency - saliency.mean(axis=(1, 2), keepdims=True), 0) ** 2
+    total = saliency.sum(axis=(1, 2), keepdims=True)
+    saliency = np.where(total > 0, saliency / np.maximum(total, 1e-12), 1 / (height * width))
+    return saliency.astype(np.float32)
+
+
+#-------------------------------------------------------------------------------
+def salientRegion(saliency, mass=0.8):
+    '''
+    Return (left, top, right, bottom) of the region holding mass of the saliency map, in
+    fractions of the map size
+    '''
+    cut = (1 - mass) / 2
+    bounds = []
+    for axis in (0, 1):
+        # Columns, then rows
+        cumulative = np.cumsum(saliency.sum(axis=axis))
+        count = len(cumulative)
+        start = np.searchsorted(cumulative, cut * cumulative[-1])
+        end = np.searchsorted(cumulative, (1 - cut) * cumulative[-1]) + 1
+        bounds.append((start / count, min(end, count) / count))
+    (left, right), (top, bottom) = bounds
+    return left, top, right, bottom
+
+
+#-------------------------------------------------------------------------------
+def salientWindow(saliency, width, height):
+    '''
+    Return position (x, y) of the window of size (width, height) holding the most saliency,
+    all in fractions of the map size. Window dimensions larger than the map are centered.
+    '''
+    rows, columns = saliency.shape
+    windowColumns = min(columns, max(1, round(width * columns)))
+    windowRows = min(rows, max(1, round(height * rows)))
+    # Saliency of all the windows, from the integral image
+    integral = np.zeros((rows + 1, columns + 1))
+    integral[1:, 1:] = saliency.cumsum(axis=0).cumsum(axis=1)
+    sums = integral[windowRows:, windowColumns:] - integral[:-windowRows, windowColumns:] - \
+        integral[windowRows:, :-windowColumns] + integral[:-windowRows, :-windowColumns]
+    # Among windows about as salient, the one centered the closest to the center of mass
+    ys, xs = np.nonzero(sums >= sums.max() * 0.98)
+    centerY = (saliency.sum(axis=1) * np.arange(rows)).sum() + 0.5
+    centerX = (saliency.sum(axis=0) * np.arange(columns)).sum() + 0.5
+    best = np.argmin((ys + windowRows / 2 - centerY) ** 2 + (xs + windowColumns / 2 - centerX) ** 2)
+    x = (1 - width) / 2 if width >= 1 else min(xs[best] / columns, 1 - width)
+    y = (1 - height) / 2 if height >= 1 else min(ys[best] / rows, 1 - height)
+    return x, y
+
+
+#-------------------------------------------------------------------------------
+class SaliencyTask(QRunnable):
+    '''
+    Compute saliency maps of a batch of image files in a worker thread. Images are read
+    downscaled to SaliencySize squares, from the thumbnail store when possible, and their
+    maps computed at once.
+    '''
+
+    def __init__(self, loader, requestId, key, filenames):
+        super(SaliencyTask, self).__init__()
+        self.loader = loader
+        self.requestId = requestId
+        self.key = key
+        self.filenames = filenames
+
+    #-------------------------------------------------------
+    def run(self):
+        '''Compute saliency maps and send them back to the GUI thread'''
+        with tracer.span('saliency', files=len(self.filenames)):
+            start = time.perf_counter()
+            images = [self._read(filename, fileKey)
+                      for filename, fileKey in zip(self.filenames, self.key[1:])]
+            found = [(fileKey, image) for fileKey, image in zip(self.key[1:], images)
+                     if not image.isNull()]
+            maps = {}
+            if found:
+                pixels = np.stack([imageArray(image)[..., :3] for fileKey, image in found])
+                maps = dict(zip([fileKey for fileKey, image in found], computeSaliency(pixels)))
+            self.loader.saliencyComputed.emit(self.requestId, self.key, maps,
+                                              time.perf_counter() - start)
+
+    #-------------------------------------------------------
+    def _read(self, filename, fileKey):
+        '''Return image of file downscaled to a SaliencySize square, in RGBX format'''
+        # Keep some details for the edges
+        image = decodeSmall(filename, fileKey, 4 * SaliencySize)
+        if image.isNull():
+            return image
+        return image.scaled(SaliencySize, SaliencySize, Qt.IgnoreAspectRatio,
+                            Qt.SmoothTransformation).convertToFormat(QImage.Format_RGBX8888)
+
+
+#-------------------------------------------------------------------------------
+class ImageLoader(QObject):
+    '''
+    Load pixmaps asynchronously: images are decoded by a pool of worker threads,
+    converted to QPixmap and stored in the pixmap cache in the GUI thread.
+    '''
+
+    decoded = pyqtSignal(int, object, QImage, float)
+    tilesDecoded = pyqtSignal(int, object, object, float)
+    saliencyComputed = pyqtSignal(int, object, object, float)
+
+    def __init__(self):
+        super(ImageLoader, self).__init__()
+        self.pool = QThreadPool(self)
+        self.nextRequestId = 0
+        # Pending requests: cache key -> (request id, filename, callbacks, task)
+        self.requests = {}
+        # Number and total duration (s) of completed decodes
+        self.decodeCount = 0
+        self.decodeTime = 0.0
+        # Number and total duration (s) of completed saliency batches
+        self.saliencyCount = 0
+        self.saliencyTime = 0.0
+        self.decoded.connect(self._decodedHandler)
+        self.tilesDecoded.connect(self._tilesDecodedHandler)
+        self.saliencyComputed.connect(self._saliencyComputedHandler)
+
+    #-------------------------------------------------------
+    def load(self, filename, callback, maxSize=None):
+        '''
+        Load pixmap of file and call callback(filename, pixmap, sourceSize) from the GUI
+        thread, sourceSize being the size of the original image. If maxSize is set, a
+        proxy just big enough to cover maxSize is decoded instead of the full image.
+        The callback is called immediately if the pixmap is already in cache.
+        '''
+        key = PixmapCache.key(filename)
+        if key is None:
+            callback(filename, QPixmap(), QSize())
+            return
+        if maxSize:
+            key += (maxSize.width(), maxSize.height())
+        pixmap = pixmapCache.find(key)
+        if pixmap is not None:
+            callback(filename, pixmap, imageSize(filename))
+            return
+        request = self.requests.get(key)
+        if request:
+            request[2].append(callback)
+            return
+        self.nextRequestId += 1
+        task = DecodeTask(self, self.nextRequestId, key, filename, maxSize)
+        self.requests[key] = (self.nextRequestId, filename, [callback], task)
+        self.pool.start(task)
+
+    #-------------------------------------------------------
+    def cancel(self, filename, callback, maxSize=None):
+        '''
+        Cancel request made by load(). The decode is dropped if it hasn't started and no
+        other callback is waiting for it.
+        '''
+        key = PixmapCache.key(filename)
+        if key is None:
+            return
+        if maxSize:
+            key += (maxSize.width(), maxSize.height())
+        self.cancelRequest(key, callback)
+
+    #-------------------------------------------------------
+    def loadTiles(self, filename, level, tiles, callback):
+        '''
+        Decode the tiles of level of detail of file whose columns and rows are in the tiles
+        rectangle, and insert them in the pixmap cache (see PixmapCache.tileKey()). Then
+        call callback(filename, key, ok) from the GUI thread. Return request key, or None
+        if the file can't be accessed.
+        '''
+        key = PixmapCache.key(filename)
+        if key is None:
+            return None
+        key += ('tiles', level, tiles.x(), tiles.y(), tiles.width(), tiles.height())
+        request = self.requests.get(key)
+        if request:
+            request[2].append(callback)
+            return key
+        self.nextRequestId += 1
+        task = TileDecodeTask(self, self.nextRequestId, key, filename, level, tiles)
+        self.requests[key] = (self.nextRequestId, filename, [callback], task)
+        self.pool.start(task)
+        return key
+
+    #-------------------------------------------------------
+    def loadSaliency(self, filenames, callback):
+        '''
+        Compute saliency maps of files, in a single batch, and store them in saliencyMaps.
+        Then call callback(filenames) from the GUI thread. Files that can't be accessed
+        are skipped. Return request key, or None if there is no file to process.
+        '''
+        files = [(filename, PixmapCache.key(filename)) for filename in filenames]
+        files = [(filename, key) for filename, key in files if key is not None]
+        if not files:
+            return None
+        key = ('saliency',) + tuple(key for filename, key in files)
+        request = self.requests.get(key)
+        if request:
+            request[2].append(callback)
+            return key
+        self.nextRequestId += 1
+        filenames = [filename for filename, key in files]
+        task = SaliencyTask(self, self.nextRequestId, key, filenames)
+        self.requests[key] = (self.nextRequestId, filenames, [callback], task)
+        self.pool.start(task)
+        return key
+
+    #-------------------------------------------------------
+    def cancelRequest(self, key, callback):
+        '''Cancel request of key made by load(), loadTiles() or loadSaliency()'''
+        request = self.requests.get(key)
+        if not request or callback not in request[2]:
+            return
+        request[2].remove(callback)
+        if not request[2] and not sip.isdeleted(request[3]) and self.pool.tryTake(request[3]):
+            del self.requests[key]
+
+    #-------------------------------------------------------
+    def cancelAll(self):
+        '''Cancel all pending requests. Decodes already running are dropped on completion.'''
+        self.pool.clear()
+        self.requests.clear()
+
+    #-------------------------------------------------------
+    def waitForDone(self):
+        '''Block until all pending requests have been completed'''
+        while self.requests:
+            self.pool.waitForDone()
+            QCoreApplication.processEvents()
+
+    #-------------------------------------------------------
+    def pendingCount(self):
+        '''Return number of pending requests'''
+        return len(self.requests)
+
+    #-------------------------------------------------------
+    def _decodedHandler(self, requestId, key, image, decodeTime):
+        '''Called in GUI thread when a worker has decoded an image'''
+        self.decodeCount += 1
+        self.decodeTime += decodeTime
+        request = self.requests.get(key)
+        if not request or request[0] != requestId:
+            # Stale or cancelled request
+            return
+        del self.requests[key]
+        with tracer.span('load', lambda: {'file': os.path.basename(request[1])}):
+            pixmap = QPixmap.fromImage(image)
+        pixmapCache.insert(key, pixmap)
+        sourceSize = QSize(imageSizes.get(key[:3], pixmap.size()))
+        for callback in self._liveCallbacks(request[2]):
+            callback(request[1], pixmap, sourceSize)
+
+    #-------------------------------------------------------
+    def _tilesDecodedHandler(self, requestId, key, tiles, decodeTime):
+        '''Called in GUI thread when a worker has decoded tiles'''
+        self.decodeCount += 1
+        self.decodeTime += decodeTime
+        request = self.requests.get(key)
+        if not request or request[0] != requestId:
+            return
+        del self.requests[key]
+        for tileKey, image in tiles:
+            pixmapCache.insert(tileKey, QPixmap.fromImage(image))
+        for callback in self._liveCallbacks(request[2]):
+            callback(request[1], key, bool(tiles))
+
+    #-------------------------------------------------------
+    def _saliencyComputedHandler(self, requestId, key, maps, duration):
+        '''Called in GUI thread when a worker has computed saliency maps'''
+        self.saliencyCount += 1
+        self.saliencyTime += duration
+        request = self.requests.get(key)
+        if not request or request[0] != requestId:
+            return
+        del self.requests[key]
+        saliencyMaps.update(maps)
+        for callback in self._liveCallbacks(request[2]):
+            callback(request[1])
+
+    #-------------------------------------------------------
+    @staticmethod
+    def _liveCallbacks(callbacks):
+        '''Return callbacks whose Qt object, if any, hasn't been deleted'''
+        live = []
+        for callback in callbacks:
+            owner = getattr(callback, '__self__', None)
+            if isinstance(owner, sip.simplewrapper) and sip.isdeleted(owner):
+                continue
+            live.append(callback)
+        return live
+
+
+imageLoader = ImageLoader()
+
+
+#-------------------------------------------------------------------------------
+class MemoryManager:
+    '''
+    Keep memory used by the pixmaps of the photos and of the pixmap cache under a
+    ceiling. When it is exceeded, cached pixmaps not displayed are dropped first, then
+    photos are downgraded to a low resolution copy: parked ones, then the ones that
+    can't be seen, then the least recently interacted with. Downgraded photos get
+    their resolution back on demand (relayout, zoom, export).
+    '''
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.downgrades = 0
+        self._photos = weakref.WeakSet()
+
+    #-------------------------------------------------------
+    def register(self, photo):
+        '''Track memory used by photo'''
+        self._photos.add(photo)
+
+    #-------------------------------------------------------
+    def photos(self):
+        '''Return list of tracked photos still alive'''
+        return [photo for photo in self._photos if not sip.isdeleted(photo)]
+
+    #-------------------------------------------------------
+    def setMaxBytes(self, maxBytes):
+        '''Set memory ceiling'''
+        self.maxBytes = maxBytes
+        self.check()
+
+    #-------------------------------------------------------
+    def usage(self):
+        '''
+        Return bytes used by pixmaps of the photos and of the cache. Shared pixmaps count
+        once.
+        '''
+        pixmaps = {}
+        for photo in self.photos():
+            pixmap = photo.pixmap()
+            pixmaps[pixmap.cacheKey()] = pixmap
+        for pixmap in pixmapCache.values():
+            pixmaps[pixmap.cacheKey()] = pixmap
+        return sum(PixmapCache.pixmapBytes(pixmap) for pixmap in pixmaps.values())
+
+    #-------------------------------------------------------
+    def check(self, keep=None):
+        '''Free pixmaps until memory usage is under the ceiling. Photo keep is never downgraded.'''
+        used = self.usage()
+        if used <= self.maxBytes:
+            return
+        photos = self.photos()
+        # Number of photos displaying each pixmap
+        holders = {}
+        for photo in photos:
+            cacheKey = photo.pixmap().cacheKey()
+            holders[cacheKey] = holders.get(cacheKey, 0) + 1
+        # Cache keys of each pixmap
+        cached = {}
+        for key, pixmap in pixmapCache.entries():
+            if used <= self.maxBytes:
+                return
+            if pixmap.cacheKey() in holders:
+                cached.setdefault(pixmap.cacheKey(), []).append(key)
+            else:
+                # Not displayed: only the cache holds it
+                pixmapCache.remove(key)
+                used -= PixmapCache.pixmapBytes(pixmap)
+        visibleRects = self._visibleRects(photos)
+        candidates = [photo for photo in photos if photo is not keep and photo.canDowngrade()]
+        candidates.sort(key=lambda photo: (self._visibility(photo, visibleRects),
+                                           photo.lastInteraction))
+        for photo in candidates:
+            if used <= self.maxBytes:
+                break
+            pixmap = photo.pixmap()
+            cacheKey = pixmap.cacheKey()
+            lowRes = photo.downgrade()
+            self.downgrades += 1
+            used += PixmapCache.pixmapBytes(lowRes)
+            holders[cacheKey] -= 1
+            if holders[cacheKey] == 0:
+                for key in cached.pop(cacheKey, []):
+                    pixmapCache.remove(key)
+                used -= PixmapCache.pixmapBytes(pixmap)
+        logger.debug('%s', self)
+
+    #-------------------------------------------------------
+    @staticmethod
+    def _visibleRects(photos):
+        '''Return list of scene rectangles shown by the views of the scenes of the photos'''
+        scenes = set(photo.scene() for photo in photos if photo.scene() is not None)
+        return [view.mapToScene(view.viewport().rect()).boundingRect()
+                for scene in scenes for view in scene.views()]
+
+    #-------------------------------------------------------
+    @staticmethod
+    def _visibility(photo, visibleRects):
+        '''Return 0 if photo is parked, 1 if it can't be seen, 2 if it is visible'''
+        scene = photo.scene()
+        if scene is None:
+            return 0
+        frame = photo.parentItem()
+        rect = (frame or photo).sceneBoundingRect()
+        if not any(rect.intersects(visibleRect) for visibleRect in visibleRects):
+            return 1
+        for item in scene.items(rect):
+            if getattr(item, 'Overlay', False) and item.isVisible() and \
+               item.sceneBoundingRect().contains(rect):
+                # Hidden behind help
+                return 1
+        return 2
+
+    #-------------------------------------------------------
+    def __str__(self):
+        return 'MemoryManager: %.1f/%.1f MB, %d downgrades' % \
+            (self.usage() / OneMB, self.maxBytes / OneMB, self.downgrades)
+
+
+memoryManager = MemoryManager(PixmapMemoryBudget)
+
+
 #-------------------------------------------------------------------------------
 class PhotoFrameItem(QGraphicsItem):
     '''The frame around a photo'''
@@ -76,9 +1376,11 @@ class PhotoFrameItem(QGraphicsItem):
         self.rect = rect
         self.photo = None
         # Set flags
+        # Borders are painted by the FrameOverlayItem of the scene
         self.setFlags(self.flags() |
                       QGraphicsItem.ItemClipsChildrenToShape |
-                      QGraphicsItem.ItemIsFocusable)
+                      QGraphicsItem.ItemIsFocusable |
+                      QGraphicsItem.ItemHasNoContents)
         self.setAcceptDrops(True)
         self.setAcceptHoverEvents(True)
 
@@ -92,11 +1394,32 @@ class PhotoFrameItem(QGraphicsItem):
             self.fitPhoto()
         self.update()
 
+    #-------------------------------------------------------
+    def swapPhotos(self, frame):
+        '''Swap photos of this frame and of frame, keeping their transformations'''
+        photo = frame.photo
+        frame.setPhoto(self.photo, reset=False)
+        self.setPhoto(photo, reset=False)
+
+    #-------------------------------------------------------
+    def setRect(self, rect):
+        '''Move and resize frame to rect, in scene coordinates'''
+        self.prepareGeometryChange()
+        self.rect = QRect(0, 0, rect.width(), rect.height())
+        self.setPos(rect.x(), rect.y())
+
+    #-------------------------------------------------------
+    def center(self):
+        '''Return center of the frame, in frame coordinates'''
+        return QPointF(self.rect.width() / 2, self.rect.height() / 2)
+
     #-------------------------------------------------------
     def fitPhoto(self, fillAllFrame=True):
         '''Fit photo to frame'''
-        photoWidth = self.photo.pixmap().width()
-        photoHeight = self.photo.pixmap().height()
+        photoWidth = self.photo.sourceSize.width()
+        photoHeight = self.photo.sourceSize.height()
+        if self.photo.rotation() % 180 == 90:
+            photoWidth, photoHeight = photoHeight, photoWidth
         frameWidth = self.rect.width()
         frameHeight = self.rect.height()
         widthRatio = 0
@@ -118,6 +1441,42 @@ class PhotoFrameItem(QGraphicsItem):
                 self.photo.setScale(frameWidth / photoWidth)
             elif heightRatio > 1:
                 self.photo.setScale(frameHeight / photoHeight)
+        if fillAllFrame and SmartFit:
+            self.cropPhoto()
+
+    #-------------------------------------------------------
+    def cropPhoto(self):
+        '''
+        Move photo fit to the frame so that its salient region is inside the frame, zooming
+        out if needed, down to the scale fitting both dimensions. Nothing is done until the
+        saliency map of the photo has been computed (see CollageScene.loadSaliency()).
+        '''
+        photo = self.photo
+        if photo.placeholder or photo.rotation() % 90:
+            return
+        saliency = saliencyMaps.get(PixmapCache.key(photo.filename))
+        if saliency is None:
+            return
+        # Saliency and size of the photo as displayed
+        turns = int(photo.rotation() // 90) % 4
+        saliency = np.rot90(saliency, -turns)
+        photoWidth = photo.sourceSize.width()
+        photoHeight = photo.sourceSize.height()
+        if turns % 2:
+            photoWidth, photoHeight = photoHeight, photoWidth
+        frameWidth = self.rect.width()
+        frameHeight = self.rect.height()
+        left, top, right, bottom = salientRegion(saliency)
+        scale = photo.scale()
+        minScale = min(scale, frameWidth / photoWidth, frameHeight / photoHeight)
+        scale = max(minScale, min(scale, frameWidth / ((right - left) * photoWidth),
+                                  frameHeight / ((bottom - top) * photoHeight)))
+        x, y = salientWindow(saliency, frameWidth / (scale * photoWidth),
+                             frameHeight / (scale * photoHeight))
+        photo.setScale(scale)
+        # Photo is scaled and rotated around its center
+        photo.setPos((0.5 - x) * photoWidth * scale - photo.sourceSize.width() / 2,
+                     (0.5 - y) * photoHeight * scale - photo.sourceSize.height() / 2)
 
     #-------------------------------------------------------
     def boundingRect(self):
@@ -126,16 +1485,7 @@ class PhotoFrameItem(QGraphicsItem):
 
     #-------------------------------------------------------
     def paint(self, painter, option, widget=None):
-        '''Paint widget'''
-        pen = painter.pen()
-        pen.setColor(FrameColor)
-        #pen.setWidth(FrameWidth)
-        pen.setWidth(FrameRadius)
-        painter.setPen(pen)
-        painter.setRenderHint(QPainter.Antialiasing)
-        painter.drawRoundedRect(self.rect.left(), self.rect.top(),
-                                self.rect.width(), self.rect.height(),
-                                FrameRadius, FrameRadius)
+        '''Nothing to paint, see FrameOverlayItem'''
 
     #-------------------------------------------------------
     def hoverEnterEvent(self, event):
@@ -151,27 +1501,28 @@ class PhotoFrameItem(QGraphicsItem):
     #-------------------------------------------------------
     def keyReleaseEvent(self, event):
         '''Handle key release event'''
-        logger.debug(str(event.key()))
+        logger.debug('Key event: %d', event.key())
+        self.photo.touch()
+        self.photo.endInteraction()
+        oldState = UndoHistory.photoState(self.photo)
         modifiers = event.modifiers()
         if event.key() == Qt.Key_Slash:
             # Reset photo pos, scale and rotation
             self.photo.reset()
-        elif event.key() == Qt.Key_F:
+        elif event.key() == Qt.Key_F and modifiers in (Qt.NoModifier, Qt.ShiftModifier):
             # Fit photo into frame
-            if modifiers == Qt.NoModifier:
-                self.photo.reset()
-                self.fitPhoto()
-            elif modifiers == Qt.ShiftModifier:
-                self.photo.reset()
-                self.fitPhoto(False)
-        elif event.key() == Qt.Key_R:
+            self.photo.reset()
+            self.fitPhoto(modifiers == Qt.NoModifier)
+        elif event.key() == Qt.Key_R and modifiers in (Qt.NoModifier, Qt.ShiftModifier):
             # Rotate by 90 degrees
-            if modifiers == Qt.NoModifier:
-                rotInc = 1
-            elif modifiers == Qt.ShiftModifier:
-                rotInc = -1
+            rotInc = 1 if modifiers == Qt.NoModifier else -1
             rot = ((self.photo.rotation() // 90) + rotInc) * 90
             self.photo.setRotation(rot)
+            self.photo.userTransformed = True
+        else:
+            # Other keys don't transform the photo
+            return
+        self.photo.recordTransform(oldState)
 
     #-------------------------------------------------------
     def mouseDoubleClickEvent(self, event):
@@ -200,14 +1551,12 @@ class PhotoFrameItem(QGraphicsItem):
     def dropEvent(self, event):
         '''Handle mouse drop event'''
         mimeData = event.mimeData()
-        logger.debug('dropEvent: mimeData=%s', str(mimeData.urls()))
-        logger.debug('dropEvent: dict=%s pos=%s', dir(event), str(event.scenePos()))
+        logger.debug('dropEvent: mimeData=%s pos=%s', mimeData.urls(), event.scenePos())
         if event.proposedAction() == Qt.CopyAction and mimeData.hasUrls():
             # New photo
             filePath = mimeData.urls()[0].toLocalFile()
             logger.debug("File dragged'n'dropped: %s", filePath)
             self.photo.setPhoto(filePath)
-            self.fitPhoto()
         elif event.proposedAction() == Qt.MoveAction and mimeData.hasText():
             # Swap photos
             # Get source PhotoFrameItem and swap its photo
@@ -217,23 +1566,105 @@ class PhotoFrameItem(QGraphicsItem):
                 items = self.scene().items(QPointF(sourcePos['pos']['x'], sourcePos['pos']['y']))
                 if items:
                     for srcItem in items:
-                        if isinstance(srcItem, PhotoFrameItem):
-                            photoItem = srcItem.photo
-                            srcItem.setPhoto(self.photo, reset=False)
-                            self.setPhoto(photoItem, reset=False)
+                        if isinstance(srcItem, PhotoFrameItem) and srcItem is not self:
+                            self.swapPhotos(srcItem)
+                            self.scene().history.recordSwap(srcItem, self)
             except Exception:
                 logger.debug('dropEvent: not a "photo swap" event: %s', mimeData.text())
 
 
+#-------------------------------------------------------------------------------
+def paintFrameBorders(painter, rects, radius, color):
+    '''Paint rounded borders of the frames of rects (scene coordinates)'''
+    if radius <= 0:
+        return
+    pen = QPen(QColor(color))
+    pen.setWidth(radius)
+    painter.setPen(pen)
+    painter.setBrush(Qt.NoBrush)
+    painter.setRenderHint(QPainter.Antialiasing)
+    for rect in rects:
+        painter.drawRoundedRect(rect, radius, radius)
+
+
+#-------------------------------------------------------------------------------
+class FrameOverlayItem(QGraphicsItem):
+    '''
+    Borders of all the photo frames of the scene, painted in a single cached layer above
+    the photos. Changing frame radius or color only repaints this layer, the photos
+    being redrawn from their own cache.
+    '''
+
+    def __init__(self, parent=None):
+        super(FrameOverlayItem, self).__init__(parent)
+        self.setZValue(1)
+        self.setAcceptedMouseButtons(Qt.NoButton)
+        self.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+
+    #-------------------------------------------------------
+    def invalidate(self):
+        '''Repaint borders after frames, frame radius or frame color changed'''
+        self.prepareGeometryChange()
+        self.update()
+
+    #-------------------------------------------------------
+    def boundingRect(self):
+        '''Return bounding rectangle: scene rect, plus the outer half of the borders'''
+        if self.scene() is None:
+            return QRectF()
+        margin = MaxFrameRadius / 2
+        return self.scene().sceneRect().adjusted(-margin, -margin, margin, margin)
+
+    #-------------------------------------------------------
+    def paint(self, painter, option, widget=None):
+        '''Paint borders of the frames'''
+        paintFrameBorders(painter, [frame.sceneBoundingRect() for frame in self.scene().frames],
+                          FrameRadius, FrameColor)
+
+
 #-------------------------------------------------------------------------------
 class PhotoItem(QGraphicsPixmapItem):
-    '''A photo item'''
+    '''
+    A photo item. Its geometry is expressed in original image coordinates, whatever the
+    resolution of the pixmap actually loaded (placeholder, proxy or full resolution).
+    '''
 
     #-------------------------------------------------------
     def __init__(self, filename):
         self.filename = filename
-        super(PhotoItem, self).__init__(QPixmap(self.filename), parent=None)
+        self.pendingFilename = None
+        # Rotation applied on reset, from the EXIF orientation
+        self.baseRotation = 0
+        # Set when the photo has been moved, zoomed or rotated by the user
+        self.userTransformed = False
+        # Offset of the photo position from the center of its last frame
+        self.centerOffset = QPointF()
+        # Display placeholder until the photo is decoded
+        self.placeholder = True
+        # Set when the pixmap has been replaced by a low resolution copy to save memory
+        self.downgraded = False
+        # Tiles of large photos being decoded: request key -> list of (level, column, row)
+        self.tileRequests = {}
+        self.tileFileKey = None
+        # Set if tiles can't be decoded: the full resolution pixmap is loaded instead
+        self.tileError = False
+        self.lastInteraction = time.monotonic()
+        # Scale and rotation of wheel steps not applied yet
+        self.wheelTarget = None
+        self.wheelTimer = QTimer()
+        self.wheelTimer.setSingleShot(True)
+        self.wheelTimer.timeout.connect(self.applyWheel)
+        # Fast rendering while the photo is interactively transformed
+        self.interacting = False
+        self.idleTimer = QTimer()
+        self.idleTimer.setSingleShot(True)
+        self.idleTimer.timeout.connect(self.endInteraction)
+        pixmap = pixmapCache.get(DefaultPhotoPath)
+        self.sourceSize = pixmap.size()
+        super(PhotoItem, self).__init__(pixmap, parent=None)
         self.dragStartPosition = None
+        # State before the photo is dragged, for the undo history
+        self.pressState = None
         self.reset()
         # Use bilinear filtering
         self.setTransformationMode(Qt.SmoothTransformation)
@@ -241,35 +1672,401 @@ class PhotoItem(QGraphicsPixmapItem):
         self.setFlags(self.flags() |
                       QGraphicsItem.ItemIsMovable |
                       QGraphicsItem.ItemStacksBehindParent)
+        # Only resample pixmap when the transformation of the photo changes
+        self.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+        memoryManager.register(self)
+
+    #-------------------------------------------------------
+    def load(self):
+        '''Load pixmap of the current photo'''
+        self.setPhoto(self.filename)
 
     #-------------------------------------------------------
     def setPhoto(self, filename):
-        pixmap = QPixmap(filename)
-        if pixmap.width() > 0:
-            logger.debug('SetPhoto(): %d %d', pixmap.width(), pixmap.height())
-            self.filename = filename
+        '''Load a new photo. The current one is kept until the new one is decoded.'''
+        if not filename:
+            return
+        self.touch()
+        self.pendingFilename = filename
+        imageLoader.load(filename, self.photoLoaded, self.proxySize(imageRotation(filename)))
+        if self.pendingFilename == filename and (filename != self.filename or self.placeholder):
+            # Not in cache: display a thumbnail while the photo is decoded
+            if not self.showStoredThumbnail(filename):
+                self.showExifThumbnail(filename)
+
+    #-------------------------------------------------------
+    def showStoredThumbnail(self, filename):
+        '''Display thumbnail of the thumbnail store, if any. Return True if found.'''
+        frameSize = None
+        if self.parentItem():
+            frameSize = self.parentItem().boundingRect().size().toSize()
+            if imageRotation(filename) % 180 == 90:
+                frameSize.transpose()
+        thumbnail = thumbnailStore.find(filename, PixmapCache.key(filename), frameSize,
+                                        fallback=True)
+        if thumbnail is None:
+            return False
+        logger.debug('showStoredThumbnail(): %s', filename)
+        self.filename = filename
+        self.setThumbnail(QPixmap.fromImage(thumbnail[0]), thumbnail[1])
+        if self.parentItem():
+            self.parentItem().fitPhoto()
+        return True
+
+    #-------------------------------------------------------
+    def showExifThumbnail(self, filename):
+        '''Display thumbnail embedded in the EXIF data of the file, if any'''
+        data = readExif(filename)[1]
+        if not data:
+            return
+        thumbnail = QPixmap()
+        sourceSize = imageSize(filename)
+        if not thumbnail.loadFromData(data, 'JPG') or sourceSize.isEmpty():
+            return
+        logger.debug('showExifThumbnail(): %s', filename)
+        self.filename = filename
+        self.setThumbnail(thumbnail, sourceSize)
+        if self.parentItem():
+            self.parentItem().fitPhoto()
+
+    #-------------------------------------------------------
+    def proxySize(self, rotation=None):
+        '''
+        Return size the proxy pixmap must cover, or None to load full resolution.
+        rotation defaults to the current rotation of the photo.
+        '''
+        if not ProxyMode or self.parentItem() is None:
+            return None
+        frameRect = self.parentItem().boundingRect()
+        size = QSize(int(frameRect.width() * MaxZoom + 0.5),
+                     int(frameRect.height() * MaxZoom + 0.5))
+        if rotation is None:
+            rotation = self.rotation()
+        if rotation % 180 == 90:
+            # Express frame size in image coordinates
+            size.transpose()
+        return size
+
+    #-------------------------------------------------------
+    def updateProxy(self):
+        '''Load a bigger proxy if the current one is too small for the frame'''
+        maxSize = self.proxySize()
+        if self.placeholder or self.isFullResolution():
+            return
+        ratio = 1.0
+        if maxSize:
+            ratio = min(1.0, max(maxSize.width() / self.sourceSize.width(),
+                                 maxSize.height() / self.sourceSize.height()))
+        if self.pixmap().width() < int(self.sourceSize.width() * ratio):
+            self.pendingFilename = self.filename
+            imageLoader.load(self.filename, self.photoLoaded, maxSize)
+
+    #-------------------------------------------------------
+    def touch(self):
+        '''Record an interaction with the photo'''
+        self.lastInteraction = time.monotonic()
+
+    #-------------------------------------------------------
+    def beginInteraction(self):
+        '''
+        Switch to fast rendering while the photo is dragged, zoomed or rotated.
+        High quality rendering is restored when input stops.
+        '''
+        if not self.interacting:
+            self.interacting = True
+            self.setTransformationMode(Qt.FastTransformation)
+            # The device cache would be regenerated on each step
+            self.setCacheMode(QGraphicsItem.NoCache)
+        self.idleTimer.start(InteractionIdleDelay)
+
+    #-------------------------------------------------------
+    def endInteraction(self):
+        '''Apply pending transformation and render photo in high quality'''
+        if sip.isdeleted(self):
+            return
+        self.idleTimer.stop()
+        self.applyWheel()
+        if not self.interacting:
+            return
+        self.interacting = False
+        self.setTransformationMode(Qt.SmoothTransformation)
+        self.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+        self.ensureResolution()
+
+    #-------------------------------------------------------
+    def applyWheel(self):
+        '''Apply wheel steps accumulated since the last update'''
+        if sip.isdeleted(self) or self.wheelTarget is None:
+            return
+        self.wheelTimer.stop()
+        scale, rot = self.wheelTarget
+        self.wheelTarget = None
+        oldState = UndoHistory.photoState(self)
+        self.setScale(scale)
+        self.setRotation(rot)
+        self.userTransformed = True
+        # Successive wheel steps are merged in one history entry
+        self.recordTransform(oldState)
+
+    #-------------------------------------------------------
+    def recordTransform(self, oldState):
+        '''Record transformation of the photo from oldState in the undo history'''
+        scene = self.scene()
+        if scene is not None:
+            scene.history.recordTransform(self, oldState)
+
+    #-------------------------------------------------------
+    def canDowngrade(self):
+        '''Return True if pixmap can be replaced by a low resolution copy'''
+        return not (self.placeholder or self.downgraded or self.pendingFilename) and \
+            self.pixmap().width() > LowResSize and self.pixmap().height() > LowResSize
+
+    #-------------------------------------------------------
+    def downgrade(self):
+        '''Replace pixmap by a low resolution copy. Return the copy.'''
+        logger.debug('downgrade(): %s', self.filename)
+        pixmap = self.pixmap().scaled(LowResSize, LowResSize, Qt.KeepAspectRatioByExpanding,
+                                      Qt.SmoothTransformation)
+        super(PhotoItem, self).setPixmap(pixmap)
+        self.downgraded = True
+        return pixmap
+
+    #-------------------------------------------------------
+    def isFullResolution(self):
+        '''Return True if the pixmap has the resolution of the original image'''
+        return self.pixmap().width() >= self.sourceSize.width()
+
+    #-------------------------------------------------------
+    def isTiled(self):
+        '''Return True if the details of the photo are displayed from tiles (large photos)'''
+        return ProxyMode and not self.placeholder and not self.tileError and \
+            self.sourceSize.width() * self.sourceSize.height() >= TiledMinPixels
+
+    #-------------------------------------------------------
+    def ensureResolution(self):
+        '''Load full resolution pixmap if the proxy is too small for the current scale'''
+        if self.placeholder or self.pendingFilename or self.isFullResolution():
+            return
+        if self.downgraded:
+            # Restore the proxy first
+            self.updateProxy()
+            return
+        if self.isTiled():
+            # Tiles are requested when painted
+            return
+        if self.scale() * self.sourceSize.width() > self.pixmap().width():
+            self.pendingFilename = self.filename
+            imageLoader.load(self.filename, self.photoLoaded)
+
+    #-------------------------------------------------------
+    def photoLoaded(self, filename, pixmap, sourceSize):
+        '''Called when the pixmap of the photo has been loaded'''
+        if filename != self.pendingFilename:
+            # Another photo has been requested in the meantime
+            return
+        self.pendingFilename = None
+        if pixmap.isNull():
+            logger.warning('Failed to load image: %s', filename)
+            return
+        self.downgraded = False
+        logger.debug('photoLoaded(): %s %d %d', filename, pixmap.width(), pixmap.height())
+        if filename == self.filename and not self.placeholder and sourceSize == self.sourceSize:
+            # Same photo at another resolution: keep position, scale and rotation
             super(PhotoItem, self).setPixmap(pixmap)
-            self.reset()
+            memoryManager.check(self)
+            return
+        self.filename = filename
+        self.placeholder = False
+        self.baseRotation = imageRotation(filename)
+        self.cancelTiles()
+        self.prepareGeometryChange()
+        self.sourceSize = sourceSize
+        self.setPixmap(pixmap)
+        if self.parentItem():
+            self.parentItem().fitPhoto()
+        if SmartFit and self.scene() is not None:
+            self.scene().requestSaliency()
+        memoryManager.check(self)
 
     #-------------------------------------------------------
     def setPixmap(self, pixmap):
         super(PhotoItem, self).setPixmap(pixmap)
         self.reset()
 
+    #-------------------------------------------------------
+    def setThumbnail(self, pixmap, sourceSize):
+        '''Display thumbnail until the photo is loaded'''
+        self.placeholder = False
+        self.baseRotation = imageRotation(self.filename)
+        self.prepareGeometryChange()
+        self.sourceSize = QSize(sourceSize)
+        self.setPixmap(pixmap)
+
+    #-------------------------------------------------------
+    def state(self):
+        '''Return position, scale and rotation of the photo'''
+        self.applyWheel()
+        return {'pos': [self.pos().x(), self.pos().y()],
+                'scale': self.scale(),
+                'rotation': self.rotation(),
+                'userTransformed': self.userTransformed}
+
+    #-------------------------------------------------------
+    def setState(self, state):
+        '''Restore position, scale and rotation returned by state()'''
+        self.setPos(*state['pos'])
+        self.setScale(state['scale'])
+        self.setRotation(state['rotation'])
+        self.userTransformed = state.get('userTransformed', True)
+
+    #-------------------------------------------------------
+    def boundingRect(self):
+        '''Return bounding rectangle, in original image coordinates'''
+        return QRectF(0, 0, self.sourceSize.width(), self.sourceSize.height())
+
+    #-------------------------------------------------------
+    def shape(self):
+        path = QPainterPath()
+        path.addRect(self.boundingRect())
+        return path
+
+    #-------------------------------------------------------
+    def contains(self, point):
+        return self.boundingRect().contains(point)
+
+    #-------------------------------------------------------
+    def opaqueArea(self):
+        return self.shape()
+
+    #-------------------------------------------------------
+    def paint(self, painter, option, widget=None):
+        '''Paint pixmap scaled to the original image size'''
+        pixmap = self.pixmap()
+        if pixmap.isNull():
+            return
+        painter.setRenderHint(QPainter.SmoothPixmapTransform,
+                              self.transformationMode() == Qt.SmoothTransformation)
+        painter.drawPixmap(self.boundingRect(), pixmap, QRectF(pixmap.rect()))
+        if self.isTiled():
+            self.paintTiles(painter)
+
+    #-------------------------------------------------------
+    def paintTiles(self, painter):
+        '''
+        Paint over the proxy the tiles of the visible part of the photo, at the level of
+        detail of the view. Missing tiles are requested, and painted once decoded.
+        '''
+        deviceScale = math.sqrt(abs(painter.worldTransform().determinant()))
+        if deviceScale <= self.pixmap().width() / self.sourceSize.width():
+            # Proxy is detailed enough
+            return
+        # Biggest downscale still detailed enough
+        level = max(0, int(math.floor(-math.log2(deviceScale))))
+        tileSize = TileSize << level
+        rect = self.visibleRect()
+        if rect.isEmpty():
+            return
+        if self.tileFileKey is None:
+            self.tileFileKey = PixmapCache.key(self.filename)
+            if self.tileFileKey is None:
+                return
+        columns = range(int(rect.left()) // tileSize,
+                        min(math.ceil(rect.right() / tileSize),
+                            math.ceil(self.sourceSize.width() / tileSize)))
+        rows = range(int(rect.top()) // tileSize,
+                     min(math.ceil(rect.bottom() / tileSize),
+                         math.ceil(self.sourceSize.height() / tileSize)))
+        missing = []
+        for row in rows:
+            for column in columns:
+                tile = pixmapCache.find(PixmapCache.tileKey(self.tileFileKey, level, column, row))
+                if tile is None:
+                    missing.append((level, column, row))
+                    continue
+                x, y = column * tileSize, row * tileSize
+                width = min(tile.width() << level, self.sourceSize.width() - x)
+                height = min(tile.height() << level, self.sourceSize.height() - y)
+                painter.drawPixmap(QRectF(x, y, width, height), tile, QRectF(tile.rect()))
+        if not self.interacting:
+            self.requestTiles(missing,
+                              set((level, column, row) for row in rows for column in columns))
+
+    #-------------------------------------------------------
+    def visibleRect(self):
+        '''Return part of the photo visible through its frame and the views'''
+        rect = self.boundingRect()
+        frame = self.parentItem()
+        if frame is not None:
+            rect &= self.mapRectFromItem(frame, frame.boundingRect())
+        # widget is None when painting into the device coordinate cache: clip to all views
+        views = self.scene().views() if self.scene() is not None else []
+        if views:
+            visible = QRectF()
+            for view in views:
+                visible |= view.mapToScene(view.viewport().rect()).boundingRect()
+            rect &= self.mapRectFromScene(visible)
+        return rect
+
+    #-------------------------------------------------------
+    def requestTiles(self, missing, needed):
+        '''
+        Request decoding of the missing tiles, in a single block. Requests of tiles no
+        longer needed (out of view, or other level of detail) are cancelled.
+        '''
+        pending = set()
+        for key, tiles in list(self.tileRequests.items()):
+            if needed.isdisjoint(tiles):
+                imageLoader.cancelRequest(key, self.tilesLoaded)
+                del self.tileRequests[key]
+            else:
+                pending.update(tiles)
+        missing = [tile for tile in missing if tile not in pending]
+        if not missing:
+            return
+        level = missing[0][0]
+        left, top = min(tile[1] for tile in missing), min(tile[2] for tile in missing)
+        right, bottom = max(tile[1] for tile in missing), max(tile[2] for tile in missing)
+        block = QRect(left, top, right - left + 1, bottom - top + 1)
+        key = imageLoader.loadTiles(self.filename, level, block, self.tilesLoaded)
+        if key is not None:
+            self.tileRequests[key] = [(level, column, row) for row in range(top, bottom + 1)
+                                      for column in range(left, right + 1)]
+
+    #-------------------------------------------------------
+    def cancelTiles(self):
+        '''Cancel tile requests'''
+        for key in self.tileRequests:
+            imageLoader.cancelRequest(key, self.tilesLoaded)
+        self.tileRequests = {}
+        self.tileFileKey = None
+        self.tileError = False
+
+    #-------------------------------------------------------
+    def tilesLoaded(self, filename, key, ok):
+        '''Called when tiles requested by requestTiles() have been decoded'''
+        if self.tileRequests.pop(key, None) is None or filename != self.filename:
+            return
+        if not ok:
+            logger.warning('Failed to decode tiles of %s', filename)
+            self.tileError = True
+            self.ensureResolution()
+        self.update()
+
     #-------------------------------------------------------
     def reset(self):
         # Center photo in frame
         if self.parentItem() != None:
             frameRect = self.parentItem().boundingRect()
-            self.setPos((frameRect.width() / 2) - (self.pixmap().width() / 2),
-                        (frameRect.height() / 2) - (self.pixmap().height() / 2))
-        # Set transform origin to center of pixmap
-        origx = self.pixmap().width() / 2
-        origy = self.pixmap().height() / 2
+            self.setPos((frameRect.width() / 2) - (self.sourceSize.width() / 2),
+                        (frameRect.height() / 2) - (self.sourceSize.height() / 2))
+        # Set transform origin to center of photo
+        origx = self.sourceSize.width() / 2
+        origy = self.sourceSize.height() / 2
         self.setTransformOriginPoint(origx, origy)
         # Reset transformation
         self.setScale(1.0)
-        self.setRotation(0.0)
+        self.setRotation(self.baseRotation)
+        self.userTransformed = False
 
     #-------------------------------------------------------
     def mouseDoubleClickEvent(self, event):
@@ -279,8 +2076,14 @@ class PhotoItem(QGraphicsPixmapItem):
 
     #-------------------------------------------------------
     def wheelEvent(self, event):
-        scale = self.scale()
-        rot = self.rotation()
+        self.touch()
+        if self.wheelTarget:
+            scale, rot = self.wheelTarget
+        else:
+            scale = self.scale()
+            rot = self.rotation()
+        # Unchanged unless selected by the modifiers
+        newScale, newRot = scale, rot
         if event.delta() > 0:
             logger.debug('Zoom')
             rot += RotOffset
@@ -301,23 +2104,38 @@ class PhotoItem(QGraphicsPixmapItem):
         #self.setTransformOriginPoint(event.pos())
         modifiers = event.modifiers()
         if modifiers == Qt.NoModifier:
-            self.setScale(scale)
+            newScale = scale
             logger.debug('scale=%f', scale)
         elif modifiers == Qt.ShiftModifier:
-            self.setRotation(rot)
+            newRot = rot
             logger.debug('rotation=%f', rot)
         elif modifiers == (Qt.ShiftModifier|Qt.ControlModifier):
-            self.setScale(scale)
-            self.setRotation(rot)
+            newScale, newRot = scale, rot
             logger.debug('scale=%f rotation=%f', scale, rot)
+        else:
+            return
+        # Coalesce wheel steps: transformation is applied at most once per frame
+        self.beginInteraction()
+        self.wheelTarget = (newScale, newRot)
+        if not self.wheelTimer.isActive():
+            self.wheelTimer.start(WheelUpdateInterval)
 
     #-------------------------------------------------------
     def mousePressEvent(self, event):
+        self.touch()
         if event.button() == Qt.RightButton:
             self.dragStartPosition = event.pos()
         else:
+            self.pressState = UndoHistory.photoState(self)
             super(PhotoItem, self).mousePressEvent(event)
 
+    #-------------------------------------------------------
+    def mouseReleaseEvent(self, event):
+        super(PhotoItem, self).mouseReleaseEvent(event)
+        if self.pressState is not None:
+            self.recordTransform(self.pressState)
+            self.pressState = None
+
     #-------------------------------------------------------
     def mouseMoveEvent(self, event):
         if event.buttons() & Qt.RightButton:
@@ -331,9 +2149,11 @@ class PhotoItem(QGraphicsPixmapItem):
                 mimeData.setText('{ "pos": { "x" : %f, "y" : %f }}' % (event.scenePos().x(), event.scenePos().y()))
                 drag.setMimeData(mimeData)
                 dropAction = drag.exec_(Qt.MoveAction)
-                logger.debug('dropAction=%s', str(dropAction))
+                logger.debug('dropAction=%s', dropAction)
         else:
+            self.beginInteraction()
             super(PhotoItem, self).mouseMoveEvent(event)
+            self.userTransformed = True
 
 
 #-------------------------------------------------------------------------------
@@ -385,29 +2205,93 @@ class AspectRatioWidget(QWidget):
 class ImageView(QGraphicsView):
     '''GraphicsView containing the scene'''
 
+    # Emitted after the view has been painted for the first time
+    firstPainted = pyqtSignal()
+
     #-------------------------------------------------------
     def __init__(self, parent=None):
         super(ImageView, self).__init__(parent)
+        self.painted = False
         self.setRenderHints(QPainter.Antialiasing | QPainter.SmoothPixmapTransform)
         # Hide scrollbars
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.helpItem = None
+        # Performance statistics, only collected while they are displayed
+        self.statsItem = None
+        self.statsTimer = QTimer(self)
+        self.statsTimer.timeout.connect(self.updateStats)
+        self.paintTimes = []
+        self.lastStatsUpdate = 0.0
+
+    #-------------------------------------------------------
+    @traced('paint')
+    def paintEvent(self, event):
+        '''Paint view, measuring paint time when statistics are displayed'''
+        if not self.statsTimer.isActive():
+            super(ImageView, self).paintEvent(event)
+            if not self.painted:
+                self.painted = True
+                self.firstPainted.emit()
+            return
+        start = time.perf_counter()
+        super(ImageView, self).paintEvent(event)
+        self.paintTimes.append(time.perf_counter() - start)
+
+    #-------------------------------------------------------
+    def toggleStats(self):
+        '''Show or hide performance statistics'''
+        if self.statsItem is None or sip.isdeleted(self.statsItem):
+            self.statsItem = StatsItem(QPoint(int(CollageSize.width()) - 650, 50))
+            self.statsItem.setVisible(False)
+            self.scene().addItem(self.statsItem)
+        if self.statsItem.isVisible():
+            self.statsItem.setVisible(False)
+            self.statsTimer.stop()
+        else:
+            self.paintTimes = []
+            self.lastStatsUpdate = time.perf_counter()
+            self.statsItem.setVisible(True)
+            self.statsTimer.start(StatsUpdateInterval)
+            self.updateStats()
 
     #-------------------------------------------------------
-    def save(self, filename):
-        '''Save scene to image file'''
-        self.scene().clearSelection()
-        image = QImage(CollageSize.width(), CollageSize.height(), QImage.Format_RGB32)
-        image.fill(Qt.black)
-        painter = QPainter(image)
-        painter.setRenderHints(QPainter.Antialiasing | QPainter.SmoothPixmapTransform)
-        self.render(painter)
-        image.save(OutFileName)
-        # Explicitely delete painter to avoid the following error:
-        # "QPaintDevice: Cannot destroy paint device that is being painted" + SIGSEV
-        del painter
-        logger.info("Collage saved to file: %s", OutFileName)
+    def updateStats(self):
+        '''Update displayed performance statistics'''
+        if sip.isdeleted(self.statsItem):
+            # Scene has been cleared
+            self.statsTimer.stop()
+            return
+        now = time.perf_counter()
+        elapsed = now - self.lastStatsUpdate
+        self.lastStatsUpdate = now
+        paintTimes = self.paintTimes
+        self.paintTimes = []
+        items = self.scene().items()
+        photos = [item for item in items if isinstance(item, PhotoItem)]
+        loader = imageLoader
+        lines = [
+            ('Paint', '%.1f ms avg, %.1f ms max' %
+             (1000 * sum(paintTimes) / max(1, len(paintTimes)),
+              1000 * max(paintTimes, default=0))),
+            ('Repaints', '%.1f /s' % (len(paintTimes) / elapsed if elapsed > 0 else 0)),
+            ('Decodes', '%d pending, %d done, %.1f ms avg' %
+             (loader.pendingCount(), loader.decodeCount,
+              1000 * loader.decodeTime / max(1, loader.decodeCount))),
+            ('Pixmaps', '%.1f / %.1f MB, %d downgrades' %
+             (memoryManager.usage() / OneMB, memoryManager.maxBytes / OneMB,
+              memoryManager.downgrades)),
+            ('Cache', '%.1f MB, %d hits, %d misses' %
+             (pixmapCache.currentBytes / OneMB, pixmapCache.hits, pixmapCache.misses)),
+            ('Items', '%d, %d frames, %d photos, %d parked' %
+             (len(items), len(getattr(self.scene(), 'frames', [])), len(photos),
+              len(getattr(self.scene(), 'photoPool', [])))),
+        ]
+        if SmartFit:
+            lines.insert(3, ('Saliency', '%d batches, %.1f ms avg' %
+                             (loader.saliencyCount,
+                              1000 * loader.saliencyTime / max(1, loader.saliencyCount))))
+        self.statsItem.setLines(lines)
 
     #-------------------------------------------------------
     def keyReleaseEvent(self, event):
@@ -421,12 +2305,12 @@ class ImageView(QGraphicsView):
         if key == Qt.Key_Plus:
             # Increase frame width
             FrameRadius = min(MaxFrameRadius, FrameRadius + 1)
-            self.viewport().update()
+            self.scene().updateFrames()
 
         elif key == Qt.Key_Minus:
             # Decrease frame width
             FrameRadius = max(0, FrameRadius - 1)
-            self.viewport().update()
+            self.scene().updateFrames()
 
         elif key == Qt.Key_D:
             # Switch dark theme
@@ -440,6 +2324,10 @@ class ImageView(QGraphicsView):
                 self.helpItem = HelpItem(QPoint(50, 50))
                 self.scene().addItem(self.helpItem)
 
+        elif key == Qt.Key_P:
+            # Show performance statistics
+            self.toggleStats()
+
         elif key == Qt.Key_S:
             # Save collage to output file
             saveas = False
@@ -447,8 +2335,20 @@ class ImageView(QGraphicsView):
                 modifiers == Qt.ShiftModifier:
                 saveas = True
             elif modifiers == Qt.ControlModifier:
+                app.saveProject()
                 return
             app.saveCollage(saveas)
+
+        elif key == Qt.Key_O and modifiers == Qt.ControlModifier:
+            # Open project file
+            app.openProject()
+
+        elif key == Qt.Key_Z and modifiers == Qt.ControlModifier:
+            self.scene().history.undo()
+
+        elif (key == Qt.Key_Z and modifiers == (Qt.ControlModifier|Qt.ShiftModifier)) or \
+             (key == Qt.Key_Y and modifiers == Qt.ControlModifier):
+            self.scene().history.redo()
         else:
             # Pass event to default handler
             super(ImageView, self).keyReleaseEvent(event)
@@ -458,116 +2358,1390 @@ class ImageView(QGraphicsView):
         logger.debug('heightForWidth(%d)', w)
         return w
 
-    #-------------------------------------------------------
-    def resizeEvent(self, event):
-        self.fitInView(CollageSize, Qt.KeepAspectRatio)
+    #-------------------------------------------------------
+    def resizeEvent(self, event):
+        self.fitInView(CollageSize, Qt.KeepAspectRatio)
+
+    #-------------------------------------------------------
+    def wheelEvent(self, event):
+        # Filter wheel events
+        items = self.items(event.pos())
+        logger.debug('Wheel event: %s', items)
+        if items:
+            for item in items:
+                if isinstance(item, PhotoItem):
+                    super(ImageView, self).wheelEvent(event)
+
+
+#-------------------------------------------------------------------------------
+class HelpItem(QGraphicsItem):
+    '''Online help'''
+
+    # Overlay items are hidden when the collage is exported
+    Overlay = True
+
+    #-------------------------------------------------------
+    def __init__(self, point, parent=None):
+        super(HelpItem, self).__init__(parent)
+        lines = len(HelpCommands) + 3
+        self.rect = QRect(point.x(), point.y(), 700, lines * 32)
+        # Above frame borders
+        self.setZValue(2)
+
+    #-------------------------------------------------------
+    def boundingRect(self):
+        return QRectF(self.rect)
+
+    #-------------------------------------------------------
+    def paint(self, painter, option, widget=None):
+        painter.setRenderHint(QPainter.Antialiasing)
+
+        pen = painter.pen()
+        pen.setColor(QColor(128, 128, 128, 200))
+        pen.setWidth(3)
+        painter.setPen(pen)
+        brush = painter.brush()
+        brush.setColor(QColor(0, 0, 0, 200))
+        brush.setStyle(Qt.SolidPattern)
+        painter.setBrush(brush)
+
+        painter.drawRoundedRect(self.rect.left(), self.rect.top(),
+                                self.rect.width(), self.rect.height(),
+                                15, 15)
+
+        font = painter.font()
+        font.setPixelSize(32)
+        painter.setFont(font)
+        pen = painter.pen()
+        pen.setColor(QColor(255, 255, 255, 232))
+        painter.setPen(pen)
+        point = self.rect.topLeft() + QPoint(20, 40)
+        painter.drawText(point, 'Help')
+
+        font.setPixelSize(24)
+        painter.setFont(font)
+        point += QPoint(0, 16)
+        for cmd, desc in HelpCommands:
+            point += QPoint(0, 32)
+            painter.drawText(point, cmd)
+            painter.drawText(point + QPoint(200, 0), desc)
+
+
+#-------------------------------------------------------------------------------
+class StatsItem(QGraphicsItem):
+    '''Performance statistics'''
+
+    # Overlay items are hidden when the collage is exported
+    Overlay = True
+
+    #-------------------------------------------------------
+    def __init__(self, point, parent=None):
+        super(StatsItem, self).__init__(parent)
+        self.lines = []
+        self.rect = QRect(point.x(), point.y(), 600, 4 * 32)
+        # Above frame borders
+        self.setZValue(2)
+        self.setAcceptedMouseButtons(Qt.NoButton)
+
+    #-------------------------------------------------------
+    def setLines(self, lines):
+        '''Set list of (name, value) lines to display'''
+        self.lines = lines
+        self.prepareGeometryChange()
+        self.rect.setHeight(len(lines) * 32 + 44)
+        self.update()
+
+    #-------------------------------------------------------
+    def boundingRect(self):
+        return QRectF(self.rect)
+
+    #-------------------------------------------------------
+    def paint(self, painter, option, widget=None):
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(QPen(QColor(128, 128, 128, 200), 3))
+        painter.setBrush(QBrush(QColor(0, 0, 0, 200)))
+        painter.drawRoundedRect(QRectF(self.rect), 15, 15)
+
+        font = painter.font()
+        font.setPixelSize(24)
+        painter.setFont(font)
+        painter.setPen(QColor(255, 255, 255, 232))
+        point = self.rect.topLeft() + QPoint(20, 24)
+        for name, value in self.lines:
+            point += QPoint(0, 32)
+            painter.drawText(point, name)
+            painter.drawText(point + QPoint(130, 0), value)
+
+
+#-------------------------------------------------------------------------------
+class UndoHistory:
+    '''
+    Undo/redo history of the edits of a collage. Entries are small tuples, pixmaps are
+    never stored; frames are designated by their index in the layout:
+      ('transform', frame index, old state, new state)
+      ('swap', frame index, frame index)
+      ('layout', old layout, old snapshot, new layout, new snapshot)
+    A state is the (x, y, scale, rotation, userTransformed) of a photo packed in bytes,
+    a snapshot the (path, state) of the photo of each frame.
+    '''
+
+    StateFormat = struct.Struct('<4d?')
+
+    def __init__(self, scene, limit=UndoLimit):
+        self.scene = scene
+        self.undoEntries = deque(maxlen=limit)
+        self.redoEntries = []
+        self.lastPushTime = 0.0
+
+    #-------------------------------------------------------
+    @staticmethod
+    def photoState(photo):
+        '''Return state of photo'''
+        pos = photo.pos()
+        return UndoHistory.StateFormat.pack(pos.x(), pos.y(), photo.scale(), photo.rotation(),
+                                            photo.userTransformed)
+
+    #-------------------------------------------------------
+    @staticmethod
+    def setPhotoState(photo, state):
+        '''Restore state of photo returned by photoState()'''
+        x, y, scale, rotation, userTransformed = UndoHistory.StateFormat.unpack(state)
+        photo.setPos(x, y)
+        photo.setScale(scale)
+        photo.setRotation(rotation)
+        photo.userTransformed = userTransformed
+        photo.ensureResolution()
+
+    #-------------------------------------------------------
+    def snapshot(self):
+        '''Return snapshot of the photos of the frames'''
+        self.flush()
+        return tuple((frame.photo.filename, self.photoState(frame.photo))
+                     for frame in self.scene.frames)
+
+    #-------------------------------------------------------
+    def flush(self):
+        '''Record wheel steps not applied yet'''
+        for frame in self.scene.frames:
+            frame.photo.applyWheel()
+
+    #-------------------------------------------------------
+    def push(self, entry):
+        '''Add entry to history. Successive transformations of a photo are merged.'''
+        if entry[0] == 'transform' and entry[2] == entry[3]:
+            # No-op, e.g. a click on a photo: the redo history is kept
+            return
+        now = time.monotonic()
+        if entry[0] == 'transform' and self.undoEntries and \
+           now - self.lastPushTime < UndoMergeDelay:
+            last = self.undoEntries[-1]
+            if last[0] == 'transform' and last[1] == entry[1]:
+                self.undoEntries.pop()
+                entry = ('transform', entry[1], last[2], entry[3])
+        self.lastPushTime = now
+        self.redoEntries.clear()
+        if entry[0] == 'transform' and entry[2] == entry[3]:
+            # Transformations cancelling each other
+            return
+        self.undoEntries.append(entry)
+
+    #-------------------------------------------------------
+    def recordTransform(self, photo, oldState):
+        '''Record transformation of photo from oldState to its current state'''
+        index = self._frameIndex(photo.parentItem())
+        if index is not None:
+            self.push(('transform', index, oldState, self.photoState(photo)))
+
+    #-------------------------------------------------------
+    def recordSwap(self, frame1, frame2):
+        '''Record swap of the photos of two frames'''
+        index1, index2 = self._frameIndex(frame1), self._frameIndex(frame2)
+        if index1 is not None and index2 is not None:
+            self.push(('swap', index1, index2))
+
+    #-------------------------------------------------------
+    def recordLayout(self, oldLayout, oldSnapshot, layout):
+        '''Record change of layout from oldLayout, oldSnapshot being taken before the change'''
+        self.push(('layout', oldLayout, oldSnapshot, layout, self.snapshot()))
+
+    #-------------------------------------------------------
+    def _frameIndex(self, frame):
+        '''Return index of frame in layout, or None'''
+        try:
+            return self.scene.frames.index(frame)
+        except ValueError:
+            return None
+
+    #-------------------------------------------------------
+    def undo(self):
+        '''Undo last entry. Return False if there is nothing to undo.'''
+        self.flush()
+        if not self.undoEntries:
+            return False
+        entry = self.undoEntries.pop()
+        self._apply(entry, True)
+        self.redoEntries.append(entry)
+        # Don't merge next edit with the entry below
+        self.lastPushTime = 0.0
+        return True
+
+    #-------------------------------------------------------
+    def redo(self):
+        '''Redo last undone entry. Return False if there is nothing to redo.'''
+        self.flush()
+        if not self.redoEntries:
+            return False
+        entry = self.redoEntries.pop()
+        self._apply(entry, False)
+        self.undoEntries.append(entry)
+        self.lastPushTime = 0.0
+        return True
+
+    #-------------------------------------------------------
+    def _apply(self, entry, undo):
+        '''Apply entry backward (undo) or forward'''
+        frames = self.scene.frames
+        if entry[0] == 'transform':
+            if entry[1] < len(frames):
+                self.setPhotoState(frames[entry[1]].photo, entry[2] if undo else entry[3])
+        elif entry[0] == 'swap':
+            if max(entry[1], entry[2]) < len(frames):
+                frames[entry[1]].swapPhotos(frames[entry[2]])
+        elif entry[0] == 'layout':
+            layout, snapshot = (entry[1], entry[2]) if undo else (entry[3], entry[4])
+            self.scene.restoreLayout(layout, snapshot)
+
+    #-------------------------------------------------------
+    def clear(self):
+        '''Remove all entries'''
+        self.undoEntries.clear()
+        self.redoEntries.clear()
+
+    #-------------------------------------------------------
+    def __str__(self):
+        return 'UndoHistory: %d undo, %d redo entries' % \
+            (len(self.undoEntries), len(self.redoEntries))
+
+
+#-------------------------------------------------------------------------------
+class CollageScene(QGraphicsScene):
+    '''Scene containing the frames and the photos'''
+
+    # Emitted with the layout description when a layout is restored by the undo history
+    layoutRestored = pyqtSignal(str)
+
+    def __init__(self):
+        super(CollageScene, self).__init__()
+        self.history = UndoHistory(self)
+        self.bgRect = None
+        self.bgItem = None
+        self.frameOverlay = None
+        # Frames of the current layout, in layout order
+        self.frames = []
+        # Photos removed from the layout, kept for reuse by a later layout
+        self.photoPool = []
+        # Photos to load once loads are no longer deferred, or None
+        self.deferredPhotos = None
+        # Cache keys of the files whose saliency map has been requested
+        self.saliencyRequested = set()
+        # Requests of saliency maps are batched
+        self.saliencyTimer = QTimer()
+        self.saliencyTimer.setSingleShot(True)
+        self.saliencyTimer.timeout.connect(self.loadSaliency)
+        self._initBackground()
+
+    #-------------------------------------------------------
+    def addPhoto(self, rect, filepath):
+        '''Add a photo item to the scene'''
+        logger.info('Add image: %s', filepath)
+        frame = PhotoFrameItem(QRect(0, 0, rect.width(), rect.height()))
+        frame.setPos(rect.x(), rect.y())
+        photo = PhotoItem(filepath)
+        frame.setPhoto(photo)
+        # Add frame to scene
+        self.addItem(frame)
+        self.frames.append(frame)
+        self.loadPhoto(photo)
+        return frame
+
+    #-------------------------------------------------------
+    def loadPhoto(self, photo):
+        '''Load pixmap of photo, unless loads are deferred (see deferLoads())'''
+        if self.deferredPhotos is None:
+            photo.load()
+        else:
+            self.deferredPhotos.append(photo)
+
+    #-------------------------------------------------------
+    def deferLoads(self):
+        '''Defer loads of photos until loadDeferredPhotos(): frames are displayed empty'''
+        if self.deferredPhotos is None:
+            self.deferredPhotos = []
+
+    #-------------------------------------------------------
+    def loadDeferredPhotos(self):
+        '''Load photos whose loading has been deferred, and stop deferring loads'''
+        photos = self.deferredPhotos or []
+        self.deferredPhotos = None
+        for photo in photos:
+            if not sip.isdeleted(photo) and photo.scene() is self:
+                photo.load()
+        if SmartFit:
+            self.loadSaliency()
+
+    #-------------------------------------------------------
+    @traced('layout')
+    def applyLayout(self, cells):
+        '''
+        Set layout of the collage from a list of (rect, filepath) cells. Existing frames
+        are moved and resized, and existing photos are reused for the cells showing the
+        same file, keeping their position, scale and rotation if they were set by the user.
+        New photos are only created for the remaining cells. Photos left over are kept
+        in a pool for later layouts.
+        '''
+        # Available photos, by file path: photos of current frames first, then parked ones
+        available = {}
+        for frame in self.frames:
+            photo = frame.photo
+            photo.centerOffset = photo.pos() - frame.center()
+            available.setdefault(photo.filename, []).append(photo)
+        for photo in self.photoPool:
+            available.setdefault(photo.filename, []).append(photo)
+        self.photoPool = []
+        oldFrames = self.frames
+        self.frames = []
+        for i, (rect, filepath) in enumerate(cells):
+            photos = available.get(filepath)
+            if i >= len(oldFrames) and not photos:
+                self.addPhoto(rect, filepath)
+                continue
+            if i < len(oldFrames):
+                frame = oldFrames[i]
+                frame.setRect(rect)
+            else:
+                frame = PhotoFrameItem(QRect(0, 0, rect.width(), rect.height()))
+                frame.setPos(rect.x(), rect.y())
+                self.addItem(frame)
+            self.frames.append(frame)
+            if photos:
+                photo = photos.pop(0)
+                frame.setPhoto(photo, reset=False)
+                if photo.userTransformed:
+                    photo.setPos(frame.center() + photo.centerOffset)
+                else:
+                    photo.reset()
+                    frame.fitPhoto()
+                photo.updateProxy()
+            else:
+                photo = PhotoItem(filepath)
+                frame.setPhoto(photo)
+                self.loadPhoto(photo)
+        # Park photos left over, then remove extra frames
+        for photos in available.values():
+            for photo in photos:
+                if photo.scene() is self:
+                    photo.setParentItem(None)
+                    self.removeItem(photo)
+                self.photoPool.append(photo)
+        for frame in oldFrames[len(self.frames):]:
+            self.removeItem(frame)
+        self.updateFrames()
+        if SmartFit:
+            self.loadSaliency()
+
+    #-------------------------------------------------------
+    def requestSaliency(self):
+        '''Request saliency maps of the photos, from the event loop (see loadSaliency())'''
+        if not self.saliencyTimer.isActive():
+            self.saliencyTimer.start(0)
+
+    #-------------------------------------------------------
+    def loadSaliency(self):
+        '''
+        Compute saliency maps of the photos of all frames in the background, in a single
+        batch. Photos not transformed by the user are fit again once they are computed.
+        '''
+        self.saliencyTimer.stop()
+        if self.deferredPhotos is not None:
+            # Requested again by loadDeferredPhotos()
+            return
+        if not loadNumpy():
+            return
+        filenames = []
+        for frame in self.frames:
+            key = PixmapCache.key(frame.photo.filename)
+            if key is not None and key not in saliencyMaps and key not in self.saliencyRequested:
+                self.saliencyRequested.add(key)
+                filenames.append(frame.photo.filename)
+        if filenames:
+            imageLoader.loadSaliency(filenames, self.saliencyLoaded)
+
+    #-------------------------------------------------------
+    def saliencyLoaded(self, filenames):
+        '''Called when the saliency maps of filenames have been computed'''
+        filenames = set(filenames)
+        self.fitPhotos([frame for frame in self.frames if frame.photo.filename in filenames])
+
+    #-------------------------------------------------------
+    def fitPhotos(self, frames=None):
+        '''Fit photos of frames (default: all) to their frame, unless transformed by the user'''
+        for frame in self.frames if frames is None else frames:
+            photo = frame.photo
+            if not photo.userTransformed and not photo.placeholder:
+                photo.reset()
+                frame.fitPhoto()
+
+    #-------------------------------------------------------
+    def clear(self):
+        '''Remove all items from the scene'''
+        super(CollageScene, self).clear()
+        self.frames = []
+        self.photoPool = []
+        self.history.clear()
+        self._initBackground()
+
+    #-------------------------------------------------------
+    def _initBackground(self):
+        '''Add rect to provide background for PhotoFrameItem's'''
+        pen = QPen(FrameBgColor)
+        brush = QBrush(FrameBgColor)
+        self.bgItem = self.addRect(QRectF(), pen, brush)
+        self.frameOverlay = FrameOverlayItem()
+        self.addItem(self.frameOverlay)
+        self.updateBackground()
+
+    #-------------------------------------------------------
+    def updateBackground(self):
+        '''Resize background to the collage size'''
+        self.bgRect = QRectF(FrameWidth/2, FrameWidth/2,
+                             CollageSize.width() - FrameWidth, CollageSize.height() - FrameWidth)
+        self.bgItem.setRect(self.bgRect)
+        self.setSceneRect(CollageSize)
+        self.updateFrames()
+
+    #-------------------------------------------------------
+    def updateFrames(self):
+        '''Repaint borders of the frames'''
+        self.frameOverlay.invalidate()
+
+    #-------------------------------------------------------
+    def getPhotosPaths(self, parked=False):
+        '''
+        Return list containing the paths of all the photos in the scene, in layout order.
+        If parked is True, the paths of the photos kept for later layouts are appended.
+        '''
+        paths = [frame.photo.filename for frame in self.frames]
+        if parked:
+            paths += [photo.filename for photo in self.photoPool]
+        logger.debug("Current photos: %s", paths)
+        return paths
+
+    #-------------------------------------------------------
+    @traced('saveProject')
+    def saveProject(self, filename, layout):
+        '''
+        Save collage project to file: layout, frames geometry, photos paths and
+        transformations, frame settings, and a small thumbnail of each photo.
+        Format is gzip-compressed JSON.
+        '''
+        frames = []
+        projectDir = os.path.dirname(os.path.abspath(filename))
+        for frame in self.frames:
+            photo = frame.photo
+            pos = frame.pos()
+            photoData = photo.state()
+            photoData['path'] = os.path.abspath(photo.filename)
+            photoData['relpath'] = os.path.relpath(photoData['path'], projectDir)
+            if not photo.placeholder:
+                photoData['size'] = [photo.sourceSize.width(), photo.sourceSize.height()]
+                thumbnail = photo.pixmap().scaled(ProjectThumbnailSize, ProjectThumbnailSize,
+                                                  Qt.KeepAspectRatio, Qt.SmoothTransformation)
+                data = QByteArray()
+                buf = QBuffer(data)
+                buf.open(QIODevice.WriteOnly)
+                thumbnail.save(buf, 'JPG', 80)
+                photoData['thumbnail'] = base64.b64encode(bytes(data)).decode('ascii')
+            frames.append({'rect': [pos.x(), pos.y(), frame.rect.width(), frame.rect.height()],
+                           'photo': photoData})
+        project = {
+            'version': 1,
+            'layout': layout,
+            'aspect': CollageAspect,
+            'frameRadius': FrameRadius,
+            'frameColor': QColor(FrameColor).name(),
+            'frames': frames,
+        }
+        try:
+            with gzip.open(filename, 'wt', encoding='utf-8') as f:
+                json.dump(project, f, separators=(',', ':'))
+        except OSError as err:
+            logger.error('Failed to save project %s: %s', filename, err)
+            return False
+        logger.info('Project saved to file: %s', filename)
+        return True
+
+    #-------------------------------------------------------
+    @traced('loadProject')
+    def loadProject(self, filename):
+        '''
+        Load collage project saved by saveProject(). Photos are displayed from their
+        embedded thumbnails, and decoded in the background. Return project layout
+        description, or None on error.
+        '''
+        global FrameRadius
+        global FrameColor
+        projectDir = os.path.dirname(os.path.abspath(filename))
+        # The whole project is parsed before clearing the scene, which is kept on error
+        try:
+            with gzip.open(filename, 'rt', encoding='utf-8') as f:
+                project = json.load(f)
+            aspect = project['aspect']
+            aspectWidth, aspectHeight = [int(i) for i in aspect.split(':')]
+            if aspectWidth <= 0 or aspectHeight <= 0:
+                raise ValueError('invalid aspect ratio: %s' % aspect)
+            frameRadius = int(project.get('frameRadius', FrameRadius))
+            frameColor = QColor(project.get('frameColor', QColor(FrameColor).name()))
+            # (path, rect, state, thumbnail data, size) of each frame
+            frames = []
+            for frameData in project['frames']:
+                photoData = frameData['photo']
+                path = photoData['path']
+                if not isinstance(path, str):
+                    raise TypeError('invalid photo path: %r' % (path,))
+                if not os.path.exists(path) and 'relpath' in photoData:
+                    path = os.path.join(projectDir, photoData['relpath'])
+                x, y, width, height = [float(i) for i in frameData['rect']]
+                thumbnail, size, state = None, None, None
+                if 'thumbnail' in photoData:
+                    thumbnail = base64.b64decode(photoData['thumbnail'])
+                    size = tuple(int(i) for i in photoData['size'])
+                    if len(size) != 2:
+                        raise ValueError('invalid photo size: %r' % (size,))
+                    posX, posY = [float(i) for i in photoData['pos']]
+                    state = {'pos': (posX, posY), 'scale': float(photoData['scale']),
+                             'rotation': float(photoData['rotation']),
+                             'userTransformed': bool(photoData.get('userTransformed', True))}
+                frames.append((path, (x, y, width, height), state, thumbnail, size))
+        except (OSError, EOFError, ValueError, KeyError, TypeError, AttributeError) as err:
+            logger.error('Failed to open project %s: %s', filename, err)
+            return None
+        setCollageAspectRatio(aspect)
+        FrameRadius = frameRadius
+        FrameColor = frameColor
+        imageLoader.cancelAll()
+        self.clear()
+        for path, (x, y, width, height), state, thumbnailData, size in frames:
+            frame = PhotoFrameItem(QRect(0, 0, int(width), int(height)))
+            frame.setPos(x, y)
+            photo = PhotoItem(path)
+            frame.setPhoto(photo)
+            if thumbnailData is not None:
+                thumbnail = QPixmap()
+                thumbnail.loadFromData(thumbnailData, 'JPG')
+                photo.setThumbnail(thumbnail, QSize(*size))
+                photo.setState(state)
+            self.addItem(frame)
+            self.frames.append(frame)
+            if photo.placeholder:
+                self.loadPhoto(photo)
+            else:
+                photo.updateProxy()
+        self.updateFrames()
+        logger.info('Project loaded from file: %s', filename)
+        return project.get('layout')
+
+    #-------------------------------------------------------
+    def restoreLayout(self, desc, snapshot):
+        '''Apply layout described by desc to the photos of snapshot, and restore their state'''
+        global filenames
+        filenames = [path for path, state in snapshot] + self.getPhotosPaths(parked=True)
+        funcname, args = parseLayout(desc)
+        getattr(self, funcname)(*args)
+        for frame, (path, state) in zip(self.frames, snapshot):
+            UndoHistory.setPhotoState(frame.photo, state)
+        self.layoutRestored.emit(desc)
+
+    #-------------------------------------------------------
+    def createGridCollage(self, numx, numy):
+        '''Create a collage with specified number of rows and columns'''
+        f = LoopIter(filenames)
+        cells = []
+        photoWidth  = round(CollageSize.width() / numx)
+        photoHeight =  round(CollageSize.height() / numy)
+        for x in range(0, numx):
+            for y in range(0, numy):
+                cells.append((QRect(x * photoWidth, y * photoHeight, photoWidth, photoHeight),
+                              f.next()))
+        self.applyLayout(cells)
+
+    #-------------------------------------------------------
+    def createColumnCollage(self, desc):
+        '''Create a collage based on the string passed in'''
+        columns = desc.split('/')
+        # Calculate base width
+        # - Big photos are twice as wide as normal ones
+        baseWidth = round(CollageSize.width() / (len(columns) + desc.count('B')))
+        # Loop through all columns
+        f = LoopIter(filenames)
+        cells = []
+        x = 0
+        for col in columns:
+            logger.debug('col=%s', col)
+            photoCount = int(col.replace('B', ''))
+            if 'B' in col:
+                photoWidth = baseWidth * 2
+            else:
+                photoWidth = baseWidth
+            photoHeight =  round(CollageSize.height() / photoCount)
+            for y in range(0, photoCount):
+                cells.append((QRect(x, y * photoHeight, photoWidth, photoHeight), f.next()))
+            x += photoWidth
+        self.applyLayout(cells)
+
+    #-------------------------------------------------------
+    def createRowCollage(self, desc):
+        '''Create a collage based on the string passed in'''
+        rows = desc.split('/')
+        # Calculate base height
+        # - Big photos are twice as high as normal ones
+        baseHeight = round(CollageSize.height() / (len(rows) + desc.count('B')))
+        # Loop through all columns
+        f = LoopIter(filenames)
+        cells = []
+        y = 0
+        for row in rows:
+            logger.debug('row=%s', row)
+            photoCount = int(row.replace('B', ''))
+            if 'B' in row:
+                photoHeight = baseHeight * 2
+            else:
+                photoHeight = baseHeight
+            photoWidth =  round(CollageSize.width() / photoCount)
+            for x in range(0, photoCount):
+                cells.append((QRect(x * photoWidth, y, photoWidth, photoHeight), f.next()))
+            y += photoHeight
+        self.applyLayout(cells)
+
+    #-------------------------------------------------------
+    def createAutoCollage(self):
+        '''
+        Create a collage of justified rows, sized from the aspect ratio of each photo
+        to minimize cropping. Each photo is used once.
+        '''
+        paths = list(OrderedDict.fromkeys(filenames))
+        ratios = []
+        for path in paths:
+            size = imageSize(path)
+            if imageRotation(path) % 180 == 90:
+                size.transpose()
+            ratios.append(size.width() / size.height() if not size.isEmpty() else 1.0)
+        rects = justifiedLayout(ratios, CollageSize.width(), CollageSize.height())
+        self.applyLayout(list(zip(rects, paths)))
+
+
+#-------------------------------------------------------------------------------
+class PngStripWriter:
+    '''Stream image strips into a PNG file, so that only one strip is kept in memory'''
+
+    def __init__(self, filename, width, height, dpi=None, quality=-1):
+        self.file = open(filename, 'wb')
+        self.width = width
+        # Same mapping of quality to compression level as Qt's PNG writer
+        level = 6 if quality < 0 else (100 - min(quality, 100)) * 9 // 91
+        self.compressor = zlib.compressobj(level)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bits RGB, no interlace
+        self._writeChunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        if dpi:
+            # Physical pixel dimensions, in pixels per meter
+            dpm = round(dpi / 0.0254)
+            self._writeChunk(b'pHYs', struct.pack('>IIB', dpm, dpm, 1))
+
+    #-------------------------------------------------------
+    def write(self, strip):
+        '''Compress strip (QImage) and append it to the file'''
+        strip = strip.convertToFormat(QImage.Format_RGB888)
+        bits = strip.constBits()
+        bits.setsize(strip.byteCount())
+        data = bits.asstring()
+        bytesPerLine = strip.bytesPerLine()
+        rowSize = self.width * 3
+        # Each row is preceded by its filter type (0: none)
+        rows = b''.join(b'\x00' + data[y * bytesPerLine:y * bytesPerLine + rowSize]
+                        for y in range(strip.height()))
+        compressed = self.compressor.compress(rows)
+        if compressed:
+            self._writeChunk(b'IDAT', compressed)
+
+    #-------------------------------------------------------
+    def close(self):
+        '''Flush compressor and close file'''
+        self._writeChunk(b'IDAT', self.compressor.flush())
+        self._writeChunk(b'IEND', b'')
+        self.file.close()
+        return True
+
+    #-------------------------------------------------------
+    def abort(self):
+        '''Close incomplete file'''
+        self.file.close()
+
+    #-------------------------------------------------------
+    def _writeChunk(self, chunkType, data):
+        '''Write a PNG chunk'''
+        self.file.write(struct.pack('>I', len(data)) + chunkType + data +
+                        struct.pack('>I', zlib.crc32(chunkType + data) & 0xffffffff))
+
+
+#-------------------------------------------------------------------------------
+class ImageStripWriter:
+    '''
+    Assemble image strips into a single QImage saved on close, for the formats that
+    can't be encoded incrementally
+    '''
+
+    def __init__(self, filename, width, height, fmt, dpi=None):
+        self.filename = filename
+        self.format = fmt
+        self.image = QImage(width, height, QImage.Format_RGB32)
+        if dpi:
+            self.image.setDotsPerMeterX(round(dpi / 0.0254))
+            self.image.setDotsPerMeterY(round(dpi / 0.0254))
+        self.painter = QPainter(self.image)
+        self.y = 0
+
+    #-------------------------------------------------------
+    def write(self, strip):
+        '''Copy strip into image'''
+        self.painter.drawImage(0, self.y, strip)
+        self.y += strip.height()
+
+    #-------------------------------------------------------
+    def finish(self):
+        '''Stop writing strips: the image can then be encoded from several threads'''
+        if self.painter.isActive():
+            self.painter.end()
+
+    #-------------------------------------------------------
+    def encode(self, filename, fmt, quality=-1):
+        '''Encode image to filename, in format fmt'''
+        self.finish()
+        writer = QImageWriter(filename, fmt.encode('ascii'))
+        writer.setQuality(quality)
+        if not writer.write(self.image):
+            logger.error('Failed to encode %s: %s', filename, writer.errorString())
+            return False
+        return True
+
+    #-------------------------------------------------------
+    def close(self):
+        '''Encode image to file'''
+        return self.encode(self.filename, self.format)
+
+    #-------------------------------------------------------
+    def abort(self):
+        '''Release image'''
+        self.finish()
+        self.image = QImage()
+
+
+#-------------------------------------------------------------------------------
+class CollageSnapshot:
+    '''
+    Copy of the state of a collage needed to render it: plain values only, no items nor
+    pixmaps, so that it can be rendered in a worker thread while the collage is edited
+    '''
+
+    def __init__(self, scene):
+        self.sceneRect = QRectF(CollageSize)
+        self.bgRect = QRectF(scene.bgRect)
+        self.bgColor = QColor(FrameBgColor)
+        self.frameColor = QColor(FrameColor)
+        self.frameRadius = FrameRadius
+        # (frame rect, photo path, photo transform, photo size) of each frame
+        self.photos = []
+        for frame in scene.frames:
+            photo = frame.photo
+            photo.applyWheel()
+            path = DefaultPhotoPath if photo.placeholder else photo.filename
+            self.photos.append((frame.sceneBoundingRect(), path, photo.sceneTransform(),
+                                QSize(photo.sourceSize)))
+
+    #-------------------------------------------------------
+    def height(self, width):
+        '''Return height of the collage rendered width pixels wide'''
+        return max(1, round(width * self.sceneRect.height() / self.sceneRect.width()))
+
+    #-------------------------------------------------------
+    def render(self, width, writers, isCancelled=None, progress=None):
+        '''
+        Render collage width pixels wide, in horizontal strips of ExportStripHeight pixels
+        written to each of writers, so that the whole image is never held in memory. Each
+        photo is decoded just big enough for its size in the output, when the first strip
+        it appears in is rendered, and released after the last one. progress(done, total)
+        is called after each strip. Return False if isCancelled() returns True.
+        '''
+        ratio = width / self.sceneRect.width()
+        height = self.height(width)
+        strip = QImage(width, min(ExportStripHeight, height), QImage.Format_RGB32)
+        stripCount = math.ceil(height / strip.height())
+        frameRects = [photo[0] for photo in self.photos]
+        # Photo index -> decoded image, for the photos of the current strip
+        images = {}
+        for n, y in enumerate(range(0, height, strip.height())):
+            if isCancelled and isCancelled():
+                return False
+            stripHeight = min(strip.height(), height - y)
+            stripRect = QRectF(0, y / ratio, self.sceneRect.width(), stripHeight / ratio)
+            strip.fill(self.frameColor)
+            painter = QPainter(strip)
+            painter.setRenderHints(QPainter.Antialiasing | QPainter.SmoothPixmapTransform)
+            painter.translate(0, -y)
+            painter.scale(ratio, ratio)
+            painter.setPen(QPen(self.bgColor))
+            painter.setBrush(QBrush(self.bgColor))
+            painter.drawRect(self.bgRect)
+            for i, (rect, path, transform, size) in enumerate(self.photos):
+                if not rect.intersects(stripRect):
+                    continue
+                if i not in images:
+                    images[i] = self._decode(path, transform, size, ratio)
+                if not images[i].isNull():
+                    painter.save()
+                    painter.setClipRect(rect)
+                    painter.setTransform(transform, True)
+                    painter.drawImage(QRectF(0, 0, size.width(), size.height()), images[i],
+                                      QRectF(images[i].rect()))
+                    painter.restore()
+            paintFrameBorders(painter, frameRects, self.frameRadius, self.frameColor)
+            painter.end()
+            # Release the photos that end in this strip
+            for i in [i for i in images if frameRects[i].bottom() <= stripRect.bottom()]:
+                del images[i]
+            if stripHeight < strip.height():
+                strip = strip.copy(0, 0, width, stripHeight)
+            for writer in writers:
+                writer.write(strip)
+            if progress:
+                progress(n + 1, stripCount)
+        return True
+
+    #-------------------------------------------------------
+    @staticmethod
+    def _decode(path, transform, size, ratio):
+        '''Decode photo at the scale it's drawn with transform in the output'''
+        with tracer.span('load', lambda: {'file': os.path.basename(path)}):
+            reader = QImageReader(path)
+            # EXIF orientation is part of the photo transform
+            reader.setAutoTransform(False)
+            scale = math.sqrt(abs(transform.determinant())) * ratio
+            if scale < 1:
+                reader.setScaledSize(QSize(max(1, math.ceil(size.width() * scale)),
+                                           max(1, math.ceil(size.height() * scale))))
+            image = reader.read()
+        if image.isNull():
+            logger.warning('Failed to load image: %s', path)
+        return image
+
+
+#-------------------------------------------------------------------------------
+def exportOutputs(filename, formats=None):
+    '''
+    Return list of (filename, format, quality) of the files to export to filename.
+    formats is a list of (format, quality), quality being -1 for the default one: files
+    are named after filename, with the quality appended for the formats listed twice.
+    '''
+    if not formats:
+        fmt = os.path.splitext(filename)[1][1:].lower() or 'png'
+        return [(filename, fmt, -1)]
+    base = os.path.splitext(filename)[0]
+    counts = {}
+    for fmt, quality in formats:
+        counts[fmt] = counts.get(fmt, 0) + 1
+    outputs = []
+    for fmt, quality in formats:
+        suffix = '-q%d' % quality if counts[fmt] > 1 and quality >= 0 else ''
+        outputs.append(('%s%s.%s' % (base, suffix, fmt), fmt, quality))
+    return outputs
+
+
+#-------------------------------------------------------------------------------
+def defaultFileMode():
+    '''Return permissions of the files created by open(), given the process umask'''
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# Permissions of the exported files, the temporary files they're written to being private
+ExportFileMode = defaultFileMode()
+
+
+#-------------------------------------------------------------------------------
+class ExportJob:
+    '''State of an export shared by its render and encode tasks'''
+
+    def __init__(self, jobId, snapshot, outputs, width, dpi):
+        self.id = jobId
+        self.snapshot = snapshot
+        self.outputs = outputs
+        self.width = int(width or snapshot.sceneRect.width())
+        self.height = snapshot.height(self.width)
+        self.dpi = dpi
+        # Rendering progress is counted in strips, encoding in outputs
+        self.steps = math.ceil(self.height / ExportStripHeight) + len(outputs)
+        # Temporary file and strip writer of each output
+        self.tmpFilenames = []
+        self.writers = []
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.encoded = 0
+        self.failed = []
+
+    #-------------------------------------------------------
+    def openWriters(self):
+        '''
+        Open the strip writers of the outputs. PNG files are written strip by strip,
+        the other formats share one image, encoded in parallel once rendered.
+        '''
+        image = None
+        for filename, fmt, quality in self.outputs:
+            # Unique temporary file: a cancelled job can't remove the one of the next job
+            fd, tmpFilename = tempfile.mkstemp(prefix='.', suffix='.part',
+                                               dir=os.path.dirname(os.path.abspath(filename)))
+            os.close(fd)
+            self.tmpFilenames.append(tmpFilename)
+            os.chmod(tmpFilename, ExportFileMode)
+            if fmt == 'png':
+                writer = PngStripWriter(tmpFilename, self.width, self.height, self.dpi, quality)
+            else:
+                if image is None:
+                    image = ImageStripWriter(tmpFilename, self.width, self.height, fmt, self.dpi)
+                writer = image
+            self.writers.append(writer)
+
+    #-------------------------------------------------------
+    def abort(self):
+        '''Close writers and remove temporary files'''
+        for writer in self.writers:
+            writer.abort()
+        self.writers = []
+        for tmpFilename in self.tmpFilenames:
+            if os.path.exists(tmpFilename):
+                os.remove(tmpFilename)
+
+
+#-------------------------------------------------------------------------------
+class ExportRenderTask(QRunnable):
+    '''
+    Render the collage of an export job in strips streamed to its outputs, then finish
+    encoding the outputs in parallel
+    '''
+
+    def __init__(self, exporter, job):
+        super(ExportRenderTask, self).__init__()
+        self.exporter = exporter
+        self.job = job
+
+    def run(self):
+        job = self.job
+        def progress(done, total):
+            self.exporter.reportProgress(job.id, done, job.steps, 'Rendering')
+        try:
+            job.openWriters()
+            with tracer.span('render', width=job.width):
+                ok = job.snapshot.render(job.width, list(OrderedDict.fromkeys(job.writers)),
+                                         job.cancelled.is_set, progress)
+            message = 'Export cancelled'
+        except OSError as err:
+            logger.error(str(err))
+            ok = False
+            message = 'Failed to save collage to file: %s' % \
+                      ', '.join(output[0] for output in job.outputs)
+        if not ok:
+            job.abort()
+            self.exporter.reportFinished(job.id, False, message)
+            return
+        for writer in job.writers:
+            if isinstance(writer, ImageStripWriter):
+                writer.finish()
+        for i in range(len(job.outputs)):
+            self.exporter.pool.start(ExportEncodeTask(self.exporter, job, i))
+
+
+#-------------------------------------------------------------------------------
+class ExportEncodeTask(QRunnable):
+    '''Finish encoding one of the outputs of an export job, and move it in place'''
+
+    def __init__(self, exporter, job, index):
+        super(ExportEncodeTask, self).__init__()
+        self.exporter = exporter
+        self.job = job
+        self.index = index
+
+    def run(self):
+        job = self.job
+        filename, fmt, quality = job.outputs[self.index]
+        tmpFilename = job.tmpFilenames[self.index]
+        writer = job.writers[self.index]
+        ok = False
+        try:
+            if job.cancelled.is_set():
+                if isinstance(writer, PngStripWriter):
+                    writer.abort()
+            else:
+                with tracer.span('encode', file=os.path.basename(filename)):
+                    if isinstance(writer, PngStripWriter):
+                        ok = writer.close()
+                    else:
+                        ok = writer.encode(tmpFilename, fmt, quality)
+            if ok and not job.cancelled.is_set():
+                os.replace(tmpFilename, filename)
+                logger.info('Collage saved to file: %s (%dx%d)', filename, job.width, job.height)
+            else:
+                if not job.cancelled.is_set():
+                    logger.error('Failed to save collage to file: %s', filename)
+                ok = False
+                if os.path.exists(tmpFilename):
+                    os.remove(tmpFilename)
+        except OSError as err:
+            logger.error(str(err))
+            ok = False
+        with job.lock:
+            job.encoded += 1
+            if not ok:
+                job.failed.append(filename)
+            encoded = job.encoded
+        self.exporter.reportProgress(job.id, job.steps - len(job.outputs) + encoded, job.steps,
+                                     'Encoding %d/%d' % (encoded, len(job.outputs)))
+        if encoded == len(job.outputs):
+            # Last output: release image
+            job.writers = []
+            if job.cancelled.is_set():
+                self.exporter.reportFinished(job.id, False, 'Export cancelled')
+            elif job.failed:
+                self.exporter.reportFinished(job.id, False, 'Failed to save collage to file: %s' %
+                                             ', '.join(job.failed))
+            else:
+                self.exporter.reportFinished(job.id, True, 'Collage saved to file: %s' %
+                                             ', '.join(output[0] for output in job.outputs))
+
+
+#-------------------------------------------------------------------------------
+class Exporter(QObject):
+    '''
+    Export collage snapshots in worker threads, so that the collage can still be edited
+    meanwhile. The collage is rendered once, in strips streamed to each output (e.g.
+    JPEG at several qualities and PNG), the formats that can't be written by strips being
+    encoded in parallel at the end. Only one export runs at a time.
+    progressChanged(percent, message) and finished(ok, message) are emitted in the GUI
+    thread.
+    '''
+
+    progressChanged = pyqtSignal(int, str)
+    finished = pyqtSignal(bool, str)
+    # Emitted by the tasks, with the job id
+    _progress = pyqtSignal(int, int, int, str)
+    _finished = pyqtSignal(int, bool, str)
+
+    def __init__(self, parent=None):
+        super(Exporter, self).__init__(parent)
+        self.pool = QThreadPool(self)
+        self.job = None
+        self.nextJobId = 0
+        self._progress.connect(self._progressHandler)
+        self._finished.connect(self._finishedHandler)
+
+    #-------------------------------------------------------
+    def export(self, snapshot, outputs, width=None, dpi=None):
+        '''
+        Export snapshot to outputs, a list of (filename, format, quality). Cancel current
+        export.
+        '''
+        self.cancel()
+        self.nextJobId += 1
+        self.job = ExportJob(self.nextJobId, snapshot, outputs, width, dpi)
+        self.pool.start(ExportRenderTask(self, self.job))
+        self.progressChanged.emit(0, 'Rendering')
+
+    #-------------------------------------------------------
+    def cancel(self):
+        '''Cancel current export. Files already written are kept.'''
+        if self.job is not None:
+            self.job.cancelled.set()
+            self.job = None
+
+    #-------------------------------------------------------
+    def isBusy(self):
+        '''Return True if an export is running'''
+        return self.job is not None
+
+    #-------------------------------------------------------
+    def waitForDone(self):
+        '''Block until current export is completed'''
+        while self.job is not None:
+            self.pool.waitForDone()
+            QCoreApplication.processEvents()
+
+    #-------------------------------------------------------
+    def reportProgress(self, jobId, done, total, message):
+        '''Report progress of job jobId, from any thread: done steps out of total'''
+        self._progress.emit(jobId, done, total, message)
+
+    #-------------------------------------------------------
+    def reportFinished(self, jobId, ok, message):
+        '''Report completion of job jobId, from any thread'''
+        self._finished.emit(jobId, ok, message)
+
+    #-------------------------------------------------------
+    def _progressHandler(self, jobId, done, total, message):
+        if self.job is not None and jobId == self.job.id:
+            self.progressChanged.emit(100 * done // total, message)
+
+    #-------------------------------------------------------
+    def _finishedHandler(self, jobId, ok, message):
+        if self.job is not None and jobId == self.job.id:
+            self.job = None
+            self.finished.emit(ok, message)
+
+
+#-------------------------------------------------------------------------------
+def exportSnapshot(snapshot, outputs, width=None, dpi=None):
+    '''
+    Export snapshot to outputs like Exporter.export(), blocking until done: used to
+    render collages without window. Return True on success.
+    '''
+    results = []
+    exporter = Exporter()
+    exporter.finished.connect(lambda ok, message: results.append(ok))
+    exporter.export(snapshot, outputs, width, dpi)
+    exporter.waitForDone()
+    return bool(results) and results[0]
+
+
+#-------------------------------------------------------------------------------
+def differenceHashes(pixels):
+    '''
+    Return 64 bits difference hashes (dHash) of a batch of 8x9 images, given as a
+    (count, 8, 9, 3) RGB array: one bit per pixel brighter than its right neighbour
+    '''
+    luminance = pixels.astype(np.float32) @ np.array([0.299, 0.587, 0.114], np.float32)
+    brighter = luminance[:, :, :-1] > luminance[:, :, 1:]
+    bits = np.packbits(brighter.reshape(len(pixels), 64), axis=1)
+    return [int.from_bytes(row.tobytes(), 'big') for row in bits]
+
+
+#-------------------------------------------------------------------------------
+class PhotoHashTask(QRunnable):
+    '''Compute perceptual hashes of a batch of photos in a worker thread'''
+
+    def __init__(self, files, results):
+        super(PhotoHashTask, self).__init__()
+        # List of (filename, cache key)
+        self.files = files
+        # List extended with (filename, cache key, hash), hash being None on error
+        self.results = results
 
     #-------------------------------------------------------
-    def wheelEvent(self, event):
-        # Filter wheel events
-        items = self.items(event.pos())
-        logger.debug('Wheel event: %s', str(items))
-        if items:
-            for item in items:
-                if isinstance(item, PhotoItem):
-                    super(ImageView, self).wheelEvent(event)
+    def run(self):
+        with tracer.span('hash', files=len(self.files)):
+            images = []
+            for filename, key in self.files:
+                image = decodeSmall(filename, key, 32)
+                if not image.isNull():
+                    image = image.scaled(9, 8, Qt.IgnoreAspectRatio, Qt.SmoothTransformation) \
+                                 .convertToFormat(QImage.Format_RGBX8888)
+                images.append(image)
+            decoded = [imageArray(image)[..., :3] for image in images if not image.isNull()]
+            hashes = iter(differenceHashes(np.stack(decoded)) if decoded else [])
+            self.results.extend((filename, key, None if image.isNull() else next(hashes))
+                                for (filename, key), image in zip(self.files, images))
 
 
 #-------------------------------------------------------------------------------
-class HelpItem(QGraphicsItem):
-    '''Online help'''
+class PhotoHashIndex:
+    '''
+    Perceptual hashes of photos, cached in a file of JSON lines shared by PyView sessions
+    and processes. Hashes are only computed for new and modified photos, by a pool of
+    threads, and appended to the file. The file is rewritten when it holds too many
+    outdated entries.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        # Path -> (mtime, size, hash). Read on first use.
+        self.entries = None
+        self.lineCount = 0
 
     #-------------------------------------------------------
-    def __init__(self, point, parent=None):
-        super(HelpItem, self).__init__(parent)
-        lines = len(HelpCommands) + 3
-        self.rect = QRect(point.x(), point.y(), 700, lines * 32)
+    def hashes(self, photos):
+        '''Return dict path -> hash of photos. Photos that can't be decoded are left out.'''
+        if self.entries is None:
+            self._read()
+        hashes = {}
+        missing = []
+        for photo in OrderedDict.fromkeys(photos):
+            key = PixmapCache.key(photo)
+            if key is None:
+                continue
+            entry = self.entries.get(key[0])
+            if entry and entry[:2] == key[1:]:
+                if entry[2] is not None:
+                    hashes[photo] = entry[2]
+            else:
+                missing.append((photo, key))
+        if missing:
+            logger.info('Computing perceptual hashes of %d photos', len(missing))
+            results = []
+            pool = QThreadPool()
+            for i in range(0, len(missing), PhotoHashBatchSize):
+                pool.start(PhotoHashTask(missing[i:i + PhotoHashBatchSize], results))
+            pool.waitForDone()
+            for photo, key, value in results:
+                self.entries[key[0]] = key[1:] + (value,)
+                if value is not None:
+                    hashes[photo] = value
+            self._write([(key[0],) + self.entries[key[0]] for photo, key, value in results])
+        return hashes
 
     #-------------------------------------------------------
-    def boundingRect(self):
-        return QRectF(self.rect)
+    def _read(self):
+        '''Read hashes file. Entries appended later override the previous ones.'''
+        self.entries = {}
+        self.lineCount = 0
+        try:
+            with open(self.filename, encoding='utf-8') as f:
+                for line in f:
+                    self.lineCount += 1
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry['path']] = (entry['mtime'], entry['size'], entry['hash'])
+                    except (ValueError, KeyError, TypeError):
+                        # Line truncated by an interrupted run
+                        continue
+        except OSError:
+            pass
 
     #-------------------------------------------------------
-    def paint(self, painter, option, widget=None):
-        painter.setRenderHint(QPainter.Antialiasing)
+    def _write(self, entries):
+        '''Append entries (path, mtime, size, hash) to the file, or rewrite it if mostly outdated'''
+        lines = [json.dumps({'path': path, 'mtime': mtime, 'size': size, 'hash': value}) + '\n'
+                 for path, mtime, size, value in entries]
+        tmpPath = None
+        try:
+            os.makedirs(os.path.dirname(self.filename), 0o700, exist_ok=True)
+            if self.lineCount + len(lines) <= 2 * len(self.entries):
+                with open(self.filename, 'a', encoding='utf-8') as f:
+                    f.writelines(lines)
+                self.lineCount += len(lines)
+                return
+            # Compact: written atomically, other processes never see a partial file
+            fd, tmpPath = tempfile.mkstemp(prefix='.', dir=os.path.dirname(self.filename))
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                for path, (mtime, size, value) in self.entries.items():
+                    f.write(json.dumps({'path': path, 'mtime': mtime, 'size': size,
+                                        'hash': value}) + '\n')
+            os.replace(tmpPath, self.filename)
+            self.lineCount = len(self.entries)
+        except OSError as err:
+            logger.warning('Failed to write perceptual hashes to %s: %s', self.filename, err)
+            if tmpPath and os.path.exists(tmpPath):
+                os.remove(tmpPath)
 
-        pen = painter.pen()
-        pen.setColor(QColor(128, 128, 128, 200))
-        pen.setWidth(3)
-        painter.setPen(pen)
-        brush = painter.brush()
-        brush.setColor(QColor(0, 0, 0, 200))
-        brush.setStyle(Qt.SolidPattern)
-        painter.setBrush(brush)
 
-        painter.drawRoundedRect(self.rect.left(), self.rect.top(),
-                                self.rect.width(), self.rect.height(),
-                                15, 15)
+photoHashIndex = PhotoHashIndex(PhotoHashFile)
 
-        font = painter.font()
-        font.setPixelSize(32)
-        painter.setFont(font)
-        pen = painter.pen()
-        pen.setColor(QColor(255, 255, 255, 232))
-        painter.setPen(pen)
-        point = self.rect.topLeft() + QPoint(20, 40)
-        painter.drawText(point, 'Help')
 
-        font.setPixelSize(24)
-        painter.setFont(font)
-        point += QPoint(0, 16)
-        for cmd, desc in HelpCommands:
-            point += QPoint(0, 32)
-            painter.drawText(point, cmd)
-            painter.drawText(point + QPoint(200, 0), desc)
+#-------------------------------------------------------------------------------
+def popcount(value):
+    '''Return number of bits set in value'''
+    return bin(value).count('1')
+
+
+if hasattr(int, 'bit_count'):
+    # Python 3.10+
+    popcount = int.bit_count
 
 
 #-------------------------------------------------------------------------------
-class CollageScene(QGraphicsScene):
-    '''Scene containing the frames and the photos'''
+class HammingIndex:
+    '''
+    Index of 64 bits hashes, finding the items whose hash is within a Hamming distance of
+    a hash without comparing it to all the hashes (multi-index hashing). Hashes are split
+    in distance // 2 + 1 chunks, so that two hashes within distance have at least one
+    chunk differing by one bit at most: only the hashes found in the buckets of these
+    chunk values are compared.
+    '''
 
-    def __init__(self):
-        super(CollageScene, self).__init__()
-        self.bgRect = None
-        self._initBackground()
+    def __init__(self, distance):
+        self.distance = distance
+        count = distance // 2 + 1
+        # Bits that may differ in the matching chunk
+        radius = distance // count
+        # (shift, mask, values xor-ed to the chunk to find the matching chunks) of the chunks
+        self.chunks = []
+        shift = 0
+        for i in range(count):
+            bits = 64 // count + (1 if i < 64 % count else 0)
+            flips = [0] + [1 << bit for bit in range(bits)] if radius else [0]
+            self.chunks.append((shift, (1 << bits) - 1, flips))
+            shift += bits
+        # Per chunk: chunk value -> list of (hash, item)
+        self.buckets = [{} for chunk in self.chunks]
 
     #-------------------------------------------------------
-    def addPhoto(self, rect, filepath):
-        '''Add a photo item to the scene'''
-        logger.info('Add image: %s', filepath)
-        frame = PhotoFrameItem(QRect(0, 0, rect.width(), rect.height()))
-        frame.setPos(rect.x(), rect.y())
-        photo = PhotoItem(filepath)
-        frame.setPhoto(photo)
-        # Add frame to scene
-        self.addItem(frame)
+    def add(self, value, item):
+        '''Add item of hash value'''
+        for (shift, mask, _), buckets in zip(self.chunks, self.buckets):
+            buckets.setdefault((value >> shift) & mask, []).append((value, item))
 
     #-------------------------------------------------------
-    def clear(self):
-        '''Remove all items from the scene'''
-        super(CollageScene, self).clear()
-        self._initBackground()
+    def find(self, value):
+        '''Return items whose hash is within distance of value'''
+        found = OrderedDict()
+        for (shift, mask, flips), buckets in zip(self.chunks, self.buckets):
+            chunk = (value >> shift) & mask
+            for flip in flips:
+                for other, item in buckets.get(chunk ^ flip, ()):
+                    if item not in found and popcount(value ^ other) <= self.distance:
+                        found[item] = None
+        return list(found)
 
-    #-------------------------------------------------------
-    def _initBackground(self):
-        '''Add rect to provide background for PhotoFrameItem's'''
-        pen = QPen(FrameBgColor)
-        brush = QBrush(FrameBgColor)
-        self.bgRect = QRectF(FrameWidth/2, FrameWidth/2,
-                             CollageSize.width() - FrameWidth, CollageSize.height() - FrameWidth)
-        self.addRect(self.bgRect, pen, brush)
 
-    #-------------------------------------------------------
-    def getPhotosPaths(self):
-        '''Return list containing the paths of all the photos in the scene'''
-        paths = []
-        items = self.items(order=Qt.AscendingOrder)
-        if items:
-            for item in items:
-                if isinstance(item, PhotoItem):
-                    paths.append(item.filename)
-        logger.debug("Current photos: %s", str(paths))
-        return paths
+#-------------------------------------------------------------------------------
+def arrangeDuplicates(photos, mode):
+    '''
+    Return photos arranged according to their near-duplicates (see DuplicateMode), the
+    order of the photos being kept otherwise. A photo is a near-duplicate of the first
+    photo of its group, if their hashes are within DuplicateDistance bits.
+    '''
+    if not loadNumpy():
+        logger.warning('Near-duplicate photos can\'t be found without NumPy')
+        return photos
+    hashes = photoHashIndex.hashes(photos)
+    index = HammingIndex(DuplicateDistance)
+    # Number of photos of each group, by first photo
+    groups = {}
+    # Photos of rank n in their group
+    ranks = [[]]
+    for photo in photos:
+        value = hashes.get(photo)
+        first = index.find(value) if value is not None else None
+        if not first:
+            if value is not None:
+                index.add(value, photo)
+                groups[photo] = 1
+            ranks[0].append(photo)
+            continue
+        rank = groups[first[0]]
+        groups[first[0]] += 1
+        if rank == len(ranks):
+            ranks.append([])
+        ranks[rank].append(photo)
+    logger.info('%d photos, %d near-duplicates', len(photos), len(photos) - len(ranks[0]))
+    if mode == 'skip':
+        return ranks[0]
+    return [photo for rank in ranks for photo in rank]
 
 
 #-------------------------------------------------------------------------------
@@ -590,36 +3764,235 @@ class LoopIter:
         return self.__next__()
 
 
+#-------------------------------------------------------------------------------
+def partitionRows(ratios, rowCount):
+    '''
+    Split the sequence of aspect ratios into rowCount rows of consecutive photos, so
+    that the sums of aspect ratios of the rows are as even as possible (linear
+    partition). Return list of row lengths.
+
+    Minimizes the sum of squared deviations of the rows from the mean, with dynamic
+    programming optimized by divide and conquer: O(rowCount * n * log(n)).
+    '''
+    n = len(ratios)
+    prefix = [0.0]
+    for ratio in ratios:
+        prefix.append(prefix[-1] + ratio)
+    target = prefix[-1] / rowCount
+    inf = float('inf')
+    # cost[j]: best cost of the first j photos in r rows, split[r][j]: start of last row
+    cost = [0.0] + [inf] * n
+    splits = []
+    for r in range(1, rowCount + 1):
+        newCost = [inf] * (n + 1)
+        split = [0] * (n + 1)
+
+        def solve(lo, hi, optLo, optHi):
+            '''Compute newCost[lo..hi], knowing optimal splits are in [optLo, optHi]'''
+            while lo <= hi:
+                mid = (lo + hi) // 2
+                best, bestSplit = inf, optLo
+                for i in range(optLo, min(mid - 1, optHi) + 1):
+                    value = cost[i] + (prefix[mid] - prefix[i] - target) ** 2
+                    if value < best:
+                        best, bestSplit = value, i
+                newCost[mid] = best
+                split[mid] = bestSplit
+                # Recurse on the smaller half, loop on the other one
+                if mid - lo < hi - mid:
+                    solve(lo, mid - 1, optLo, bestSplit)
+                    lo, optLo = mid + 1, bestSplit
+                else:
+                    solve(mid + 1, hi, bestSplit, optHi)
+                    hi, optHi = mid - 1, bestSplit
+
+        solve(r, n - (rowCount - r), r - 1, n - 1)
+        cost = newCost
+        splits.append(split)
+    # Backtrack
+    lengths = []
+    j = n
+    for r in range(rowCount - 1, -1, -1):
+        i = splits[r][j]
+        lengths.append(j - i)
+        j = i
+    return lengths[::-1]
+
+
+#-------------------------------------------------------------------------------
+def justifiedLayout(ratios, width, height):
+    '''
+    Return list of rects laying out photos of the given aspect ratios in justified
+    rows filling width x height. The number of rows is chosen so that rows need the
+    least vertical stretching, which is the only source of cropping.
+    '''
+    if not ratios:
+        return []
+    total = sum(ratios)
+    bestRows = 1
+    bestError = None
+    best = None
+    estimate = round(math.sqrt(total * height / width))
+    for rowCount in range(max(1, estimate - 1), min(len(ratios), estimate + 1) + 1):
+        lengths = partitionRows(ratios, rowCount)
+        # Height of each row when its photos are scaled to fill the width uncropped
+        rowHeights = []
+        start = 0
+        for length in lengths:
+            rowHeights.append(width / sum(ratios[start:start + length]))
+            start += length
+        error = abs(math.log(sum(rowHeights) / height))
+        if bestError is None or error < bestError:
+            bestRows, bestError, best = rowCount, error, (lengths, rowHeights)
+    logger.debug('justifiedLayout: %d photos, %d rows', len(ratios), bestRows)
+    lengths, rowHeights = best
+    # Stretch rows to fill height
+    stretch = height / sum(rowHeights)
+    rects = []
+    start = 0
+    y = 0.0
+    for length, rowHeight in zip(lengths, rowHeights):
+        top, bottom = round(y), round(y + rowHeight * stretch)
+        rowRatio = sum(ratios[start:start + length])
+        x = 0.0
+        for ratio in ratios[start:start + length]:
+            left, right = round(x), round(x + width * ratio / rowRatio)
+            rects.append(QRect(left, top, right - left, bottom - top))
+            x += width * ratio / rowRatio
+        y += rowHeight * stretch
+        start += length
+    return rects
+
+
+#-------------------------------------------------------------------------------
+def parseLayout(desc):
+    '''
+    Return (funcname, args) of the layout described by desc: one of the Layouts names,
+    or any 'Grid <columns>x<rows>', 'Columns <desc>' or 'Rows <desc>' description.
+    '''
+    for name, layout in Layouts:
+        if name == desc:
+            return layout
+    match = re.fullmatch(r'Grid (\d+)x(\d+)', desc)
+    if match:
+        return ('createGridCollage', (int(match.group(1)), int(match.group(2))))
+    match = re.fullmatch(r'(Columns|Rows) (\d+B?(/\d+B?)*)', desc)
+    if match:
+        funcname = 'createColumnCollage' if match.group(1) == 'Columns' else 'createRowCollage'
+        return (funcname, (match.group(2),))
+    raise ValueError('Invalid layout: %s' % desc)
+
+
+#-------------------------------------------------------------------------------
+def layoutPhotoCount(layout):
+    '''Return number of photos of layout (funcname, args), or None if it fits any number'''
+    funcname, args = layout
+    if funcname == 'createGridCollage':
+        return args[0] * args[1]
+    if funcname in ('createColumnCollage', 'createRowCollage'):
+        return sum(int(count.replace('B', '')) for count in args[0].split('/'))
+    return None
+
+
+#-------------------------------------------------------------------------------
+def setCollageAspectRatio(desc):
+    '''Set collage aspect ratio from a '<width>:<height>' description'''
+    global CollageAspect
+    global CollageAspectRatio
+    global CollageSize
+    width, height = [int(i) for i in desc.split(':')]
+    CollageAspect = desc
+    CollageAspectRatio = width / height
+    CollageSize = QRectF(0, 0, 2048, 2048 * (1 / CollageAspectRatio))
+
+
 #-------------------------------------------------------------------------------
 class PyView(QApplication):
     '''PyView class'''
 
     def __init__(self, argv):
-        '''Constructor. Parse args and build UI.'''
+        '''
+        Constructor. Parse args and build UI. The window is shown with empty frames, and
+        photos are loaded once it has been painted.
+        '''
+        created = time.perf_counter()
         super(PyView, self).__init__(argv)
+        # Startup steps: (name, time), time from StartTime
+        self.startupSteps = []
+        self.startupTimer = None
+        self.startupStep('imports', created)
+        self.startupStep('application')
         self.win = None
         self.scene = None
         self.gfxView = None
         self.layoutCombo = None
+        self.browser = None
+        self.browserAction = None
+        self.exporter = None
+        self.exportProgress = None
         self.appPath = os.path.abspath(os.path.dirname(argv[0]))
-        self.currentLayout = ('createColumnCollage', ('3/2B/3',))
+        # Room for the cached renderings of the photos and frame borders
+        QPixmapCache.setCacheLimit(ItemCacheSize // 1024)
+        self.currentLayout = parseLayout(CollageLayout)
+        # Description of the current layout, as in the layout combo box
+        self.layoutDesc = CollageLayout
         # Init GUI
         self.initUI()
+        # Queued: the painted window is flushed to the screen first
+        self.gfxView.firstPainted.connect(self.firstPaintHandler, Qt.QueuedConnection)
         self.win.show()
+        self.startupStep('window')
+        # In case the window isn't painted, e.g. started minimized
+        QTimer.singleShot(FirstPaintTimeout, self.scene.loadDeferredPhotos)
+
+    #-------------------------------------------------------
+    def startupStep(self, name, now=None):
+        '''
+        Record startup step name, ended at now (default: now), and log it with
+        --startup-profile
+        '''
+        elapsed = (now or time.perf_counter()) - StartTime
+        previous = self.startupSteps[-1][1] if self.startupSteps else 0.0
+        self.startupSteps.append((name, elapsed))
+        if StartupProfile:
+            logger.info('Startup: %-13s %6.1f ms (+%.1f ms)', name, 1000 * elapsed,
+                        1000 * (elapsed - previous))
+
+    #-------------------------------------------------------
+    def firstPaintHandler(self):
+        '''Load photos once the window with empty frames is on screen'''
+        self.startupStep('first paint')
+        self.scene.loadDeferredPhotos()
+        if StartupProfile:
+            # Wait for the photos of the initial collage
+            self.startupTimer = QTimer(self)
+            self.startupTimer.timeout.connect(self.checkPhotosLoaded)
+            self.startupTimer.start(10)
+
+    #-------------------------------------------------------
+    def checkPhotosLoaded(self):
+        '''Record startup step when the photos of the initial collage have been loaded'''
+        if imageLoader.pendingCount() or \
+           any(frame.photo.placeholder for frame in self.scene.frames):
+            return
+        self.startupTimer.stop()
+        self.startupStep('photos loaded')
 
     #-------------------------------------------------------
     def initUI(self):
         '''Init UI of the PyView application'''
-        # The QWidget widget is the base class of all user interface objects in PyQt5.
-        self.win = QWidget()
+        self.win = QMainWindow()
 
         # Set window title
         self.win.setWindowTitle("PyView")
         self.win.setWindowIcon(QIcon(os.path.join(self.appPath, 'icons', DefaultPhoto)))
         self.win.resize(800, 800 * round(1 / CollageAspectRatio))
 
+        # The QWidget widget is the base class of all user interface objects in PyQt5.
+        centralWidget = QWidget()
         vbox = QVBoxLayout()
-        self.win.setLayout(vbox)
+        centralWidget.setLayout(vbox)
+        self.win.setCentralWidget(centralWidget)
 
         # Add toolbar
         toolbar = QToolBar()
@@ -630,46 +4003,68 @@ class PyView(QApplication):
         toolbar.addAction(icon, 'New', getattr(self, 'newCollage'))
         icon = self.style().standardIcon(getattr(QStyle, 'SP_DialogSaveButton'))
         toolbar.addAction(icon, 'Save', getattr(self, 'saveCollage'))
+        icon = self.style().standardIcon(getattr(QStyle, 'SP_DialogOpenButton'))
+        toolbar.addAction(icon, 'Open project', getattr(self, 'openProject'))
+        icon = self.style().standardIcon(getattr(QStyle, 'SP_DriveFDIcon'))
+        toolbar.addAction(icon, 'Save project', getattr(self, 'saveProject'))
         # Layout combobox
         toolbar.addSeparator()
         label = QLabel('Layout: ')
         toolbar.addWidget(label)
         self.layoutCombo = QComboBox()
-        self.layoutCombo.addItem('Grid 2x2', ('createGridCollage', (2, 2)))
-        self.layoutCombo.addItem('Grid 3x3', ('createGridCollage', (3, 3)))
-        self.layoutCombo.addItem('Grid 3x4', ('createGridCollage', (3, 4)))
-        self.layoutCombo.addItem('Grid 4x3', ('createGridCollage', (4, 3)))
-        self.layoutCombo.addItem('Grid 4x4', ('createGridCollage', (4, 4)))
-        self.layoutCombo.addItem('Grid 5x5', ('createGridCollage', (5, 5)))
-        self.layoutCombo.addItem('Grid 7x1', ('createGridCollage', (7, 1)))
-        self.layoutCombo.addItem('Columns 1B/3', ('createColumnCollage', ('1B/3',)))
-        self.layoutCombo.addItem('Columns 2/2B/2', ('createColumnCollage', ('2/2B/2',)))
-        self.layoutCombo.addItem('Columns 3/1B/3', ('createColumnCollage', ('3/1B/3',)))
-        self.layoutCombo.addItem('Columns 3/2B/3', ('createColumnCollage', ('3/2B/3',)))
-        self.layoutCombo.addItem('Rows 1B/2/3/2B', ('createRowCollage', ('1B/2/3/2B',)))
-        self.layoutCombo.setCurrentIndex(8)
+        for name, layout in Layouts:
+            self.layoutCombo.addItem(name, layout)
+        if self.layoutCombo.findText(CollageLayout) < 0:
+            self.layoutCombo.addItem(CollageLayout, self.currentLayout)
+        self.layoutCombo.setCurrentIndex(self.layoutCombo.findText(CollageLayout))
         self.layoutCombo.currentIndexChanged[str].connect(self.layoutChangedHandler)
         toolbar.addWidget(self.layoutCombo)
         # Aspect ratio combobox
         label = QLabel('Aspect Ratio: ')
         toolbar.addWidget(label)
         self.aspectRatioCombo = QComboBox()
-        self.aspectRatioCombo.addItem('1:1')
-        self.aspectRatioCombo.insertSeparator(99)
-        self.aspectRatioCombo.addItem('3:2')
-        self.aspectRatioCombo.addItem('4:3')
-        self.aspectRatioCombo.addItem('16:9')
-        self.aspectRatioCombo.addItem('16:10')
-        self.aspectRatioCombo.insertSeparator(99)
-        self.aspectRatioCombo.addItem('2:3')
-        self.aspectRatioCombo.addItem('3:4')
-        self.aspectRatioCombo.setCurrentIndex(2)
+        for aspectRatio in AspectRatios:
+            if aspectRatio:
+                self.aspectRatioCombo.addItem(aspectRatio)
+            else:
+                self.aspectRatioCombo.insertSeparator(99)
+        if self.aspectRatioCombo.findText(CollageAspect) < 0:
+            self.aspectRatioCombo.addItem(CollageAspect)
+        self.aspectRatioCombo.setCurrentIndex(self.aspectRatioCombo.findText(CollageAspect))
         self.aspectRatioCombo.currentIndexChanged[str].connect(self.aspectRatioChangedHandler)
         toolbar.addWidget(self.aspectRatioCombo)
         # Frame color button
         toolbar.addSeparator()
         icon = QIcon(os.path.join(self.appPath, 'icons', 'frame-color.svg'))
         toolbar.addAction(icon, 'Choose frame color', getattr(self, 'setFrameColor'))
+        # Smart fit toggle
+        icon = self.style().standardIcon(getattr(QStyle, 'SP_FileDialogContentsView'))
+        action = toolbar.addAction(icon, 'Smart fit: keep subjects inside the frames')
+        action.setCheckable(True)
+        action.setChecked(SmartFit)
+        action.setEnabled(numpyAvailable())
+        action.toggled.connect(self.setSmartFit)
+
+        # Photo browser panel, hidden by default and created when first shown
+        icon = self.style().standardIcon(getattr(QStyle, 'SP_DirIcon'))
+        self.browserAction = toolbar.addAction(icon, 'Browse photos')
+        self.browserAction.setCheckable(True)
+        self.browserAction.toggled.connect(self.showBrowser)
+
+        # Background export, with its progress in the status bar
+        self.exporter = Exporter(self)
+        self.exporter.progressChanged.connect(self.exportProgressHandler)
+        self.exporter.finished.connect(self.exportFinishedHandler)
+        self.exportProgress = QProgressBar()
+        self.exportProgress.setMaximumWidth(200)
+        cancelButton = QToolButton()
+        cancelButton.setIcon(self.style().standardIcon(getattr(QStyle, 'SP_DialogCancelButton')))
+        cancelButton.setToolTip('Cancel export')
+        cancelButton.clicked.connect(self.cancelExport)
+        statusBar = self.win.statusBar()
+        statusBar.addPermanentWidget(self.exportProgress)
+        statusBar.addPermanentWidget(cancelButton)
+        statusBar.hide()
 
         # Create GraphicsView
         self.gfxView = ImageView()
@@ -679,29 +4074,31 @@ class PyView(QApplication):
 
         # Set OpenGL renderer
         if OpenGLRender:
+            from PyQt5.QtWidgets import QOpenGLWidget
             self.gfxView.setViewport(QOpenGLWidget())
 
         # Add scene
         self.scene = CollageScene()
+        self.scene.layoutRestored.connect(self.layoutRestoredHandler)
+        # Photos are loaded after the first paint of the window
+        self.scene.deferLoads()
 
         # Create initial collage
-        funcname, args = self.currentLayout
-        self.setLayout(funcname, *args)
+        if ProjectFileName:
+            self.openProject(ProjectFileName)
+        else:
+            funcname, args = self.currentLayout
+            self.setLayout(funcname, *args)
 
         self.gfxView.setScene(self.scene)
 
     #-------------------------------------------------------
     def setLayout(self, funcname, *args):
-        '''Set collage new layout'''
-        logger.debug('funcname=%s *args=%s', funcname, str(args))
-        # Clear all items from scene
-        self.scene.clear()
+        '''Set collage new layout, reusing the frames and photos already in the scene'''
+        logger.debug('funcname=%s *args=%s', funcname, args)
         # Create new collage
-        func = getattr(self, funcname)
-        if args:
-            func(self.scene, *args)
-        else:
-            func(self.scene)
+        func = getattr(self.scene, funcname)
+        func(*args)
 
     #-------------------------------------------------------
     def setDarkTheme(self, enabled):
@@ -728,90 +4125,46 @@ class PyView(QApplication):
         else:
             self.setPalette(self.style().standardPalette())
 
-    #-------------------------------------------------------
-    def createGridCollage(self, scene, numx, numy):
-        '''Create a collage with specified number of rows and columns'''
-        f = LoopIter(filenames)
-        photoWidth  = round(CollageSize.width() / numx)
-        photoHeight =  round(CollageSize.height() / numy)
-        for x in range(0, numx):
-            for y in range(0, numy):
-                scene.addPhoto(QRect(x * photoWidth, y * photoHeight, photoWidth, photoHeight), f.next())
-
-    #-------------------------------------------------------
-    def createColumnCollage(self, scene, desc):
-        '''Create a collage based on the string passed in'''
-        columns = desc.split('/')
-        # Calculate base width
-        # - Big photos are twice as wide as normal ones
-        baseWidth = round(CollageSize.width() / (len(columns) + desc.count('B')))
-        # Loop through all columns
-        f = LoopIter(filenames)
-        x = 0
-        for col in columns:
-            logger.debug('col=%s', col)
-            photoCount = int(col.replace('B', ''))
-            if 'B' in col:
-                photoWidth = baseWidth * 2
-            else:
-                photoWidth = baseWidth
-            photoHeight =  round(CollageSize.height() / photoCount)
-            for y in range(0, photoCount):
-                scene.addPhoto(QRect(x, y * photoHeight, photoWidth, photoHeight), f.next())
-            x += photoWidth
-
-    #-------------------------------------------------------
-    def createRowCollage(self, scene, desc):
-        '''Create a collage based on the string passed in'''
-        rows = desc.split('/')
-        # Calculate base height
-        # - Big photos are twice as high as normal ones
-        baseHeight = round(CollageSize.height() / (len(rows) + desc.count('B')))
-        # Loop through all columns
-        f = LoopIter(filenames)
-        y = 0
-        for row in rows:
-            logger.debug('row=%s', row)
-            photoCount = int(row.replace('B', ''))
-            if 'B' in row:
-                photoHeight = baseHeight * 2
-            else:
-                photoHeight = baseHeight
-            photoWidth =  round(CollageSize.width() / photoCount)
-            for x in range(0, photoCount):
-                scene.addPhoto(QRect(x * photoWidth, y, photoWidth, photoHeight), f.next())
-            y += photoHeight
-
     #-------------------------------------------------------
     def layoutChangedHandler(self, desc):
         '''Handler for layoutCombo signal'''
         global filenames
+        oldLayout = self.layoutDesc
+        snapshot = self.scene.history.snapshot()
         self.currentLayout = self.layoutCombo.currentData()
+        self.layoutDesc = desc
         # Save list of displayed photos
-        filenames = self.scene.getPhotosPaths()
+        filenames = self.scene.getPhotosPaths(parked=True)
         # Set new layout
         funcname, args = self.currentLayout
         self.setLayout(funcname, *args)
+        self.scene.history.recordLayout(oldLayout, snapshot, desc)
+
+    #-------------------------------------------------------
+    def layoutRestoredHandler(self, desc):
+        '''Update toolbar when a layout is restored by undo/redo'''
+        self.currentLayout = parseLayout(desc)
+        self.layoutDesc = desc
+        self.layoutCombo.blockSignals(True)
+        if self.layoutCombo.findText(desc) < 0:
+            self.layoutCombo.addItem(desc, self.currentLayout)
+        self.layoutCombo.setCurrentIndex(self.layoutCombo.findText(desc))
+        self.layoutCombo.blockSignals(False)
 
     #-------------------------------------------------------
     def aspectRatioChangedHandler(self, desc):
         '''Handler for aspectRatioCombo signal'''
-        global CollageAspectRatio
-        global CollageSize
         global filenames
-        width, height = [int(i) for i in desc.split(':')]
-        CollageAspectRatio = width / height
-        CollageSize = QRectF(0, 0, 2048, 2048 * (1 / CollageAspectRatio))
+        setCollageAspectRatio(desc)
         self.win.resize(self.win.width(), self.win.width() * round(1 / CollageAspectRatio))
         self.arWidget.setAspectRatio(CollageAspectRatio)
         # Save list of displayed photos
-        filenames = self.scene.getPhotosPaths()
-        # Clear scene
-        self.scene.clear()
-        # Re-create collage
+        filenames = self.scene.getPhotosPaths(parked=True)
+        # Relayout collage in place
+        self.scene.updateBackground()
         funcname, args = self.currentLayout
         self.setLayout(funcname, *args)
-        #self.gfxView.setScene(self.scene)
+        self.gfxView.fitInView(CollageSize, Qt.KeepAspectRatio)
 
     #-------------------------------------------------------
     def newCollage(self):
@@ -821,6 +4174,8 @@ class PyView(QApplication):
                                    'Are you sure you want to reset your collage?',
                                    defaultButton=QMessageBox.Yes)
         if ret == QMessageBox.Yes:
+            # Drop decoding requests of the previous collage
+            imageLoader.cancelAll()
             self.scene.clear()
             funcname, args = self.currentLayout
             self.setLayout(funcname, *args)
@@ -840,23 +4195,180 @@ class PyView(QApplication):
         if OutFileName:
             LastDirectory = os.path.dirname(OutFileName)
             self.win.setWindowTitle('PyView - %s' % OutFileName)
-            self.gfxView.save(OutFileName)
+            # Render and encode in the background, from a copy of the collage state
+            self.exporter.export(CollageSnapshot(self.scene),
+                                 exportOutputs(OutFileName, ExportFormats), ExportWidth, ExportDpi)
+
+    #-------------------------------------------------------
+    def exportProgressHandler(self, percent, message):
+        '''Display export progress'''
+        statusBar = self.win.statusBar()
+        statusBar.show()
+        statusBar.showMessage(message)
+        self.exportProgress.setValue(percent)
+
+    #-------------------------------------------------------
+    def exportFinishedHandler(self, ok, message):
+        '''Hide export progress, and report errors'''
+        self.win.statusBar().hide()
+        if not ok:
+            QMessageBox.warning(self.win, 'Save collage', message)
+
+    #-------------------------------------------------------
+    def cancelExport(self):
+        '''Cancel export in progress'''
+        self.exporter.cancel()
+        self.win.statusBar().hide()
+        logger.info('Export cancelled')
+
+    #-------------------------------------------------------
+    def openProject(self, filename=None):
+        '''Open project action handler'''
+        global LastDirectory
+        global ProjectFileName
+        global filenames
+        if not filename:
+            if not LastDirectory:
+                LastDirectory = os.getcwd()
+            filename, filetype = QFileDialog.getOpenFileName(None, 'Open Project', LastDirectory,
+                                                             ProjectFileFilter)
+        if not filename:
+            return
+        desc = self.scene.loadProject(filename)
+        if desc is None:
+            QMessageBox.warning(self.win, 'Open project', 'Failed to open project: %s' % filename)
+            return
+        ProjectFileName = filename
+        LastDirectory = os.path.dirname(filename)
+        filenames = self.scene.getPhotosPaths()
+        # Update toolbar without triggering a new layout
+        try:
+            self.currentLayout = parseLayout(desc)
+            self.layoutDesc = desc
+        except ValueError:
+            desc = None
+        for combo, text in ((self.layoutCombo, desc), (self.aspectRatioCombo, CollageAspect)):
+            if text is None:
+                continue
+            combo.blockSignals(True)
+            if combo.findText(text) < 0:
+                combo.addItem(text, self.currentLayout if combo is self.layoutCombo else None)
+            combo.setCurrentIndex(combo.findText(text))
+            combo.blockSignals(False)
+        self.arWidget.setAspectRatio(CollageAspectRatio)
+        self.gfxView.setBackgroundBrush(QBrush(FrameColor))
+        self.gfxView.fitInView(CollageSize, Qt.KeepAspectRatio)
+        self.win.setWindowTitle('PyView - %s' % filename)
+
+    #-------------------------------------------------------
+    def saveProject(self):
+        '''Save project action handler'''
+        global LastDirectory
+        global ProjectFileName
+        filename = ProjectFileName
+        if not filename:
+            if not LastDirectory:
+                LastDirectory = os.getcwd()
+            filename, filetype = QFileDialog.getSaveFileName(None, 'Save Project', LastDirectory,
+                                                             ProjectFileFilter)
+            if not filename:
+                return
+            if not os.path.splitext(filename)[1]:
+                filename += '.pyview'
+        if self.scene.saveProject(filename, self.layoutCombo.currentText()):
+            ProjectFileName = filename
+            LastDirectory = os.path.dirname(filename)
+            self.win.setWindowTitle('PyView - %s' % filename)
 
     #-------------------------------------------------------
     def setFrameColor(self):
         '''Set color of the photo frames'''
         global FrameColor
+        from PyQt5.QtWidgets import QColorDialog
         FrameColor = QColorDialog.getColor()
         self.gfxView.setBackgroundBrush(QBrush(FrameColor))
+        self.scene.updateFrames()
+
+    #-------------------------------------------------------
+    def showBrowser(self, visible):
+        '''Show or hide the photo browser panel'''
+        if self.browser is None:
+            if not visible:
+                return
+            self.browser = PhotoBrowser(imageLoader, self.win)
+            self.win.addDockWidget(Qt.LeftDockWidgetArea, self.browser)
+            # Panel may also be closed by its own button
+            self.browser.toggleViewAction().toggled.connect(self.browserAction.setChecked)
+            self.browser.setDirectory(os.path.dirname(filenames[0]) if filenames else os.getcwd())
+        self.browser.setVisible(visible)
+
+    #-------------------------------------------------------
+    def setSmartFit(self, enabled):
+        '''Enable or disable smart fit, and fit photos again'''
+        global SmartFit
+        SmartFit = enabled
+        self.scene.fitPhotos()
+        if SmartFit:
+            self.scene.loadSaliency()
 
 
 #-------------------------------------------------------------------------------
 def usage():
     '''Display usage of the application'''
     print('Usage: ' +  os.path.basename(sys.argv[0]) + \
-          ' [image1...imageN]')
+          ' [options] [image1...imageN | project.pyview]')
     print("\nOptions:\n")
     print("  -h         This help message")
+    print("  -D         Debug logging")
+    print("  --trace=FILE")
+    print("             Record load, decode, layout, paint and save spans to FILE,")
+    print("             in Chrome trace-event format (chrome://tracing, Perfetto)")
+    print("  --layout=LAYOUT")
+    print("             Collage layout, e.g. 'Grid 3x3', 'Columns 3/2B/3', 'Rows 1B/2/3/2B'")
+    print("  --aspect=W:H")
+    print("             Collage aspect ratio, e.g. 16:9")
+    print("  --output=FILE")
+    print("             Render collage to FILE without opening a window, and exit")
+    print("  --width=PX Width in pixels of the saved collage (default: %d)" %
+          CollageSize.width())
+    print("  --dpi=DPI  Resolution stored in the saved collage")
+    print("  --formats=FORMAT[:QUALITY],...")
+    print("             Save collage in several formats encoded in parallel, e.g.")
+    print("             jpg:95,jpg:80,png saves out-q95.jpg, out-q80.jpg and out.png")
+    print("  --batch=SOURCE")
+    print("             Render collages of all the photos of SOURCE, a directory or a")
+    print("             manifest file listing one photo per line, and exit. --output is")
+    print("             the output directory, or a filename pattern like out/%03d.png.")
+    print("             Collages already rendered by an interrupted run are skipped.")
+    print("  --per-collage=N")
+    print("             Number of photos per collage in batch mode (default: number of")
+    print("             photos of the layout)")
+    print("  --jobs=N   Number of processes rendering collages in batch mode")
+    print("             (default: number of CPUs)")
+    print("  --smart-fit")
+    print("             Fit photos so that their subjects stay inside the frames (needs NumPy)")
+    print("  --duplicates=MODE")
+    print("             Near-duplicate photos (e.g. burst shots): 'skip' keeps the first photo")
+    print("             of each group, 'spread' places the others after all the distinct")
+    print("             photos (needs NumPy)")
+    print("  --duplicate-distance=BITS")
+    print("             Maximum number of different bits of the perceptual hashes of")
+    print("             near-duplicate photos, out of 64 (default: %d)" % DuplicateDistance)
+    print("  --startup-profile")
+    print("             Log time to first paint of the window and to photos loaded")
+    print("  --no-proxy Always load photos at full resolution")
+    print("  --cache-size=MB")
+    print("             Memory budget of the decoded images cache (default: %d MB)" %
+          (PixmapCacheSize // OneMB))
+    print("  --thumbnail-cache-size=MB")
+    print("             Disk space of the persistent thumbnails in %s (default: %d MB)" %
+          (ThumbnailCacheDir, ThumbnailCacheSize // OneMB))
+    print("  --no-thumbnail-cache")
+    print("             Don't read nor write persistent thumbnails")
+    print("  --memory-budget=MB")
+    print("             Memory ceiling of all the decoded images, photos beyond are")
+    print("             downgraded to low resolution (default: %d MB)" %
+          (PixmapMemoryBudget // OneMB))
     print("\nCommands:\n")
     for cmd, desc in HelpCommands:
         print('  %-16s  %s' % (cmd, desc))
@@ -865,8 +4377,30 @@ def usage():
 #-------------------------------------------------------------------------------
 def parse_args():
     '''Parse application arguments. Build list of filenames.'''
+    global ProxyMode
+    global CollageLayout
+    global OutFileName
+    global Headless
+    global ExportWidth
+    global ExportDpi
+    global ProjectFileName
+    global TraceFileName
+    global ExportFormats
+    global BatchSource
+    global BatchPhotoCount
+    global BatchJobs
+    global SmartFit
+    global DuplicateMode
+    global DuplicateDistance
+    global StartupProfile
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'Dh', ['help'])
+        opts, args = getopt.getopt(sys.argv[1:], 'Dh', ['help', 'cache-size=', 'memory-budget=',
+                                                      'thumbnail-cache-size=', 'no-thumbnail-cache',
+                                                      'no-proxy', 'layout=', 'aspect=', 'output=',
+                                                      'width=', 'dpi=', 'formats=', 'trace=',
+                                                      'batch=', 'per-collage=', 'jobs=',
+                                                      'smart-fit', 'duplicates=',
+                                                      'duplicate-distance=', 'startup-profile'])
     except getopt.GetoptError as err:
         logger.error(str(err))
         usage()
@@ -878,14 +4412,378 @@ def parse_args():
             sys.exit(0)
         elif o == '-D':
             logger.setLevel(logging.DEBUG)
+        elif o == '--trace':
+            TraceFileName = os.path.abspath(a)
+            tracer.enable(TraceFileName)
+        elif o == '--layout':
+            try:
+                parseLayout(a)
+            except ValueError as err:
+                logger.error(str(err))
+                sys.exit(1)
+            CollageLayout = a
+        elif o == '--aspect':
+            try:
+                setCollageAspectRatio(a)
+            except (ValueError, ZeroDivisionError):
+                logger.error('Invalid aspect ratio: %s', a)
+                sys.exit(1)
+        elif o == '--output':
+            OutFileName = os.path.abspath(a)
+            Headless = True
+        elif o == '--width':
+            try:
+                ExportWidth = int(a)
+            except ValueError:
+                ExportWidth = 0
+            if ExportWidth <= 0:
+                logger.error('Invalid width: %s', a)
+                sys.exit(1)
+        elif o == '--dpi':
+            try:
+                ExportDpi = float(a)
+            except ValueError:
+                ExportDpi = 0
+            if ExportDpi <= 0:
+                logger.error('Invalid resolution: %s', a)
+                sys.exit(1)
+        elif o == '--formats':
+            try:
+                ExportFormats = parseFormats(a)
+            except ValueError as err:
+                logger.error(str(err))
+                sys.exit(1)
+        elif o == '--batch':
+            BatchSource = os.path.abspath(a)
+        elif o == '--per-collage':
+            try:
+                BatchPhotoCount = int(a)
+            except ValueError:
+                BatchPhotoCount = 0
+            if BatchPhotoCount <= 0:
+                logger.error('Invalid number of photos per collage: %s', a)
+                sys.exit(1)
+        elif o == '--jobs':
+            try:
+                BatchJobs = int(a)
+            except ValueError:
+                BatchJobs = 0
+            if BatchJobs <= 0:
+                logger.error('Invalid number of jobs: %s', a)
+                sys.exit(1)
+        elif o == '--smart-fit':
+            if not numpyAvailable():
+                logger.error('Smart fit needs NumPy')
+                sys.exit(1)
+            SmartFit = True
+        elif o == '--duplicates':
+            if a not in ('skip', 'spread'):
+                logger.error('Invalid near-duplicates mode: %s', a)
+                sys.exit(1)
+            if not numpyAvailable():
+                logger.error('Finding near-duplicate photos needs NumPy')
+                sys.exit(1)
+            DuplicateMode = a
+        elif o == '--duplicate-distance':
+            try:
+                DuplicateDistance = int(a)
+            except ValueError:
+                DuplicateDistance = -1
+            if not 0 <= DuplicateDistance <= 8:
+                logger.error('Invalid near-duplicate distance: %s', a)
+                sys.exit(1)
+        elif o == '--startup-profile':
+            StartupProfile = True
+        elif o == '--no-proxy':
+            ProxyMode = False
+        elif o == '--cache-size':
+            try:
+                pixmapCache.setMaxBytes(int(float(a) * OneMB))
+            except ValueError:
+                logger.error('Invalid cache size: %s', a)
+                sys.exit(1)
+        elif o == '--thumbnail-cache-size':
+            try:
+                thumbnailStore.maxBytes = int(float(a) * OneMB)
+            except ValueError:
+                logger.error('Invalid thumbnail cache size: %s', a)
+                sys.exit(1)
+        elif o == '--no-thumbnail-cache':
+            thumbnailStore.enabled = False
+        elif o == '--memory-budget':
+            try:
+                memoryManager.setMaxBytes(int(float(a) * OneMB))
+            except ValueError:
+                logger.error('Invalid memory budget: %s', a)
+                sys.exit(1)
 
-    if args:
+    if len(args) == 1 and args[0].endswith('.pyview'):
+        ProjectFileName = os.path.abspath(args[0])
+    elif args:
         for f in args:
             filenames.append(os.path.abspath(f))
-            logger.debug(str(filenames))
+        logger.debug('filenames=%s', filenames)
     else:
         appPath = os.path.abspath(os.path.dirname(sys.argv[0]))
         filenames.append(os.path.join(appPath, 'icons', DefaultPhoto))
+    if DuplicateMode and len(filenames) > 1:
+        filenames[:] = arrangeDuplicates(filenames, DuplicateMode)
+
+
+#-------------------------------------------------------------------------------
+def parseFormats(desc):
+    '''Return list of (format, quality) of a 'FORMAT[:QUALITY],...' description'''
+    supported = [bytes(fmt).decode('ascii') for fmt in QImageWriter.supportedImageFormats()]
+    formats = []
+    for item in desc.split(','):
+        fmt, sep, quality = item.strip().lower().partition(':')
+        if fmt not in supported:
+            raise ValueError('Unsupported format: %s' % fmt)
+        try:
+            quality = int(quality) if sep else -1
+        except ValueError:
+            quality = None
+        if quality is None or quality > 100 or (sep and quality < 0):
+            raise ValueError('Invalid quality: %s' % item)
+        formats.append((fmt, quality))
+    return formats
+
+
+#-------------------------------------------------------------------------------
+def renderCollage():
+    '''Render collage to OutFileName without creating any window. Return exit status.'''
+    os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+    qapp = QApplication(sys.argv[:1])
+    scene = CollageScene()
+    if ProjectFileName:
+        if scene.loadProject(ProjectFileName) is None:
+            return 1
+    else:
+        funcname, args = parseLayout(CollageLayout)
+        getattr(scene, funcname)(*args)
+    imageLoader.waitForDone()
+    ok = exportSnapshot(CollageSnapshot(scene), exportOutputs(OutFileName, ExportFormats),
+                        ExportWidth, ExportDpi)
+    ret = 0 if ok else 1
+    # Delete scene before the application object
+    del scene
+    del qapp
+    return ret
+
+
+#-------------------------------------------------------------------------------
+def batchPhotos(source):
+    '''
+    Return list of photos of source: the photos of a directory sorted by name, or the
+    paths listed in a manifest file, one per line, relative to the manifest directory.
+    '''
+    if os.path.isdir(source):
+        with os.scandir(source) as it:
+            return sorted(entry.path for entry in it
+                          if not entry.name.startswith('.') and entry.is_file() and
+                          entry.name.lower().endswith(ImageExtensions))
+    directory = os.path.dirname(source)
+    photos = []
+    with open(source, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                photos.append(os.path.join(directory, os.path.expanduser(line)))
+    return photos
+
+
+#-------------------------------------------------------------------------------
+def batchJobs(photos, photoCount, pattern):
+    '''
+    Split photos in consecutive groups of photoCount photos, one per collage, and return
+    list of jobs (index, filename, photos, signature). The signature identifies the
+    photos (path, mtime and size) and the rendering settings of the collage.
+    '''
+    jobs = []
+    for i in range(0, len(photos), photoCount):
+        index = i // photoCount + 1
+        group = photos[i:i + photoCount]
+        desc = [CollageLayout, CollageAspect, ExportWidth, ExportDpi,
+                [PixmapCache.key(photo) for photo in group]]
+        if SmartFit:
+            desc.append('smart-fit')
+        signature = hashlib.md5(json.dumps(desc).encode('utf-8')).hexdigest()
+        jobs.append((index, pattern % index, group, signature))
+    return jobs
+
+
+#-------------------------------------------------------------------------------
+def readBatchJournal(filename):
+    '''Return dict filename -> signature of the collages rendered by previous batch runs'''
+    done = {}
+    try:
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    done[entry['filename']] = entry['signature']
+                except (ValueError, KeyError, TypeError):
+                    # Line truncated by an interrupted run
+                    continue
+    except OSError:
+        pass
+    return done
+
+
+#-------------------------------------------------------------------------------
+def batchInit(settings):
+    '''Initialize batch worker process with the settings of the parent process'''
+    global app
+    global CollageLayout
+    global ExportWidth
+    global ExportDpi
+    global SmartFit
+    os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+    # Progress is reported by the parent process
+    logger.setLevel(settings['logLevel'])
+    CollageLayout = settings['layout']
+    setCollageAspectRatio(settings['aspect'])
+    ExportWidth = settings['width']
+    ExportDpi = settings['dpi']
+    SmartFit = settings['smartFit']
+    thumbnailStore.enabled = False
+    pixmapCache.setMaxBytes(settings['cacheSize'])
+    # Don't oversubscribe the CPUs: processes already decode in parallel
+    imageLoader.pool.setMaxThreadCount(settings['threads'])
+    app = QApplication(sys.argv[:1])
+
+
+#-------------------------------------------------------------------------------
+def batchRender(job):
+    '''Render collage of job in a worker process. Return (index, ok, photo count, duration).'''
+    global filenames
+    index, filename, photos, _ = job
+    start = time.perf_counter()
+    try:
+        filenames = list(photos)
+        scene = CollageScene()
+        funcname, args = parseLayout(CollageLayout)
+        getattr(scene, funcname)(*args)
+        imageLoader.waitForDone()
+        # Photos that couldn't be decoded are still displayed as placeholders
+        failed = [frame.photo.filename for frame in scene.frames
+                  if frame.photo is not None and frame.photo.placeholder]
+        if failed:
+            logger.error('Failed to load photos of %s: %s', filename, ', '.join(failed))
+            ok = False
+        else:
+            ok = exportSnapshot(CollageSnapshot(scene), exportOutputs(filename),
+                                ExportWidth, ExportDpi)
+        # The undo history references the scene, which is only freed by the garbage
+        # collector: delete its items now, not in the middle of the next collage
+        scene.clear()
+        del scene
+    except Exception:
+        # Report the failure of this collage, instead of stopping the whole batch
+        logger.exception('Failed to render %s', filename)
+        ok = False
+    finally:
+        # Next collage has other photos
+        pixmapCache.clear()
+    return (index, ok, len(photos), time.perf_counter() - start)
+
+
+#-------------------------------------------------------------------------------
+def renderBatch():
+    '''
+    Render collages of the photos of BatchSource, BatchPhotoCount photos each, with a pool
+    of BatchJobs processes. Collages rendered by a previous run with the same photos and
+    settings are skipped. Return exit status.
+    '''
+    layout = parseLayout(CollageLayout)
+    photoCount = BatchPhotoCount or layoutPhotoCount(layout)
+    if not photoCount:
+        logger.error('--per-collage is required with layout %s', CollageLayout)
+        return 1
+    if not OutFileName:
+        logger.error('--batch requires --output')
+        return 1
+    pattern = OutFileName
+    if '%' not in os.path.basename(pattern):
+        pattern = os.path.join(pattern, BatchOutputName)
+    try:
+        pattern % 1
+    except (TypeError, ValueError):
+        logger.error('Invalid output filename pattern: %s', pattern)
+        return 1
+    try:
+        photos = batchPhotos(BatchSource)
+    except OSError as err:
+        logger.error(str(err))
+        return 1
+    if DuplicateMode:
+        photos = arrangeDuplicates(photos, DuplicateMode)
+    if not photos:
+        logger.error('No photos in %s', BatchSource)
+        return 1
+
+    journalFilename = os.path.join(os.path.dirname(pattern % 1), BatchJournalName)
+    done = readBatchJournal(journalFilename)
+    jobs = []
+    skipped = 0
+    for job in batchJobs(photos, photoCount, pattern):
+        if done.get(job[1]) == job[3] and os.path.exists(job[1]):
+            skipped += 1
+        else:
+            jobs.append(job)
+    processCount = min(BatchJobs or os.cpu_count() or 1, len(jobs))
+    logger.info('Batch: %d photos, %d collages of %d photos, %d already rendered, %d processes',
+                len(photos), len(jobs) + skipped, photoCount, skipped, processCount)
+
+    rendered = failed = renderedPhotos = 0
+    busyTime = 0.0
+    start = time.perf_counter()
+    if jobs:
+        try:
+            for directory in set(os.path.dirname(job[1]) for job in jobs):
+                os.makedirs(directory, exist_ok=True)
+            journal = open(journalFilename, 'a', encoding='utf-8')
+        except OSError as err:
+            logger.error(str(err))
+            return 1
+        settings = {
+            'logLevel': logging.DEBUG if logger.isEnabledFor(logging.DEBUG) else logging.WARNING,
+            'layout': CollageLayout,
+            'aspect': CollageAspect,
+            'width': ExportWidth,
+            'dpi': ExportDpi,
+            'smartFit': SmartFit,
+            'cacheSize': pixmapCache.maxBytes,
+            'threads': max(1, (os.cpu_count() or 1) // processCount),
+        }
+        jobsByIndex = {job[0]: job for job in jobs}
+        # Spawned processes don't inherit the Qt state of this one
+        import multiprocessing
+        context = multiprocessing.get_context('spawn')
+        with journal, context.Pool(processCount, batchInit, (settings,)) as pool:
+            for index, ok, count, duration in pool.imap_unordered(batchRender, jobs):
+                filename, signature = jobsByIndex[index][1], jobsByIndex[index][3]
+                busyTime += duration
+                if ok:
+                    rendered += 1
+                    renderedPhotos += count
+                    journal.write(json.dumps({'filename': filename, 'signature': signature}) + '\n')
+                    journal.flush()
+                else:
+                    failed += 1
+                logger.info('[%d/%d] %s: %d photos, %.2f s', rendered + failed, len(jobs),
+                            os.path.basename(filename), count, duration)
+
+    elapsed = time.perf_counter() - start
+    if rendered:
+        logger.info('Batch: %d collages (%d photos) in %.1f s: %.2f collages/s, %.1f photos/s, '
+                    '%d processes %.0f%% busy', rendered, renderedPhotos, elapsed,
+                    rendered / elapsed, renderedPhotos / elapsed, processCount,
+                    100 * busyTime / (elapsed * processCount))
+    if failed:
+        logger.error('Batch: %d collages failed', failed)
+        return 1
+    return 0
 
 
 #-------------------------------------------------------------------------------
@@ -894,12 +4792,31 @@ def main():
     global app
     parse_args()
 
+    if BatchSource:
+        ret = renderBatch()
+        tracer.write()
+        sys.exit(ret)
+
+    if Headless:
+        ret = renderCollage()
+        tracer.write()
+        sys.exit(ret)
+
     # Quit application on Ctrl+C
     # https://stackoverflow.com/questions/5160577/ctrl-c-doesnt-work-with-pyqt
     signal.signal(signal.SIGINT, signal.SIG_DFL)
 
     app = PyView(sys.argv)
-    sys.exit(app.exec_())
+    ret = app.exec_()
+    # Don't let workers outlive the application
+    imageLoader.cancelAll()
+    imageLoader.pool.waitForDone()
+    app.exporter.cancel()
+    app.exporter.pool.waitForDone()
+    logger.debug('%s', pixmapCache)
+    logger.debug('%s', memoryManager)
+    tracer.write()
+    sys.exit(ret)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,406 @@
+#! /usr/bin/env python3
+
+'''
+PyView performance benchmarks
+
+Run with Qt offscreen platform on synthetic JPEG/PNG photos generated once in a
+directory, and write the timings in JSON so that results of two commits can be
+compared:
+
+    tools/benchmark.py --output before.json
+    (change code)
+    tools/benchmark.py --output after.json --compare before.json
+
+-*- coding: utf-8 -*-
+'''
+
+import functools
+import getopt
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyview
+
+from PyQt5.QtGui import QPainter, QImage, QColor, QLinearGradient
+from PyQt5.QtCore import Qt, QCoreApplication, QPointF, QRectF, QT_VERSION_STR, PYQT_VERSION_STR
+
+# Photo sizes, in megapixels
+Sizes = [1, 12, 24, 50]
+# Grids NxN
+Grids = [2, 3, 4, 5, 6, 7, 8, 9, 10]
+Formats = ['jpg']
+# Number of distinct photos generated per size and format: bigger collages reuse them
+DistinctPhotos = 8
+Repeat = 3
+# Grid used for the export benchmarks
+ExportGrid = 3
+ImageDir = os.path.join(tempfile.gettempdir(), 'pyview-benchmark')
+OutFileName = 'benchmark.json'
+CompareFileName = None
+Benchmarks = ['decode', 'grid', 'layouts', 'relayout', 'paint', 'export']
+
+# Seed of the synthetic photos content
+Seed = 1234
+AspectRatio = 3.0 / 2.0
+
+app = None
+
+
+#-------------------------------------------------------------------------------
+def photoSize(megapixels):
+    '''Return (width, height) of a 3:2 photo of megapixels'''
+    height = int((megapixels * 1000000 / AspectRatio) ** 0.5)
+    return (int(height * AspectRatio), height)
+
+
+#-------------------------------------------------------------------------------
+def generatePhoto(filename, megapixels, index):
+    '''Generate a synthetic photo: gradient background plus random shapes'''
+    width, height = photoSize(megapixels)
+    rand = random.Random(Seed + index)
+    image = QImage(width, height, QImage.Format_RGB32)
+    painter = QPainter(image)
+    painter.setRenderHint(QPainter.Antialiasing)
+    gradient = QLinearGradient(QPointF(0, 0), QPointF(width, height))
+    gradient.setColorAt(0, QColor.fromHsv(rand.randrange(360), 200, 220))
+    gradient.setColorAt(1, QColor.fromHsv(rand.randrange(360), 200, 80))
+    painter.fillRect(image.rect(), gradient)
+    painter.setPen(Qt.NoPen)
+    for _ in range(200):
+        painter.setBrush(QColor.fromHsv(rand.randrange(360), rand.randrange(256),
+                                        rand.randrange(256), rand.randrange(64, 256)))
+        size = rand.uniform(0.01, 0.2) * width
+        painter.drawEllipse(QRectF(rand.uniform(0, width), rand.uniform(0, height),
+                                   size, size * rand.uniform(0.3, 1.5)))
+    painter.end()
+    if not image.save(filename, quality=90):
+        raise OSError('Failed to save %s' % filename)
+
+
+#-------------------------------------------------------------------------------
+def getPhotos(megapixels, fmt, count=DistinctPhotos):
+    '''Return list of count synthetic photos, generating those not already in ImageDir'''
+    os.makedirs(ImageDir, exist_ok=True)
+    photos = []
+    for i in range(count):
+        filename = os.path.join(ImageDir, 'photo-%dmp-%d-%d.%s' % (megapixels, Seed, i, fmt))
+        if not os.path.exists(filename):
+            print('Generating %s' % filename)
+            generatePhoto(filename, megapixels, i)
+        photos.append(filename)
+    return photos
+
+
+#-------------------------------------------------------------------------------
+def clearCaches():
+    '''Forget all decoded images so that the next load decodes them again'''
+    pyview.imageLoader.waitForDone()
+    pyview.pixmapCache.clear()
+    pyview.imageSizes.clear()
+    pyview.imageOrientations.clear()
+
+
+#-------------------------------------------------------------------------------
+def setPhotos(photos, count):
+    '''Set photos used by the next layouts: count photos, cycling through photos'''
+    pyview.filenames[:] = [photos[i % len(photos)] for i in range(count)]
+
+
+#-------------------------------------------------------------------------------
+def newScene():
+    '''Replace scene of the application with an empty one'''
+    pyview.imageLoader.cancelAll()
+    pyview.imageLoader.waitForDone()
+    app.scene.clear()
+    QCoreApplication.processEvents()
+
+
+#-------------------------------------------------------------------------------
+def measure(results, name, params, func, setup=None):
+    '''Run func Repeat times, after setup if any, and append timings to results'''
+    times = []
+    for _ in range(Repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    result = {'name': name, 'params': params, 'times': times,
+              'median': times[len(times) // 2], 'min': times[0]}
+    results.append(result)
+    print('%-60s %10.2f ms' % (resultKey(result), result['median'] * 1000))
+
+
+#-------------------------------------------------------------------------------
+def resultKey(result):
+    '''Return string identifying a result: benchmark name and parameters'''
+    params = ' '.join('%s=%s' % (key, result['params'][key]) for key in sorted(result['params']))
+    return '%s %s' % (result['name'], params)
+
+
+#-------------------------------------------------------------------------------
+def loadAndWait(func, *args):
+    '''Return function calling func(*args) and waiting for photos to be decoded'''
+    def run():
+        func(*args)
+        pyview.imageLoader.waitForDone()
+    return run
+
+
+#-------------------------------------------------------------------------------
+def benchDecode(results):
+    '''CollageScene.addPhoto of one photo, until decoded, cold cache'''
+    for fmt in Formats:
+        for megapixels in Sizes:
+            photos = getPhotos(megapixels, fmt, 1)
+            rect = pyview.CollageSize.toRect()
+            def setup():
+                newScene()
+                clearCaches()
+            measure(results, 'addPhoto', {'mp': megapixels, 'format': fmt},
+                    loadAndWait(app.scene.addPhoto, rect, photos[0]), setup)
+
+
+#-------------------------------------------------------------------------------
+def benchGrid(results):
+    '''createGridCollage() from an empty scene, cold and warm cache'''
+    for fmt in Formats:
+        for megapixels in Sizes:
+            photos = getPhotos(megapixels, fmt)
+            for n in Grids:
+                params = {'mp': megapixels, 'format': fmt, 'grid': '%dx%d' % (n, n)}
+                setPhotos(photos, n * n)
+                def setup():
+                    newScene()
+                    clearCaches()
+                measure(results, 'createGridCollage-cold', params,
+                        loadAndWait(app.scene.createGridCollage, n, n), setup)
+                measure(results, 'createGridCollage-warm', params,
+                        loadAndWait(app.scene.createGridCollage, n, n), newScene)
+
+
+#-------------------------------------------------------------------------------
+def benchLayouts(results):
+    '''Each predefined layout from an empty scene. Proxies are decoded on the first run only.'''
+    photos = getPhotos(Sizes[0], Formats[0])
+    setPhotos(photos, max(Grids) ** 2)
+    for name, (funcname, args) in pyview.Layouts:
+        func = getattr(app.scene, funcname)
+        measure(results, funcname, {'mp': Sizes[0], 'layout': name},
+                loadAndWait(func, *args), newScene)
+
+
+#-------------------------------------------------------------------------------
+def benchRelayout(results):
+    '''layoutChangedHandler() and aspectRatioChangedHandler() on a populated collage'''
+    combos = ((app.layoutCombo, 'layoutChangedHandler'),
+              (app.aspectRatioCombo, 'aspectRatioChangedHandler'))
+    for megapixels in Sizes:
+        photos = getPhotos(megapixels, Formats[0])
+        newScene()
+        setPhotos(photos, max(Grids) ** 2)
+        app.scene.createGridCollage(5, 5)
+        pyview.imageLoader.waitForDone()
+        for combo, name in combos:
+            indexes = [i for i in range(combo.count()) if combo.itemText(i)]
+            for i, index in enumerate(indexes):
+                fromIndex = indexes[i - 1]
+                measure(results, name, {'mp': megapixels, 'from': combo.itemText(fromIndex),
+                                        'to': combo.itemText(index)},
+                        loadAndWait(combo.setCurrentIndex, index),
+                        loadAndWait(combo.setCurrentIndex, fromIndex))
+        app.aspectRatioCombo.setCurrentIndex(app.aspectRatioCombo.findText('3:2'))
+
+
+#-------------------------------------------------------------------------------
+def benchPaint(results):
+    '''Full paint of the view, and rendering of the whole scene in an image'''
+    photos = getPhotos(Sizes[0], Formats[0])
+    view = app.gfxView
+    def render(image):
+        painter = QPainter(image)
+        painter.setRenderHints(view.renderHints())
+        app.scene.render(painter, QRectF(image.rect()), pyview.CollageSize)
+        painter.end()
+    for n in Grids:
+        newScene()
+        setPhotos(photos, n * n)
+        app.scene.createGridCollage(n, n)
+        pyview.imageLoader.waitForDone()
+        QCoreApplication.processEvents()
+        params = {'mp': Sizes[0], 'grid': '%dx%d' % (n, n)}
+        measure(results, 'viewportRepaint', params, view.viewport().repaint)
+        image = QImage(view.viewport().size(), QImage.Format_RGB32)
+        measure(results, 'sceneRender', params, functools.partial(render, image))
+
+
+#-------------------------------------------------------------------------------
+def benchExport(results):
+    '''Export of a grid collage by the Exporter, in PNG and JPEG'''
+    outDir = tempfile.mkdtemp(prefix='pyview-export-')
+    exporter = pyview.Exporter()
+    def export(filename):
+        exporter.export(pyview.CollageSnapshot(app.scene), pyview.exportOutputs(filename),
+                        pyview.ExportWidth, pyview.ExportDpi)
+        exporter.waitForDone()
+    for megapixels in Sizes:
+        photos = getPhotos(megapixels, Formats[0])
+        newScene()
+        setPhotos(photos, ExportGrid * ExportGrid)
+        app.scene.createGridCollage(ExportGrid, ExportGrid)
+        pyview.imageLoader.waitForDone()
+        for fmt in ('png', 'jpg'):
+            filename = os.path.join(outDir, 'collage.%s' % fmt)
+            params = {'mp': megapixels, 'format': fmt,
+                      'grid': '%dx%d' % (ExportGrid, ExportGrid),
+                      'width': pyview.ExportWidth or int(pyview.CollageSize.width())}
+            measure(results, 'save', params, functools.partial(export, filename))
+            os.remove(filename)
+    os.rmdir(outDir)
+
+
+#-------------------------------------------------------------------------------
+def gitRevision():
+    '''Return revision of the source tree, or None'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+#-------------------------------------------------------------------------------
+def compare(results, filename):
+    '''Print median of results next to the ones of a previous run'''
+    with open(filename) as f:
+        previous = {resultKey(result): result for result in json.load(f)['results']}
+    print('\n%-60s %10s %10s %8s' % ('Benchmark (vs %s)' % os.path.basename(filename),
+                                     'Before ms', 'After ms', 'Ratio'))
+    for result in results:
+        before = previous.get(resultKey(result))
+        if before is None:
+            continue
+        ratio = result['median'] / before['median'] if before['median'] else 0
+        print('%-60s %10.2f %10.2f %7.2fx%s' % (resultKey(result), before['median'] * 1000,
+                                               result['median'] * 1000, ratio,
+                                               '  <--' if ratio > 1.1 else ''))
+
+
+#-------------------------------------------------------------------------------
+def usage():
+    '''Display usage of the benchmark'''
+    print('Usage: ' + os.path.basename(sys.argv[0]) + ' [options] [benchmark...]')
+    print("\nBenchmarks: %s (default: all)" % ' '.join(Benchmarks))
+    print("\nOptions:\n")
+    print("  -h         This help message")
+    print("  --sizes=MP,...")
+    print("             Photo sizes in megapixels (default: %s)" % ','.join(map(str, Sizes)))
+    print("  --grids=N,...")
+    print("             NxN grids (default: %s)" % ','.join(map(str, Grids)))
+    print("  --formats=FMT,...")
+    print("             Photo formats, jpg and/or png (default: %s)" % ','.join(Formats))
+    print("  --repeat=N Number of runs of each benchmark, median is reported (default: %d)" %
+          Repeat)
+    print("  --quick    Small sizes and grids, one run")
+    print("  --image-dir=DIR")
+    print("             Directory of the generated photos (default: %s)" % ImageDir)
+    print("  --output=FILE")
+    print("             JSON results file (default: %s)" % OutFileName)
+    print("  --compare=FILE")
+    print("             Compare results with a previous JSON results file")
+
+
+#-------------------------------------------------------------------------------
+def parse_args():
+    '''Parse benchmark arguments. Return list of benchmarks to run.'''
+    global Sizes, Grids, Formats, Repeat, ImageDir, OutFileName, CompareFileName
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'sizes=', 'grids=', 'formats=',
+                                                      'repeat=', 'quick', 'image-dir=',
+                                                      'output=', 'compare='])
+        for o, a in opts:
+            if o == '-h' or o == '--help':
+                usage()
+                sys.exit(0)
+            elif o == '--sizes':
+                Sizes = [int(size) for size in a.split(',')]
+            elif o == '--grids':
+                Grids = [int(n) for n in a.split(',')]
+            elif o == '--formats':
+                Formats = a.split(',')
+            elif o == '--repeat':
+                Repeat = max(1, int(a))
+            elif o == '--quick':
+                Sizes = [1]
+                Grids = [2, 5]
+                Repeat = 1
+            elif o == '--image-dir':
+                ImageDir = a
+            elif o == '--output':
+                OutFileName = a
+            elif o == '--compare':
+                CompareFileName = a
+    except (getopt.GetoptError, ValueError) as err:
+        print(str(err))
+        usage()
+        sys.exit(1)
+    for name in args:
+        if name not in Benchmarks:
+            print('Unknown benchmark: %s' % name)
+            sys.exit(1)
+    return args or Benchmarks
+
+
+#-------------------------------------------------------------------------------
+def main():
+    '''Main function'''
+    global app
+    benchmarks = parse_args()
+    pyview.logger.setLevel(pyview.logging.WARNING)
+    # Cold loads must decode the photos, and the user's thumbnail cache be left alone
+    pyview.thumbnailStore.enabled = False
+    pyview.filenames[:] = getPhotos(Sizes[0], Formats[0], 4)
+    # Application path is used to find the icons
+    app = pyview.PyView([pyview.__file__])
+    pyview.app = app
+    # Photos are loaded after the first paint otherwise
+    app.scene.loadDeferredPhotos()
+    pyview.imageLoader.waitForDone()
+
+    results = []
+    for name in benchmarks:
+        globals()['bench' + name.capitalize()](results)
+
+    report = {'revision': gitRevision(),
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'qt': QT_VERSION_STR,
+              'pyqt': PYQT_VERSION_STR,
+              'platform': platform.platform(),
+              'cpus': os.cpu_count(),
+              'repeat': Repeat,
+              'results': results}
+    with open(OutFileName, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Results written to %s' % OutFileName)
+    if CompareFileName:
+        compare(results, CompareFileName)
+
+    pyview.imageLoader.cancelAll()
+    pyview.imageLoader.pool.waitForDone()
+
+
+if __name__ == '__main__':
+    main()
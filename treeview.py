@@ -1,31 +1,39 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 # -*- coding: utf-8 -*-
-#
-import os
-import sys
-from PyQt4.QtCore import *
-from PyQt4.QtGui import *
+'''
+Photo browser panel: lazy list of the photos of a directory
 
-# Create an PyQT4 application object.
-a = QApplication(sys.argv)
+Entries are read by batches with os.scandir() as the view scrolls, and files are
+only stat'ed and thumbnailed when their row is displayed, so that directories of
+100k photos open instantly.
+'''
 
-# The QWidget widget is the base class of all user interface objects in PyQt4.
-w = QWidget()
+import os
+import sys
+from collections import OrderedDict
 
-# Set window size.
-w.resize(320, 240)
+from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QDockWidget, QStyle
+from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QTreeView, QLineEdit, QToolButton
+from PyQt5.QtWidgets import QHeaderView, QAbstractItemView
 
-# Set window title
-w.setWindowTitle("TreeWidget")
+from PyQt5.QtGui import QPixmap
 
-# Add layout
-layout = QVBoxLayout()
-w.setLayout(layout)
+from PyQt5.QtCore import Qt, QSize, QUrl, QMimeData, QAbstractTableModel, QModelIndex, pyqtSignal
 
 OneGB = (1024.0 * 1024.0 * 1024.0)
 OneMB = (1024.0 * 1024.0)
 OneKB = 1024.0
 
+# Directory entries read per fetch
+FetchBatchSize = 1000
+ThumbnailSize = 48
+# Thumbnails kept in memory
+MaxThumbnails = 2000
+# Thumbnail requests kept pending: older ones (rows scrolled past) are cancelled
+MaxPendingThumbnails = 256
+ImageExtensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+
 def hsize(size):
     '''returns human-readable size'''
     if size >= OneGB:
@@ -37,24 +45,291 @@ def hsize(size):
     else:
         return '%d B ' % (size)
 
-# Add a tree widget
-tree = QTreeWidget()
-tree.setHeaderLabels(["Name", "Size"])
-tree.setSortingEnabled(True)
-tree.sortByColumn(0, Qt.AscendingOrder)
-items = []
-for f in os.listdir("/usr/share/pixmaps/"):
-    fpath = os.path.join("/usr/share/pixmaps", f)
-    if os.path.isfile(fpath):
-        fstat = os.stat(fpath)
-        item = QTreeWidgetItem([f, hsize(fstat.st_size)])
-        item.setTextAlignment(1, Qt.AlignRight)
-        items.append(item)
-tree.insertTopLevelItems(0, items)
-tree.resizeColumnToContents(0)
-layout.addWidget(tree)
-
-# Show window
-w.show()
-
-sys.exit(a.exec_())
+
+#-------------------------------------------------------------------------------
+class PhotoListModel(QAbstractTableModel):
+    '''
+    Model of the subdirectories and photos of a directory. loader is an object with
+    load(filename, callback, maxSize) and cancel(filename, callback, maxSize) methods
+    (see pyview.ImageLoader), used to decode thumbnails. No thumbnails without loader.
+    '''
+
+    Columns = ['Name', 'Size']
+
+    # Emitted when a thumbnail has been decoded, connected to thumbnailLoaded() through
+    # the event loop
+    thumbnailReady = pyqtSignal(str, QPixmap)
+
+    def __init__(self, loader=None, parent=None):
+        super(PhotoListModel, self).__init__(parent)
+        self.loader = loader
+        self.directory = None
+        self.entries = []
+        self._iterator = None
+        # Thumbnails: path -> QPixmap, null if the file couldn't be decoded
+        self.thumbnails = OrderedDict()
+        # Pending thumbnail requests: path -> row
+        self.pending = OrderedDict()
+        self.thumbnailSize = QSize(ThumbnailSize, ThumbnailSize)
+        self.dirIcon = QApplication.style().standardIcon(QStyle.SP_DirIcon)
+        self.thumbnailReady.connect(self.thumbnailLoaded, Qt.QueuedConnection)
+
+    #-------------------------------------------------------
+    def setDirectory(self, directory):
+        '''List directory. Return False if it can't be read.'''
+        try:
+            iterator = os.scandir(directory)
+        except OSError:
+            return False
+        self.beginResetModel()
+        self._close()
+        self.cancelThumbnails()
+        self.directory = os.path.abspath(directory)
+        self.entries = []
+        self._iterator = iterator
+        self.endResetModel()
+        return True
+
+    #-------------------------------------------------------
+    def _close(self):
+        '''Close directory iterator'''
+        if self._iterator is not None:
+            self._iterator.close()
+            self._iterator = None
+
+    #-------------------------------------------------------
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self._iterator is not None
+
+    #-------------------------------------------------------
+    def fetchMore(self, parent):
+        '''Read next batch of directory entries'''
+        if parent.isValid() or self._iterator is None:
+            return
+        entries = []
+        try:
+            for _ in range(FetchBatchSize):
+                entry = next(self._iterator)
+                # d_type is known from scandir(): no stat here, except for symlinks
+                if entry.name.startswith('.'):
+                    continue
+                if entry.name.lower().endswith(ImageExtensions) or entry.is_dir():
+                    entries.append(entry)
+        except (StopIteration, OSError):
+            self._close()
+        if entries:
+            first = len(self.entries)
+            self.beginInsertRows(QModelIndex(), first, first + len(entries) - 1)
+            self.entries += entries
+            self.endInsertRows()
+
+    #-------------------------------------------------------
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+
+    #-------------------------------------------------------
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.Columns)
+
+    #-------------------------------------------------------
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.Columns[section]
+        return None
+
+    #-------------------------------------------------------
+    def isDir(self, index):
+        '''Return True if entry of index is a directory'''
+        try:
+            return self.entries[index.row()].is_dir()
+        except OSError:
+            return False
+
+    #-------------------------------------------------------
+    def path(self, index):
+        '''Return path of entry of index'''
+        return self.entries[index.row()].path
+
+    #-------------------------------------------------------
+    def data(self, index, role=Qt.DisplayRole):
+        '''Return data of visible rows. Files are stat'ed and thumbnailed on first display.'''
+        if not index.isValid():
+            return None
+        entry = self.entries[index.row()]
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == 0:
+                return entry.name
+            if self.isDir(index):
+                return ''
+            try:
+                # Cached by DirEntry
+                return hsize(entry.stat().st_size)
+            except OSError:
+                return ''
+        elif role == Qt.DecorationRole and column == 0:
+            if self.isDir(index):
+                return self.dirIcon
+            thumbnail = self.thumbnails.get(entry.path)
+            if thumbnail is None:
+                self.requestThumbnail(entry.path, index.row())
+            elif not thumbnail.isNull():
+                return thumbnail
+        elif role == Qt.TextAlignmentRole and column == 1:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        elif role == Qt.ToolTipRole:
+            return entry.path
+        return None
+
+    #-------------------------------------------------------
+    def flags(self, index):
+        flags = super(PhotoListModel, self).flags(index)
+        if index.isValid() and not self.isDir(index):
+            flags |= Qt.ItemIsDragEnabled
+        return flags
+
+    #-------------------------------------------------------
+    def mimeTypes(self):
+        return ['text/uri-list']
+
+    #-------------------------------------------------------
+    def mimeData(self, indexes):
+        '''Return URLs of dragged photos'''
+        paths = []
+        for index in indexes:
+            path = self.path(index)
+            if path not in paths and not self.isDir(index):
+                paths.append(path)
+        mimeData = QMimeData()
+        mimeData.setUrls([QUrl.fromLocalFile(path) for path in paths])
+        return mimeData
+
+    #-------------------------------------------------------
+    def supportedDragActions(self):
+        return Qt.CopyAction
+
+    #-------------------------------------------------------
+    def requestThumbnail(self, path, row):
+        '''Request decoding of thumbnail of path, displayed at row'''
+        if self.loader is None:
+            return
+        if path in self.pending:
+            self.pending.move_to_end(path)
+            return
+        self.pending[path] = row
+        self.loader.load(path, self.thumbnailDecodedHandler, self.thumbnailSize)
+        if len(self.pending) > MaxPendingThumbnails:
+            # Row has most likely been scrolled past
+            oldest = next(iter(self.pending))
+            del self.pending[oldest]
+            self.loader.cancel(oldest, self.thumbnailDecodedHandler, self.thumbnailSize)
+
+    #-------------------------------------------------------
+    def cancelThumbnails(self):
+        '''Cancel all pending thumbnail requests'''
+        for path in self.pending:
+            self.loader.cancel(path, self.thumbnailDecodedHandler, self.thumbnailSize)
+        self.pending.clear()
+
+    #-------------------------------------------------------
+    def thumbnailDecodedHandler(self, filename, pixmap, _sourceSize):
+        '''
+        Loader callback, called from data() when the thumbnail is already decoded: the
+        model is updated later, not while the view reads it
+        '''
+        self.thumbnailReady.emit(filename, pixmap)
+
+    #-------------------------------------------------------
+    def thumbnailLoaded(self, filename, pixmap):
+        '''Called when thumbnail of filename has been decoded'''
+        row = self.pending.pop(filename, None)
+        if row is None:
+            return
+        if pixmap.width() > ThumbnailSize or pixmap.height() > ThumbnailSize:
+            pixmap = pixmap.scaled(self.thumbnailSize, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        self.thumbnails[filename] = pixmap
+        if len(self.thumbnails) > MaxThumbnails:
+            self.thumbnails.popitem(last=False)
+        index = self.index(row, 0)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
+#-------------------------------------------------------------------------------
+class PhotoBrowser(QDockWidget):
+    '''Dockable panel listing the photos of a directory. Photos can be dragged to the collage.'''
+
+    def __init__(self, loader=None, parent=None):
+        super(PhotoBrowser, self).__init__('Photos', parent)
+        self.model = PhotoListModel(loader, self)
+
+        widget = QWidget()
+        vbox = QVBoxLayout()
+        vbox.setContentsMargins(0, 0, 0, 0)
+        widget.setLayout(vbox)
+        # Directory path and parent directory button
+        hbox = QHBoxLayout()
+        upButton = QToolButton()
+        upButton.setIcon(self.style().standardIcon(QStyle.SP_FileDialogToParent))
+        upButton.setToolTip('Parent directory')
+        upButton.clicked.connect(self.parentDirectory)
+        hbox.addWidget(upButton)
+        self.pathEdit = QLineEdit()
+        self.pathEdit.returnPressed.connect(lambda: self.setDirectory(self.pathEdit.text()))
+        hbox.addWidget(self.pathEdit)
+        vbox.addLayout(hbox)
+        # File list. Uniform row heights let the view only query the visible rows.
+        self.view = QTreeView()
+        self.view.setModel(self.model)
+        self.view.setUniformRowHeights(True)
+        self.view.setRootIsDecorated(False)
+        self.view.setIconSize(QSize(ThumbnailSize, ThumbnailSize))
+        self.view.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.view.setDragEnabled(True)
+        self.view.setDragDropMode(QAbstractItemView.DragOnly)
+        self.view.header().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.view.header().setStretchLastSection(False)
+        self.view.doubleClicked.connect(self.itemDoubleClicked)
+        vbox.addWidget(self.view)
+        self.setWidget(widget)
+
+    #-------------------------------------------------------
+    def setDirectory(self, directory):
+        '''List photos of directory'''
+        if self.model.setDirectory(directory):
+            self.pathEdit.setText(self.model.directory)
+        else:
+            self.pathEdit.setText(self.model.directory or '')
+
+    #-------------------------------------------------------
+    def parentDirectory(self):
+        '''List parent directory'''
+        if self.model.directory:
+            self.setDirectory(os.path.dirname(self.model.directory))
+
+    #-------------------------------------------------------
+    def itemDoubleClicked(self, index):
+        '''Enter directory on double click'''
+        if self.model.isDir(index):
+            self.setDirectory(self.model.path(index))
+
+
+#-------------------------------------------------------------------------------
+def main():
+    '''Browse directory given as argument'''
+    from pyview import imageLoader
+
+    a = QApplication(sys.argv)
+    w = QMainWindow()
+    w.resize(320, 480)
+    w.setWindowTitle("Photos")
+    browser = PhotoBrowser(imageLoader)
+    browser.setDirectory(sys.argv[1] if len(sys.argv) > 1 else os.getcwd())
+    w.setCentralWidget(browser)
+    w.show()
+    ret = a.exec_()
+    imageLoader.cancelAll()
+    imageLoader.pool.waitForDone()
+    sys.exit(ret)
+
+if __name__ == '__main__':
+    main()